@@ -4,6 +4,7 @@ import numpy as np
 from cs231n.layers import *
 from cs231n.fast_layers import *
 from cs231n.layer_utils import *
+from cs231n.sequential import Sequential
 
 
 class ThreeLayerConvNet(object):
@@ -12,14 +13,23 @@ class ThreeLayerConvNet(object):
 
     conv - relu - 2x2 max pool - affine - relu - affine - softmax
 
+    Optionally the pooled feature maps are reduced with a global average pool
+    before the hidden affine layer:
+
+    conv - relu - 2x2 max pool - global avg pool - affine - relu - affine - softmax
+
+    which shrinks W2 from (num_filters * H/2 * W/2, hidden_dim) to
+    (num_filters, hidden_dim), and the hidden layer GEMM with it.
+
     The network operates on minibatches of data that have shape (N, C, H, W)
     consisting of N images, each with height H and width W and with C input
-    channels.
+    channels, or shape (N, H, W, C) if the network is built with
+    layout='NHWC'.
     """
 
     def __init__(self, input_dim=(3, 32, 32), num_filters=32, filter_size=7,
                  hidden_dim=100, num_classes=10, weight_scale=1e-3, reg=0.0,
-                 dtype=np.float32):
+                 dtype=np.float32, global_pool=False, layout='NCHW'):
         """
         Initialize a new network.
 
@@ -32,11 +42,23 @@ class ThreeLayerConvNet(object):
         - weight_scale: Scalar giving standard deviation for random initialization
           of weights.
         - reg: Scalar giving L2 regularization strength
-        - dtype: numpy datatype to use for computation.
+        - dtype: numpy datatype to use for computation. float16 stores weights
+          and activations in half precision for mixed-precision training with
+          the Solver.
+        - global_pool: If True, use a global average pooling head instead of
+          feeding the flattened feature maps to the hidden affine layer.
+        - layout: 'NCHW' or 'NHWC', the layout of the input images. Channels-last
+          data (as stored by CIFAR-10) is convolved without any transposes.
+          input_dim is (C, H, W) either way.
         """
         self.params = {}
         self.reg = reg
         self.dtype = dtype
+        self.global_pool = global_pool
+        self.layout = layout
+        # Factor by which the gradients are scaled; set by the Solver for
+        # mixed-precision training so that they do not underflow in float16.
+        self.loss_scale = 1.0
 
         ############################################################################
         # TODO: Initialize weights and biases for the three-layer convolutional    #
@@ -55,7 +77,10 @@ class ThreeLayerConvNet(object):
         ############################################################################
         
         self.params['W1'] = np.random.normal(scale=weight_scale, size=(num_filters, input_dim[0], filter_size, filter_size))
-        W2_row_size = num_filters * input_dim[1]//2 * input_dim[2]//2
+        if global_pool:
+            W2_row_size = num_filters
+        else:
+            W2_row_size = num_filters * input_dim[1]//2 * input_dim[2]//2
         self.params['W2'] = np.random.normal(scale=weight_scale, size=(W2_row_size, hidden_dim)) 
         self.params['W3'] = np.random.normal(scale=weight_scale, size=(hidden_dim, num_classes))
     
@@ -78,16 +103,16 @@ class ThreeLayerConvNet(object):
         Input / output: Same API as TwoLayerNet in fc_net.py.
         """
         W1, b1 = self.params['W1'], self.params['b1']
-        W2, b2 = self.params['W2'], self.params['b2']
-        W3, b3 = self.params['W3'], self.params['b3']
 
         # pass conv_param to the forward pass for the convolutional layer
         # Padding and stride chosen to preserve the input spatial size
         filter_size = W1.shape[2]
-        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2,
+                      'layout': self.layout}
 
         # pass pool_param to the forward pass for the max-pooling layer
-        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2,
+                      'layout': self.layout}
 
         scores = None
         ############################################################################
@@ -100,8 +125,15 @@ class ThreeLayerConvNet(object):
         ############################################################################
         
         out_1, cache_1 = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)
-        out_2, cache_2 = affine_relu_forward(out_1, W2, b2)
-        out_3, cache_3 = affine_forward(out_2, W3, b3)
+        if self.global_pool:
+            if self.layout == 'NHWC':
+                # Average over the spatial axes of a channels-first view
+                out_1 = out_1.transpose(0, 3, 1, 2)
+            out_1, cache_gap = global_avg_pool_forward(out_1)
+        # W2 and W3 may have been factorized by low-rank compression
+        a_2, cache_2 = affine_layer_forward(out_1, self.params, 2)
+        out_2, cache_relu_2 = relu_forward(a_2)
+        out_3, cache_3 = affine_layer_forward(out_2, self.params, 3)
         scores = out_3
         
         ############################################################################
@@ -124,18 +156,122 @@ class ThreeLayerConvNet(object):
         ############################################################################
         
         loss, dscores = softmax_loss(scores, y)
-        loss += sum(0.5*self.reg*np.sum(W_tmp**2) for W_tmp in [W1, W2, W3])
+        dscores = (dscores * self.loss_scale).astype(self.dtype, copy=False)
     
-        dx_3, grads['W3'], grads['b3'] = affine_backward(dscores, cache_3)
-        dx_2, grads['W2'], grads['b2'] = affine_relu_backward(dx_3, cache_2)
+        dx_3, layer_grads = affine_layer_backward(dscores, cache_3)
+        grads.update(layer_grads)
+        da_2 = relu_backward(dx_3, cache_relu_2)
+        dx_2, layer_grads = affine_layer_backward(da_2, cache_2)
+        grads.update(layer_grads)
+        if self.global_pool:
+            dx_2 = global_avg_pool_backward(dx_2, cache_gap)
+            if self.layout == 'NHWC':
+                dx_2 = dx_2.transpose(0, 2, 3, 1)
         dx_1, grads['W1'], grads['b1'] = conv_relu_pool_backward(dx_2, cache_1)
     
-        grads['W3'] += self.reg*self.params['W3']
-        grads['W2'] += self.reg*self.params['W2']
-        grads['W1'] += self.reg*self.params['W1']
+        weights = ('W1',) + weight_names(self.params, 2) + weight_names(self.params, 3)
+        for k in weights:
+            loss += 0.5*self.reg*np.sum(self.params[k]**2)
+            grads[k] += self.loss_scale*self.reg*self.params[k]
         
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
 
         return loss, grads
+
+
+class DeepConvNet(Sequential):
+    """
+    A convolutional network of configurable depth, made of a stack of conv
+    blocks followed by fully-connected layers:
+
+    {conv - [batch/group norm] - relu - [2x2 max pool]} x L - [global avg pool]
+    - {affine - [batch norm] - relu - [dropout]} x M - affine - softmax
+
+    Each block is described by a dictionary with the keys:
+    - num_filters: Number of filters of the conv layer
+    - filter_size: Width/height of the filters; default 3
+    - stride: Stride of the conv layer; default 1
+    - pad: Zero-padding of the conv layer; default (filter_size - 1) // 2,
+      which preserves the spatial size for stride 1
+    - pool: If True, the block ends with a 2x2 max pool of stride 2; default
+      False
+    - normalization: 'batchnorm', 'groupnorm' or None; defaults to the
+      normalization of the network
+    - G: Number of groups for 'groupnorm'
+
+    Blocks with batch normalization run as fused conv_bn_relu layers, and
+    blocks without normalization that pool as fused conv_relu_pool layers.
+    The network is a Sequential model, so its loss runs through a plan that
+    is compiled once. The parameters of the i-th conv or affine layer are Wi
+    and bi, and those of the normalization layer following it gammai and
+    betai.
+
+    The network operates on minibatches of data that have shape (N, C, H, W)
+    consisting of N images, each with height H and width W and with C input
+    channels.
+    """
+
+    def __init__(self, blocks, input_dim=(3, 32, 32), hidden_dims=(),
+                 num_classes=10, normalization='batchnorm', global_pool=False,
+                 dropout=1, weight_scale='kaiming', reg=0.0,
+                 dtype=np.float32, seed=None):
+        """
+        Initialize a new network.
+
+        Inputs:
+        - blocks: List of block dictionaries, as described above
+        - input_dim: Tuple (C, H, W) giving size of input data
+        - hidden_dims: List of integers giving the size of each hidden
+          fully-connected layer
+        - num_classes: Number of scores to produce from the final affine layer.
+        - normalization: Default normalization of the conv blocks, which is
+          also used for the hidden fully-connected layers if it is
+          'batchnorm'.
+        - global_pool: If True, average the feature maps of the last block
+          over space before the fully-connected layers.
+        - dropout: Scalar between 0 and 1 giving the probability of keeping
+          a unit after each hidden fully-connected layer; 1 disables dropout.
+        - weight_scale: Scalar giving standard deviation for random
+          initialization of weights, or 'kaiming'
+        - reg: Scalar giving L2 regularization strength
+        - dtype: numpy datatype to use for computation.
+        - seed: If not None, then pass this random seed to the dropout layers.
+        """
+        layers = []
+        for block in blocks:
+            block_norm = block.get('normalization', normalization)
+            filter_size = block.get('filter_size', 3)
+            layers.append({'type': 'conv', 'num_filters': block['num_filters'],
+                           'filter_size': filter_size,
+                           'stride': block.get('stride', 1),
+                           'pad': block.get('pad', (filter_size - 1) // 2)})
+            if block_norm == 'batchnorm':
+                layers.append({'type': 'spatial_batchnorm'})
+            elif block_norm == 'groupnorm':
+                if 'G' not in block:
+                    raise ValueError('Group normalization needs the number of '
+                                     'groups G')
+                layers.append({'type': 'groupnorm', 'G': block['G']})
+            elif block_norm is not None:
+                raise ValueError('Invalid normalization "%s"' % block_norm)
+            layers.append({'type': 'relu'})
+            if block.get('pool', False):
+                layers.append({'type': 'max_pool', 'pool_size': 2,
+                               'stride': 2})
+        if global_pool:
+            layers.append({'type': 'global_avg_pool'})
+        for dim in hidden_dims:
+            layers.append({'type': 'affine', 'dim': dim})
+            if normalization == 'batchnorm':
+                layers.append({'type': 'batchnorm'})
+            layers.append({'type': 'relu'})
+            if dropout != 1:
+                layers.append({'type': 'dropout', 'p': dropout})
+        layers.append({'type': 'affine', 'dim': num_classes})
+
+        self.blocks = blocks
+        super(DeepConvNet, self).__init__(layers, input_dim=input_dim,
+                                          weight_scale=weight_scale, reg=reg,
+                                          dtype=dtype, seed=seed)
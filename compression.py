@@ -0,0 +1,180 @@
+from __future__ import print_function, division
+from builtins import range
+import copy
+from timeit import default_timer as timer
+
+import numpy as np
+
+from cs231n.layer_utils import weight_names
+
+"""
+This file implements low-rank compression of affine layers.
+
+compress_model replaces trained affine weights W of shape (D, M) with factors
+U of shape (D, R) and V of shape (R, M) from a truncated SVD of W. The rank R
+is either given or chosen to keep a given fraction of the energy of the
+singular values. The models then compute the layer as two thin matrix
+products (see factorized_affine_forward in layers.py). The factors are
+ordinary parameters, so the compressed model can be fine-tuned with a
+Solver to recover accuracy:
+
+compressed = compress_model(model, energy=0.9)
+solver = Solver(compressed, data, update_rule='adam', num_epochs=2)
+solver.train()
+
+compression_report shows the resulting trade-off between accuracy, size and
+latency.
+"""
+
+
+def choose_rank(s, energy):
+    """
+    Returns the smallest rank R for which the first R singular values hold at
+    least the given fraction of the energy (sum of squares) of all of s.
+    """
+    cumulative = np.cumsum(s ** 2)
+    if cumulative[-1] == 0:
+        return 1
+    rank = np.searchsorted(cumulative / cumulative[-1], energy) + 1
+    return int(min(rank, len(s)))
+
+
+def truncated_svd(w, rank=None, energy=None):
+    """
+    Factorizes w into the product of two thin matrices with a truncated SVD.
+
+    Inputs:
+    - w: Array of shape (D, M)
+    - rank: Rank R of the factorization
+    - energy: If rank is None, choose the smallest rank that keeps this
+      fraction of the energy of the singular values of w.
+
+    Returns a tuple of:
+    - u: Array of shape (D, R)
+    - v: Array of shape (R, M)
+      such that u.dot(v) is the best rank R approximation of w. The singular
+      values are split evenly between the factors, so that they have the same
+      scale for fine-tuning.
+    """
+    U, s, Vt = np.linalg.svd(w, full_matrices=False)
+    if rank is None:
+        if energy is None:
+            raise ValueError('Either rank or energy must be given')
+        rank = choose_rank(s, energy)
+    rank = min(rank, len(s))
+    root_s = np.sqrt(s[:rank])
+    u = U[:, :rank] * root_s
+    v = root_s[:, None] * Vt[:rank]
+    return u.astype(w.dtype), v.astype(w.dtype)
+
+
+def affine_layer_indices(params):
+    """
+    Indices i of the affine layers of a model, whose weights are params['W%d']
+    (2D) or the factors params['U%d'] and params['V%d'].
+    """
+    indices = set()
+    for k, v in params.items():
+        if k[0] in 'WUV' and k[1:].isdigit() and np.ndim(v) == 2:
+            indices.add(int(k[1:]))
+    return sorted(indices)
+
+
+def compress_model(model, rank=None, energy=None, layers=None):
+    """
+    Low-rank compression of the affine layers of a trained model, such as a
+    FullyConnectedNet or ThreeLayerConvNet.
+
+    Inputs:
+    - model: The model to compress; it is not modified.
+    - rank: Rank of the factorized weights
+    - energy: If rank is None, the fraction of the energy of the singular
+      values of each weight to keep; see truncated_svd.
+    - layers: Indices i of the affine layers to compress; by default all of
+      them.
+
+    A layer is only factorized if that reduces its cost, that is if
+    R * (D + M) < D * M; other layers keep their dense weights.
+
+    Returns a compressed copy of the model. Its attribute ranks maps the
+    index of every factorized layer to its rank.
+    """
+    if layers is None:
+        layers = affine_layer_indices(model.params)
+    compressed = copy.deepcopy(model)
+    compressed.ranks = dict(getattr(model, 'ranks', {}))
+    params = compressed.params
+    for i in layers:
+        if 'W%d' % i not in params:
+            # Already factorized
+            continue
+        w = params['W%d' % i]
+        u, v = truncated_svd(w, rank, energy)
+        R = u.shape[1]
+        D, M = w.shape
+        if R * (D + M) >= D * M:
+            continue
+        del params['W%d' % i]
+        params['U%d' % i] = u
+        params['V%d' % i] = v
+        compressed.ranks[i] = R
+    return compressed
+
+
+def affine_flops(params):
+    """
+    Number of multiply-adds per example of the affine layers of a model.
+    """
+    flops = 0
+    for i in affine_layer_indices(params):
+        for k in weight_names(params, i):
+            flops += np.prod(params[k].shape)
+    return int(flops)
+
+
+def compression_report(model, compressed, X, y, batch_size=100, num_runs=3,
+                       verbose=True):
+    """
+    Compares a model with its low-rank compressed version on a labelled
+    dataset.
+
+    Inputs:
+    - model: The original model
+    - compressed: The model returned by compress_model(model, ...), possibly
+      fine-tuned
+    - X, y: Input data and labels
+    - batch_size: Size of the minibatches passed to loss
+    - num_runs: Number of timed passes over X; the fastest one is reported.
+    - verbose: Whether to print the report
+
+    Returns a dictionary with the following keys, each mapping to a tuple of
+    the values for the original and the compressed model:
+    - acc: Accuracy on (X, y)
+    - time: Seconds per pass over X
+    - params: Number of parameters
+    - affine_flops: Multiply-adds per example in the affine layers
+    """
+    report = {'acc': (), 'time': (), 'params': (), 'affine_flops': ()}
+    for m in (model, compressed):
+        best = None
+        for _ in range(num_runs):
+            start = timer()
+            y_pred = np.hstack([np.argmax(m.loss(X[i:i + batch_size]), axis=1)
+                                for i in range(0, X.shape[0], batch_size)])
+            elapsed = timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+        report['acc'] += (np.mean(y_pred == y),)
+        report['time'] += (best,)
+        report['params'] += (sum(np.prod(v.shape) for v in m.params.values()),)
+        report['affine_flops'] += (affine_flops(m.params),)
+
+    if verbose:
+        print('Ranks: %s' % ', '.join('layer %d: %d' % (i, r)
+                                      for i, r in sorted(compressed.ranks.items())))
+        print('%-11s %10s %12s %12s %14s' % ('', 'accuracy', 'time (ms)',
+                                             'params', 'affine flops'))
+        for j, name in enumerate(('original', 'compressed')):
+            print('%-11s %10.4f %12.2f %12d %14d' % (
+                   name, report['acc'][j], 1e3 * report['time'][j],
+                   report['params'][j], report['affine_flops'][j]))
+    return report
@@ -1,173 +1,1531 @@
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from timeit import default_timer as timer
+
 import numpy as np
+
+from cs231n.im2col import *
+from cs231n.layers import matmul_mixed
+from cs231n.workspace import workspace, pad_into
 try:
     from cs231n.im2col_cython import col2im_cython, im2col_cython
     from cs231n.im2col_cython import col2im_6d_cython
 except ImportError:
-    print('run the following from the cs231n directory and try again:')
-    print('python setup.py build_ext --inplace')
-    print('You may also need to restart your iPython kernel')
+    # The Cython extension has not been built (run
+    # `python setup.py build_ext --inplace` from the cs231n directory to build
+    # it). Fall back on the vectorized numpy engine from im2col.py, which has
+    # the same signatures and layouts, so every fast layer keeps working.
+    im2col_cython = im2col_strided
+    col2im_cython = col2im_strided
+    col2im_6d_cython = col2im_6d_strided
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    # Without threadpoolctl the BLAS thread count is left alone.
+    threadpool_limits = None
 
-from cs231n.im2col import *
+
+def conv_forward_im2col(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer
+    based on im2col and col2im.
+    """
+    N, C, H, W = x.shape
+    num_filters, _, filter_height, filter_width = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    # Check dimensions
+    assert (W + 2 * pad - filter_width) % stride == 0, 'width does not work'
+    assert (H + 2 * pad - filter_height) % stride == 0, 'height does not work'
+
+    # Create output
+    out_height = (H + 2 * pad - filter_height) // stride + 1
+    out_width = (W + 2 * pad - filter_width) // stride + 1
+    out = np.zeros((N, num_filters, out_height, out_width), dtype=x.dtype)
+
+    # x_cols = im2col_indices(x, w.shape[2], w.shape[3], pad, stride)
+    x_cols = im2col_cython(x, w.shape[2], w.shape[3], pad, stride)
+    res = w.reshape((w.shape[0], -1)).dot(x_cols) + b.reshape(-1, 1)
+
+    out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
+    out = out.transpose(3, 0, 1, 2)
+
+    cache = (x, w, b, conv_param, x_cols)
+    return out, cache
+
+
+def _strided_im2col(x, field_height, field_width, stride, pad):
+    """
+    Builds the im2col matrix of x for conv_forward_strides by picking clever
+    strides over a padded copy of the input.
+
+    Returns a tuple of:
+    - x_cols: Array of shape (C * HH * WW, N * out_h * out_w), taken from the
+      workspace pool; the caller is responsible for releasing it.
+    - out_h, out_w: Output dimensions of the convolution
+    """
+    N, C, H, W = x.shape
+    HH, WW = field_height, field_width
+
+    # Pad the input
+    x_padded = pad_into(x, pad, workspace)
+
+    # Figure out output dimensions
+    H += 2 * pad
+    W += 2 * pad
+    out_h = (H - HH) // stride + 1
+    out_w = (W - WW) // stride + 1
+
+    # Perform an im2col operation by picking clever strides
+    shape = (C, HH, WW, N, out_h, out_w)
+    strides = (H * W, W, 1, C * H * W, stride * W, stride)
+    strides = x.itemsize * np.array(strides)
+    x_stride = np.lib.stride_tricks.as_strided(x_padded,
+                  shape=shape, strides=strides)
+    x_cols = workspace.acquire((C * HH * WW, N * out_h * out_w), x.dtype)
+    x_cols.reshape(shape)[...] = x_stride
+    workspace.release(x_padded)
+
+    return x_cols, out_h, out_w
+
+
+def _take_cached(slot):
+    """
+    Returns the workspace buffers held in the one-element list slot of a
+    cache and empties it. Backward passes that release these buffers to the
+    pool take them this way, so that giving them the same cache twice raises
+    an error instead of releasing the buffers twice.
+    """
+    buffers = slot[0]
+    if buffers is None:
+        raise ValueError('This cache has already been used for a backward '
+                         'pass; run the forward pass again')
+    slot[0] = None
+    return buffers
+
+
+def conv_forward_strides(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer that
+    builds the im2col matrix with stride tricks.
+
+    The padded input, the im2col matrix and the GEMM result are drawn from the
+    shared workspace pool, so that repeated calls with the same shapes do not
+    allocate them again. The im2col matrix is kept in the cache and given back
+    to the pool by conv_backward_strides, so each cache can only be used for a
+    single backward pass; a second one raises a ValueError.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    # Check dimensions
+    #assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+    #assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+
+    x_cols, out_h, out_w = _strided_im2col(x, HH, WW, stride, pad)
+
+    # Now all our convolutions are a big matrix multiply
+    w_flat = w.reshape(F, -1)
+    res = workspace.acquire((F, N * out_h * out_w),
+                            np.result_type(w_flat, x_cols))
+    matmul_mixed(w_flat, x_cols, out=res)
+
+    # Reshape the output, adding the bias while making it contiguous
+    res_4d = res.reshape(F, N, out_h, out_w).transpose(1, 0, 2, 3)
+    out = np.empty(res_4d.shape, dtype=np.result_type(res, b))
+    np.add(res_4d, b.reshape(1, -1, 1, 1), out=out)
+    workspace.release(res)
+
+    cache = (x, w, b, conv_param, [x_cols])
+    return out, cache
+
+
+def conv_backward_strides(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer
+    computed with conv_forward_strides.
+
+    The im2col matrix from the cache is released to the workspace pool.
+    """
+    x, w, b, conv_param, x_cols_slot = cache
+    x_cols = _take_cached(x_cols_slot)
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    _, _, out_h, out_w = dout.shape
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    dout_reshaped = workspace.acquire((F, N * out_h * out_w), dout.dtype)
+    dout_reshaped.reshape(F, N, out_h, out_w)[...] = dout.transpose(1, 0, 2, 3)
+    dw = matmul_mixed(dout_reshaped, x_cols.T).reshape(w.shape)
+
+    w_flat = w.reshape(F, -1)
+    dx_cols = workspace.acquire((C * HH * WW, N * out_h * out_w),
+                                np.result_type(w_flat, dout_reshaped))
+    matmul_mixed(w_flat.T, dout_reshaped, out=dx_cols)
+    dx = col2im_6d_cython(dx_cols.reshape(C, HH, WW, N, out_h, out_w),
+                          N, C, H, W, HH, WW, pad, stride)
+
+    workspace.release(x_cols, dout_reshaped, dx_cols)
+    return dx, dw, db
+
+
+def _conv_tile_size(x, w, conv_param):
+    """
+    Returns the number of images per tile for conv_forward_tiled, chosen so
+    that the im2col matrix of a tile fits in the memory budget.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
+    budget = conv_param.get('max_workspace_bytes', CONV_MAX_WORKSPACE_BYTES)
+    bytes_per_image = C * HH * WW * out_h * out_w * x.itemsize
+    return int(min(N, max(1, budget // bytes_per_image)))
+
+
+def conv_forward_tiled(x, w, b, conv_param):
+    """
+    A memory-bounded implementation of the forward pass for a convolutional
+    layer.
+
+    This works like conv_forward_strides, but processes the minibatch in tiles
+    of images whose im2col matrix fits in conv_param['max_workspace_bytes']
+    (default CONV_MAX_WORKSPACE_BYTES). The columns are not kept in the cache;
+    conv_backward_tiled recomputes them one tile at a time, so peak memory
+    does not grow with the batch size. A tile holds at least one image.
+
+    Inputs / outputs: Same as conv_forward_strides; the cache is specific to
+    this function and must be passed to conv_backward_tiled.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    tile = _conv_tile_size(x, w, conv_param)
+
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
+    w_flat = w.reshape(F, -1)
+    out = np.empty((N, F, out_h, out_w), dtype=np.result_type(x, w, b))
+    for start in range(0, N, tile):
+        end = min(start + tile, N)
+        x_cols, _, _ = _strided_im2col(x[start:end], HH, WW, stride, pad)
+        res = matmul_mixed(w_flat, x_cols)
+        res = res.reshape(F, end - start, out_h, out_w)
+        np.add(res.transpose(1, 0, 2, 3), b.reshape(1, -1, 1, 1),
+               out=out[start:end])
+        workspace.release(x_cols)
+
+    cache = (x, w, b, conv_param)
+    return out, cache
+
+
+def conv_backward_tiled(dout, cache):
+    """
+    A memory-bounded implementation of the backward pass for a convolutional
+    layer computed with conv_forward_tiled.
+
+    The im2col matrix is rebuilt for each tile of images; the filter and bias
+    gradients are accumulated across tiles.
+    """
+    x, w, b, conv_param = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    _, _, out_h, out_w = dout.shape
+    tile = _conv_tile_size(x, w, conv_param)
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    w_flat = w.reshape(F, -1)
+    dw = np.zeros(w_flat.shape, dtype=np.result_type(dout, x))
+    dx = np.empty(x.shape, dtype=np.result_type(dout, w))
+    for start in range(0, N, tile):
+        end = min(start + tile, N)
+        n = end - start
+        x_cols, _, _ = _strided_im2col(x[start:end], HH, WW, stride, pad)
+        dout_tile = dout[start:end].transpose(1, 0, 2, 3).reshape(F, -1)
+        dw += matmul_mixed(dout_tile, x_cols.T)
+        workspace.release(x_cols)
+
+        dx_cols = matmul_mixed(w_flat.T, dout_tile)
+        dx_cols.shape = (C, HH, WW, n, out_h, out_w)
+        dx[start:end] = col2im_6d_cython(dx_cols, n, C, H, W, HH, WW, pad,
+                                         stride)
+
+    dw = dw.reshape(w.shape)
+    return dx, dw, db
+
+
+_conv_executor = None
+_conv_executor_threads = 0
+
+
+def _conv_thread_pool(num_threads):
+    """
+    Returns a shared thread pool with at least num_threads workers.
+
+    The pool is sized once for all the cores, and only rebuilt if more
+    threads than that are ever requested, so calls with different thread or
+    shard counts share it.
+    """
+    global _conv_executor, _conv_executor_threads
+    if _conv_executor_threads < num_threads:
+        if _conv_executor is not None:
+            _conv_executor.shutdown()
+        _conv_executor_threads = max(num_threads, os.cpu_count() or 1)
+        _conv_executor = ThreadPoolExecutor(max_workers=_conv_executor_threads)
+    return _conv_executor
+
+
+def _run_sharded(fn, num_items, num_threads):
+    """
+    Splits range(num_items) into at most num_threads contiguous shards and
+    calls fn(start, end) for each of them on the shared thread pool, returning
+    the results in order.
+
+    numpy releases the GIL in copies and BLAS calls, so the shards run in
+    parallel. While they run, BLAS is limited to its share of the cores (if
+    threadpoolctl is installed) so that the shards do not oversubscribe the
+    machine.
+    """
+    num_shards = max(1, min(num_threads, num_items))
+    bounds = np.linspace(0, num_items, num_shards + 1).astype(int)
+    shards = list(zip(bounds[:-1], bounds[1:]))
+    if num_shards == 1:
+        return [fn(*shards[0])]
+
+    executor = _conv_thread_pool(num_shards)
+    if threadpool_limits is None:
+        futures = [executor.submit(fn, *shard) for shard in shards]
+        return [future.result() for future in futures]
+    blas_threads = max(1, (os.cpu_count() or 1) // num_shards)
+    with threadpool_limits(limits=blas_threads, user_api='blas'):
+        futures = [executor.submit(fn, *shard) for shard in shards]
+        return [future.result() for future in futures]
+
+
+def conv_forward_threaded(x, w, b, conv_param):
+    """
+    A multithreaded implementation of the forward pass for a convolutional
+    layer.
+
+    The minibatch is split into conv_param['num_threads'] (default
+    CONV_NUM_THREADS) shards of images, and each worker thread runs the im2col
+    copy and GEMM of conv_forward_strides on its own shard, so that the copy
+    phases use all cores rather than only the GEMM.
+
+    Inputs / outputs: Same as conv_forward_strides; the cache is specific to
+    this function and must be passed to conv_backward_threaded.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    num_threads = conv_param.get('num_threads', CONV_NUM_THREADS)
+
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
+    w_flat = w.reshape(F, -1)
+    out = np.empty((N, F, out_h, out_w), dtype=np.result_type(x, w, b))
+
+    def forward_shard(start, end):
+        x_cols, _, _ = _strided_im2col(x[start:end], HH, WW, stride, pad)
+        res = matmul_mixed(w_flat, x_cols)
+        res = res.reshape(F, end - start, out_h, out_w)
+        np.add(res.transpose(1, 0, 2, 3), b.reshape(1, -1, 1, 1),
+               out=out[start:end])
+        return start, end, x_cols
+
+    shards = _run_sharded(forward_shard, N, num_threads)
+
+    cache = (x, w, b, conv_param, [shards])
+    return out, cache
+
+
+def conv_backward_threaded(dout, cache):
+    """
+    A multithreaded implementation of the backward pass for a convolutional
+    layer computed with conv_forward_threaded.
+
+    Each worker computes the input gradient of its shard and a partial filter
+    gradient; the partial filter gradients are summed at the end. The im2col
+    matrices from the cache are released to the workspace pool.
+    """
+    x, w, b, conv_param, shards_slot = cache
+    shards = _take_cached(shards_slot)
+    stride, pad = conv_param['stride'], conv_param['pad']
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    _, _, out_h, out_w = dout.shape
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    w_flat = w.reshape(F, -1)
+    dx = np.empty(x.shape, dtype=np.result_type(dout, w))
+    shard_cols = {start: x_cols for start, _, x_cols in shards}
+
+    def backward_shard(start, end):
+        n = end - start
+        x_cols = shard_cols[start]
+        dout_shard = dout[start:end].transpose(1, 0, 2, 3).reshape(F, -1)
+        dw_shard = matmul_mixed(dout_shard, x_cols.T)
+        dx_cols = matmul_mixed(w_flat.T, dout_shard)
+        dx_cols.shape = (C, HH, WW, n, out_h, out_w)
+        dx[start:end] = col2im_6d_cython(dx_cols, n, C, H, W, HH, WW, pad,
+                                         stride)
+        return dw_shard
+
+    # min(num_threads, N) shards, the same as in the forward pass
+    num_threads = conv_param.get('num_threads', CONV_NUM_THREADS)
+    dw = sum(_run_sharded(backward_shard, N, num_threads))
+    dw = dw.reshape(w.shape)
+    workspace.release(*[x_cols for _, _, x_cols in shards])
+
+    return dx, dw, db
+
+
+def conv_backward_im2col(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer
+    based on im2col and col2im.
+    """
+    x, w, b, conv_param, x_cols = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    num_filters, _, filter_height, filter_width = w.shape
+    dout_reshaped = dout.transpose(1, 2, 3, 0).reshape(num_filters, -1)
+    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+
+    dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
+    # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
+    dx = col2im_cython(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
+                       filter_height, filter_width, pad, stride)
+
+    return dx, dw, db
+
+
+def _winograd_transform(x, rows, n_out):
+    """
+    Applies a small transform matrix to the first two axes of x, computing
+    R x R^T where R is given row by row in rows as lists of (index, coeff)
+    pairs with coefficients in {1, -1, 0.5, -0.5}. The Winograd matrices are
+    this sparse, so elementwise adds into preallocated buffers are much cheaper
+    than stacking or a general tensordot.
+    """
+    def apply(src, dst, axis):
+        for r, terms in enumerate(rows):
+            o = dst[r] if axis == 0 else dst[:, r]
+            get = (lambda k: src[k]) if axis == 0 else (lambda k: src[:, k])
+            (k0, c0), rest = terms[0], terms[1:]
+            if c0 == 1:
+                o[...] = get(k0)
+            else:
+                np.multiply(get(k0), c0, out=o)
+            for k, c in rest:
+                if c == 1:
+                    o += get(k)
+                elif c == -1:
+                    o -= get(k)
+                else:
+                    o += c * get(k)
+
+    tmp = np.empty((n_out,) + x.shape[1:], dtype=x.dtype)
+    apply(x, tmp, 0)
+    out = np.empty((n_out, n_out) + x.shape[2:], dtype=x.dtype)
+    apply(tmp, out, 1)
+    return out
+
+
+# Rows of the F(2x2, 3x3) transform matrices B^T, G and A^T, and of their
+# transposes B, G^T and A used by the backward pass.
+_WINOGRAD_BT = [[(0, 1), (2, -1)], [(1, 1), (2, 1)], [(2, 1), (1, -1)],
+                [(1, 1), (3, -1)]]
+_WINOGRAD_B = [[(0, 1)], [(1, 1), (2, -1), (3, 1)], [(1, 1), (2, 1), (0, -1)],
+               [(3, -1)]]
+_WINOGRAD_G = [[(0, 1)], [(0, 0.5), (1, 0.5), (2, 0.5)],
+               [(0, 0.5), (1, -0.5), (2, 0.5)], [(2, 1)]]
+_WINOGRAD_GT = [[(0, 1), (1, 0.5), (2, 0.5)], [(1, 0.5), (2, -0.5)],
+                [(3, 1), (1, 0.5), (2, 0.5)]]
+_WINOGRAD_AT = [[(0, 1), (1, 1), (2, 1)], [(1, 1), (2, -1), (3, -1)]]
+_WINOGRAD_A = [[(0, 1)], [(0, 1), (1, 1)], [(0, 1), (1, -1)], [(1, -1)]]
+
+
+def conv_forward_winograd(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a 3x3, stride 1
+    convolutional layer using Winograd's minimal filtering algorithm F(2x2, 3x3).
+
+    The padded input is cut into overlapping 4x4 tiles, each of which produces
+    a 2x2 block of the output. After transforming tiles and filters into the
+    Winograd domain the convolution becomes 16 independent (F, C) x (C, P)
+    matrix multiplies, one per tile element, which needs 16 multiplies per
+    2x2 output block instead of the 36 of a direct or im2col convolution.
+    The transformed input is only 4x the size of x, rather than the 9x of the
+    im2col matrix.
+
+    Inputs / outputs: Same as conv_forward_strides; the cache is specific to
+    this function and must be passed to conv_backward_winograd.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    assert HH == WW == 3, 'Winograd convolution needs 3x3 filters'
+    assert stride == 1, 'Winograd convolution needs stride 1'
+
+    out_h = H + 2 * pad - 2
+    out_w = W + 2 * pad - 2
+    tiles_h = (out_h + 1) // 2
+    tiles_w = (out_w + 1) // 2
+
+    # Pad the input, adding an extra row / column of zeros if the output has
+    # odd size so that it is covered by a whole number of tiles.
+    p = pad
+    extra_h = 2 * tiles_h - out_h
+    extra_w = 2 * tiles_w - out_w
+    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p + extra_h), (p, p + extra_w)),
+                      mode='constant')
+
+    # Overlapping 4x4 tiles with a stride of 2, laid out as (4, 4, C, N, th, tw)
+    sN, sC, sH, sW = x_padded.strides
+    shape = (4, 4, C, N, tiles_h, tiles_w)
+    strides = (sH, sW, sC, sN, 2 * sH, 2 * sW)
+    tiles = np.lib.stride_tricks.as_strided(x_padded, shape=shape,
+                                            strides=strides)
+
+    V = _winograd_transform(tiles, _WINOGRAD_BT, 4).reshape(16, C, -1)
+    U = _winograd_transform(w.transpose(2, 3, 0, 1), _WINOGRAD_G, 4)
+    U = U.reshape(16, F, C)
+    M = np.matmul(U, V).reshape(4, 4, F, N, tiles_h, tiles_w)
+    Y = _winograd_transform(M, _WINOGRAD_AT, 2)
+
+    # Y has shape (2, 2, F, N, th, tw); interleave the 2x2 blocks into images
+    out = Y.transpose(3, 2, 4, 0, 5, 1).reshape(N, F, 2 * tiles_h, 2 * tiles_w)
+    out = out[:, :, :out_h, :out_w] + b.reshape(1, -1, 1, 1)
+    out = np.ascontiguousarray(out)
+
+    cache = (x, w, b, conv_param, V, U)
+    return out, cache
+
+
+def conv_backward_winograd(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer
+    computed with conv_forward_winograd.
+
+    Gradients are propagated through the Winograd transforms with their
+    adjoints, so the backward pass reuses the same 16 batched matrix multiplies
+    instead of building a col2im matrix.
+    """
+    x, w, b, conv_param, V, U = cache
+    pad = conv_param['pad']
+    N, C, H, W = x.shape
+    F = w.shape[0]
+    _, _, out_h, out_w = dout.shape
+    tiles_h = (out_h + 1) // 2
+    tiles_w = (out_w + 1) // 2
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    dout_padded = np.pad(dout, ((0, 0), (0, 0), (0, 2 * tiles_h - out_h),
+                                (0, 2 * tiles_w - out_w)), mode='constant')
+    dY = dout_padded.reshape(N, F, tiles_h, 2, tiles_w, 2)
+    dY = dY.transpose(3, 5, 1, 0, 2, 4)
+    dM = _winograd_transform(dY, _WINOGRAD_A, 4).reshape(16, F, -1)
+
+    dU = np.matmul(dM, V.transpose(0, 2, 1)).reshape(4, 4, F, C)
+    dw = _winograd_transform(dU, _WINOGRAD_GT, 3).transpose(2, 3, 0, 1)
+
+    dV = np.matmul(U.transpose(0, 2, 1), dM)
+    dV = dV.reshape(4, 4, C, N, tiles_h, tiles_w)
+    d_tiles = _winograd_transform(dV, _WINOGRAD_B, 4)
+
+    # Scatter the overlapping tiles back into the padded input
+    H_padded, W_padded = 2 * tiles_h + 2, 2 * tiles_w + 2
+    dx_padded = np.zeros((C, N, H_padded, W_padded), dtype=dout.dtype)
+    for i in range(4):
+        for j in range(4):
+            dx_padded[:, :, i:i + 2 * tiles_h:2, j:j + 2 * tiles_w:2] += \
+                d_tiles[i, j]
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W].transpose(1, 0, 2, 3)
+    dx = np.ascontiguousarray(dx)
+
+    return dx, dw, db
+
+
+def _fft_conv_geometry(x_shape, w_shape, conv_param):
+    """
+    Works out the stride 1 output size and the tiling used by the FFT
+    convolution. Returns (pad, full_h, full_w, tile_h, tile_w, tiles_h, tiles_w).
+    """
+    N, C, H, W = x_shape
+    F, _, HH, WW = w_shape
+    pad = conv_param['pad']
+    full_h = H + 2 * pad - HH + 1
+    full_w = W + 2 * pad - WW + 1
+    tile = conv_param.get('fft_tile', FFT_TILE_SIZE)
+    tile_h, tile_w = min(tile, full_h), min(tile, full_w)
+    tiles_h = -(-full_h // tile_h)
+    tiles_w = -(-full_w // tile_w)
+    return pad, full_h, full_w, tile_h, tile_w, tiles_h, tiles_w
+
+
+def _fft_batched_product(A, B, transpose_a=False, conj_b=False):
+    """
+    Multiplies two arrays of spectra, summing over a shared channel axis.
+
+    A has shape (P, Q, U, V) and B has shape (Q, R, U, V) (or, if transpose_a
+    is set, A has shape (Q, P, U, V)); the result has shape (P, R, U, V).
+    The channel sum is done as one batched matrix multiply over the U * V
+    frequencies.
+    """
+    if transpose_a:
+        A = A.transpose(1, 0, 2, 3)
+    P, Q, U, V = A.shape
+    R = B.shape[1]
+    A = A.transpose(2, 3, 0, 1).reshape(U * V, P, Q)
+    B = B.transpose(2, 3, 0, 1).reshape(U * V, Q, R)
+    if conj_b:
+        B = B.conj()
+    out = np.matmul(A, B).reshape(U, V, P, R)
+    return out.transpose(2, 3, 0, 1)
+
+
+def conv_forward_fft(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer based
+    on the FFT, which wins over im2col for large (5x5 and up) filters since its
+    cost does not grow with the filter area.
+
+    Each image and filter is transformed with a real 2D FFT, the products of
+    the spectra are summed over input channels with one batched matrix
+    multiply, and the result is transformed back. Large images are cut into
+    tiles of at most conv_param['fft_tile'] (default FFT_TILE_SIZE) outputs
+    per side; neighbouring input tiles overlap by the filter size minus one
+    (overlap-save), which keeps the FFTs small. Strides greater than one are
+    handled by subsampling the stride 1 output.
+
+    Inputs / outputs: Same as conv_forward_strides; the cache is specific to
+    this function and must be passed to conv_backward_fft.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride = conv_param['stride']
+    pad, full_h, full_w, tile_h, tile_w, tiles_h, tiles_w = \
+        _fft_conv_geometry(x.shape, w.shape, conv_param)
+
+    # Pad the input so that every tile is complete
+    extra_h = tiles_h * tile_h - full_h
+    extra_w = tiles_w * tile_w - full_w
+    x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad + extra_h),
+                          (pad, pad + extra_w)), mode='constant')
+
+    # Cross-correlation is a product with the conjugate filter spectrum; with
+    # an FFT size of tile + filter - 1 the first tile outputs do not wrap.
+    fft_shape = (tile_h + HH - 1, tile_w + WW - 1)
+    w_hat = np.fft.rfft2(w, s=fft_shape)
+
+    full = np.empty((N, F, tiles_h * tile_h, tiles_w * tile_w), dtype=x.dtype)
+    for th in range(tiles_h):
+        i = th * tile_h
+        for tw in range(tiles_w):
+            j = tw * tile_w
+            x_tile = x_padded[:, :, i:i + fft_shape[0], j:j + fft_shape[1]]
+            x_hat = np.fft.rfft2(x_tile)
+            out_hat = _fft_batched_product(x_hat, w_hat.transpose(1, 0, 2, 3),
+                                           conj_b=True)
+            out_tile = np.fft.irfft2(out_hat, s=fft_shape)
+            full[:, :, i:i + tile_h, j:j + tile_w] = \
+                out_tile[:, :, :tile_h, :tile_w]
+
+    out = full[:, :, :full_h:stride, :full_w:stride] + b.reshape(1, -1, 1, 1)
+    out = np.ascontiguousarray(out)
+
+    cache = (x, w, b, conv_param)
+    return out, cache
+
+
+def conv_backward_fft(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer
+    computed with conv_forward_fft.
+
+    The upstream gradient is processed in the same tiles as the forward pass:
+    the filter gradient of each tile is a correlation of the input tile with
+    the upstream gradient, and the input gradient of each tile is a full
+    convolution with the filters whose overlapping tiles are summed
+    (overlap-add).
+    """
+    x, w, b, conv_param = cache
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride = conv_param['stride']
+    pad, full_h, full_w, tile_h, tile_w, tiles_h, tiles_w = \
+        _fft_conv_geometry(x.shape, w.shape, conv_param)
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    # Scatter dout back onto the stride 1 output grid
+    dfull = np.zeros((N, F, tiles_h * tile_h, tiles_w * tile_w),
+                     dtype=dout.dtype)
+    dfull[:, :, :full_h:stride, :full_w:stride] = dout
+
+    extra_h = tiles_h * tile_h - full_h
+    extra_w = tiles_w * tile_w - full_w
+    x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad + extra_h),
+                          (pad, pad + extra_w)), mode='constant')
+
+    fft_shape = (tile_h + HH - 1, tile_w + WW - 1)
+    w_hat = np.fft.rfft2(w, s=fft_shape)
+
+    dw_hat = 0
+    dx_padded = np.zeros_like(x_padded)
+    for th in range(tiles_h):
+        i = th * tile_h
+        for tw in range(tiles_w):
+            j = tw * tile_w
+            x_tile = x_padded[:, :, i:i + fft_shape[0], j:j + fft_shape[1]]
+            x_hat = np.fft.rfft2(x_tile)
+            dout_hat = np.fft.rfft2(dfull[:, :, i:i + tile_h, j:j + tile_w],
+                                    s=fft_shape)
+            dw_hat = dw_hat + _fft_batched_product(dout_hat.conj(), x_hat,
+                                                   transpose_a=True)
+            dx_hat = _fft_batched_product(dout_hat, w_hat)
+            dx_padded[:, :, i:i + fft_shape[0], j:j + fft_shape[1]] += \
+                np.fft.irfft2(dx_hat, s=fft_shape)
+
+    # The conjugate products above give the correlation of each input tile
+    # with dout; the filter gradient is its first HH x WW lags.
+    dw = np.fft.irfft2(dw_hat, s=fft_shape)[:, :, :HH, :WW]
+    dw = np.ascontiguousarray(dw, dtype=w.dtype)
+    dx = np.ascontiguousarray(dx_padded[:, :, pad:pad + H, pad:pad + W])
+
+    return dx, dw, db
+
+
+def conv_forward_pointwise(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a 1x1 convolutional layer
+    without padding.
+
+    A 1x1 convolution is just a matrix multiply over channels, so each image
+    (subsampled if the stride is greater than one) is multiplied by the
+    (F, C) weight matrix directly. With stride 1 the input is used in place
+    and the result is already in (N, F, H, W) order, so nothing is copied.
+
+    Inputs / outputs: Same as conv_forward_strides; the cache is specific to
+    this function and must be passed to conv_backward_pointwise.
+    """
+    N, C, H, W = x.shape
+    F = w.shape[0]
+    stride, pad = conv_param['stride'], conv_param['pad']
+    assert w.shape[2:] == (1, 1), 'pointwise convolution needs 1x1 filters'
+    assert pad == 0, 'pointwise convolution does not support padding'
+
+    x_s = x[:, :, ::stride, ::stride]
+    out_h, out_w = x_s.shape[2:]
+    out = np.matmul(w.reshape(F, C), x_s.reshape(N, C, -1))
+    out = out.reshape(N, F, out_h, out_w)
+    out += b.reshape(1, -1, 1, 1)
+
+    cache = (x, w, b, conv_param)
+    return out, cache
+
+
+def conv_backward_pointwise(dout, cache):
+    """
+    A fast implementation of the backward pass for a 1x1 convolutional layer
+    computed with conv_forward_pointwise.
+    """
+    x, w, b, conv_param = cache
+    stride = conv_param['stride']
+    N, C, H, W = x.shape
+    F = w.shape[0]
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    x_s = x[:, :, ::stride, ::stride].reshape(N, C, -1)
+    dout_flat = dout.reshape(N, F, -1)
+    dw = np.tensordot(dout_flat, x_s, axes=([0, 2], [0, 2]))
+    dw = dw.reshape(w.shape)
+
+    dx_s = np.matmul(w.reshape(F, C).T, dout_flat)
+    if stride == 1:
+        dx = dx_s.reshape(x.shape)
+    else:
+        dx = np.zeros(x.shape, dtype=dx_s.dtype)
+        dx[:, :, ::stride, ::stride] = dx_s.reshape(N, C, *dout.shape[2:])
+
+    return dx, dw, db
+
+
+def _patchify_cols(x, HH, WW):
+    """
+    Reshapes x into non-overlapping HH x WW patches, returning an array of
+    shape (N, HH * WW * C, out_h * out_w) and the output size.
+    """
+    N, C, H, W = x.shape
+    out_h, out_w = H // HH, W // WW
+    x_patches = x[:, :, :out_h * HH, :out_w * WW]
+    x_patches = x_patches.reshape(N, C, out_h, HH, out_w, WW)
+    x_cols = np.ascontiguousarray(x_patches.transpose(0, 3, 5, 1, 2, 4))
+    x_cols.shape = (N, HH * WW * C, out_h * out_w)
+    return x_cols, out_h, out_w
+
+
+def conv_forward_patchify(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer whose
+    filters are as large as the stride, so that receptive fields do not
+    overlap (e.g. 2x2 filters with stride 2), and that has no padding.
+
+    Like max_pool_forward_reshape, this reshapes the input into
+    non-overlapping patches without padding or stride tricks, and multiplies
+    the patches of every image by the filters in one batched matmul whose
+    result is already in (N, F, H', W') order.
+
+    Inputs / outputs: Same as conv_forward_strides; the cache is specific to
+    this function and must be passed to conv_backward_patchify.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    assert HH == WW == stride, 'filter size must equal the stride'
+    assert pad == 0, 'patchify convolution does not support padding'
+
+    x_cols, out_h, out_w = _patchify_cols(x, HH, WW)
+    w_flat = w.transpose(0, 2, 3, 1).reshape(F, -1)
+    out = np.matmul(w_flat, x_cols).reshape(N, F, out_h, out_w)
+    out += b.reshape(1, -1, 1, 1)
+
+    cache = (x, w, b)
+    return out, cache
+
+
+def conv_backward_patchify(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer
+    computed with conv_forward_patchify.
+    """
+    x, w, b = cache
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    _, _, out_h, out_w = dout.shape
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    x_cols, _, _ = _patchify_cols(x, HH, WW)
+    dout_flat = dout.reshape(N, F, -1)
+    dw = np.tensordot(dout_flat, x_cols, axes=([0, 2], [0, 2]))
+    dw = dw.reshape(F, HH, WW, C).transpose(0, 3, 1, 2)
+
+    w_flat = w.transpose(0, 2, 3, 1).reshape(F, -1)
+    dx_cols = np.matmul(w_flat.T, dout_flat)
+    dx_patches = dx_cols.reshape(N, HH, WW, C, out_h, out_w)
+    dx_patches = dx_patches.transpose(0, 3, 4, 1, 5, 2)
+    if out_h * HH == H and out_w * WW == W:
+        dx = dx_patches.reshape(x.shape)
+    else:
+        dx = np.zeros(x.shape, dtype=dx_patches.dtype)
+        dx[:, :, :out_h * HH, :out_w * WW] = \
+            dx_patches.reshape(N, C, out_h * HH, out_w * WW)
+
+    return dx, dw, db
+
+
+def conv_forward_grouped(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a grouped convolutional
+    layer.
+
+    The C input channels and F filters are split into G groups, and the
+    filters of each group only see the C / G input channels of their group.
+    The im2col matrix is built once for the whole input and the G per-group
+    matrix multiplies are done as one batched np.matmul.
+
+    Input:
+    - x: Input data of shape (N, C, H, W)
+    - w: Filter weights of shape (F, C / G, HH, WW)
+    - b: Biases, of shape (F,)
+    - conv_param: A dictionary with the same keys as for conv_forward_naive,
+      plus:
+      - 'groups': The number of groups G, which must divide both C and F.
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, F, H', W')
+    - cache: Object to give to conv_backward_grouped
+    """
+    N, C, H, W = x.shape
+    F, C_g, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    G = conv_param['groups']
+    assert C % G == 0 and F % G == 0, 'groups must divide C and F'
+    assert C_g == C // G, 'w must have C / groups input channels'
+
+    x_cols, out_h, out_w = _strided_im2col(x, HH, WW, stride, pad)
+    x_cols_g = x_cols.reshape(G, C_g * HH * WW, -1)
+    w_g = w.reshape(G, F // G, -1)
+    res = np.matmul(w_g, x_cols_g).reshape(F, N, out_h, out_w)
+    out = res.transpose(1, 0, 2, 3) + b.reshape(1, -1, 1, 1)
+
+    cache = (x, w, b, conv_param, [x_cols])
+    return out, cache
+
+
+def conv_backward_grouped(dout, cache):
+    """
+    A fast implementation of the backward pass for a grouped convolutional
+    layer computed with conv_forward_grouped.
+
+    The im2col matrix from the cache is released to the workspace pool.
+    """
+    x, w, b, conv_param, x_cols_slot = cache
+    x_cols = _take_cached(x_cols_slot)
+    stride, pad = conv_param['stride'], conv_param['pad']
+    G = conv_param['groups']
+    N, C, H, W = x.shape
+    F, C_g, HH, WW = w.shape
+    _, _, out_h, out_w = dout.shape
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    dout_g = dout.transpose(1, 0, 2, 3).reshape(G, F // G, -1)
+    x_cols_g = x_cols.reshape(G, C_g * HH * WW, -1)
+    dw = np.matmul(dout_g, x_cols_g.transpose(0, 2, 1)).reshape(w.shape)
+
+    w_g = w.reshape(G, F // G, -1)
+    dx_cols = np.matmul(w_g.transpose(0, 2, 1), dout_g)
+    dx_cols.shape = (C, HH, WW, N, out_h, out_w)
+    dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+
+    workspace.release(x_cols)
+    return dx, dw, db
+
+
+def conv_forward_depthwise(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a depthwise convolutional
+    layer, i.e. a grouped convolution with one group per input channel.
+
+    With a single input channel per filter there is no channel sum for a
+    matrix multiply to exploit, so rather than building an im2col matrix this
+    multiplies strided windows of the padded input by each of the HH * WW
+    filter taps and accumulates the results directly.
+
+    Input:
+    - x: Input data of shape (N, C, H, W)
+    - w: Filter weights of shape (C * M, 1, HH, WW), where M is the channel
+      multiplier; filters c * M to c * M + M - 1 read input channel c.
+    - b: Biases, of shape (C * M,)
+    - conv_param: A dictionary with the same keys as for conv_forward_naive.
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, C * M, H', W')
+    - cache: Object to give to conv_backward_depthwise
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    assert F % C == 0, 'the number of filters must be a multiple of C'
+    M = F // C
+
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
+    x_padded = pad_into(x, pad, workspace)
+    w_taps = w.reshape(C, M, HH, WW)
+
+    out = np.zeros((N, C, M, out_h, out_w), dtype=np.result_type(x, w, b))
+    for i in range(HH):
+        for j in range(WW):
+            window = x_padded[:, :, i:i + stride * out_h:stride,
+                              j:j + stride * out_w:stride]
+            out += window[:, :, None] * w_taps[:, :, i, j, None, None]
+    workspace.release(x_padded)
+    out = out.reshape(N, F, out_h, out_w)
+    out += b.reshape(1, -1, 1, 1)
+
+    cache = (x, w, b, conv_param)
+    return out, cache
+
+
+def conv_backward_depthwise(dout, cache):
+    """
+    A fast implementation of the backward pass for a depthwise convolutional
+    layer computed with conv_forward_depthwise.
+    """
+    x, w, b, conv_param = cache
+    stride, pad = conv_param['stride'], conv_param['pad']
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    M = F // C
+    _, _, out_h, out_w = dout.shape
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    x_padded = pad_into(x, pad, workspace)
+    dx_padded = workspace.acquire_zeros(x_padded.shape,
+                                        np.result_type(dout, w))
+    dout_taps = dout.reshape(N, C, M, out_h, out_w)
+    w_taps = w.reshape(C, M, HH, WW)
+    dw = np.empty((C, M, HH, WW), dtype=np.result_type(dout, x))
+    for i in range(HH):
+        for j in range(WW):
+            rows = slice(i, i + stride * out_h, stride)
+            cols = slice(j, j + stride * out_w, stride)
+            window = x_padded[:, :, rows, cols]
+            dw[:, :, i, j] = np.einsum('ncmhw,nchw->cm', dout_taps, window)
+            dx_padded[:, :, rows, cols] += np.einsum(
+                'ncmhw,cm->nchw', dout_taps, w_taps[:, :, i, j])
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W].copy()
+    workspace.release(x_padded, dx_padded)
+    dw = dw.reshape(w.shape)
+
+    return dx, dw, db
+
+
+def _nhwc_im2col(x, field_height, field_width, stride, pad):
+    """
+    Builds the im2col matrix of a channels-last input for conv_forward_nhwc.
+
+    Returns a tuple of:
+    - x_cols: Array of shape (N * out_h * out_w, HH * WW * C), taken from the
+      workspace pool; the caller is responsible for releasing it.
+    - out_h, out_w: Output dimensions of the convolution
+    """
+    N, H, W, C = x.shape
+    HH, WW = field_height, field_width
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
+
+    x_padded = workspace.acquire_zeros((N, H + 2 * pad, W + 2 * pad, C),
+                                       x.dtype)
+    x_padded[:, pad:pad + H, pad:pad + W, :] = x
+
+    sN, sH, sW, sC = x_padded.strides
+    shape = (N, out_h, out_w, HH, WW, C)
+    strides = (sN, stride * sH, stride * sW, sH, sW, sC)
+    x_stride = np.lib.stride_tricks.as_strided(x_padded,
+                  shape=shape, strides=strides)
+    x_cols = workspace.acquire((N * out_h * out_w, HH * WW * C), x.dtype)
+    x_cols.reshape(shape)[...] = x_stride
+    workspace.release(x_padded)
+
+    return x_cols, out_h, out_w
+
+
+def _nhwc_gemm_backward(dout_flat, x_shape, w, conv_param, x_cols):
+    """
+    Backward pass shared by conv_backward_nhwc and the channels-last fused
+    conv-relu-pool layer, given the upstream derivatives of the GEMM result
+    as a (N * out_h * out_w, F) matrix. Releases x_cols to the workspace pool.
+    """
+    N, H, W, C = x_shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
+
+    db = np.sum(dout_flat, axis=0)
+    dw = matmul_mixed(x_cols.T, dout_flat).reshape(HH, WW, C, F)
+    dw = np.ascontiguousarray(dw.transpose(3, 2, 0, 1))
+
+    # Rather than building the whole dx im2col matrix and scattering it with
+    # C-element strides, multiply once per kernel offset and add the
+    # contiguous (N, H', W', C) result straight into the padded gradient.
+    w_taps = np.ascontiguousarray(w.transpose(2, 3, 0, 1))
+    dtype = np.result_type(dout_flat, w_taps)
+    dx_tap = workspace.acquire((N * out_h * out_w, C), dtype)
+    dx_padded = np.zeros((N, H + 2 * pad, W + 2 * pad, C), dtype=dtype)
+    for i in range(HH):
+        rows = slice(i, i + stride * out_h, stride)
+        for j in range(WW):
+            cols = slice(j, j + stride * out_w, stride)
+            matmul_mixed(dout_flat, w_taps[i, j], out=dx_tap)
+            dx_padded[:, rows, cols, :] += dx_tap.reshape(N, out_h, out_w, C)
+    dx = dx_padded[:, pad:pad + H, pad:pad + W, :].copy()
+
+    workspace.release(x_cols, dx_tap)
+    return dx, dw, db
+
+
+def conv_forward_nhwc(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer on
+    channels-last data.
+
+    The input has shape (N, H, W, C) and the output has shape
+    (N, H', W', F); the weights keep their usual (F, C, HH, WW) shape, so the
+    same parameters work in both layouts. With the patches of the input as
+    rows of the im2col matrix, the GEMM result is already the output in
+    channels-last order, so unlike the channels-first methods no transpose
+    of the output is needed.
+
+    Like conv_forward_strides, the im2col matrix is taken from the workspace
+    pool and released in the backward pass, so each cache can only be used
+    for a single backward pass; a second one raises a ValueError.
+    """
+    N, H, W, C = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    x_cols, out_h, out_w = _nhwc_im2col(x, HH, WW, stride, pad)
+
+    w_mat = w.transpose(2, 3, 1, 0).reshape(-1, F)
+    dtype = np.result_type(x_cols, w_mat)
+    out = np.empty((N * out_h * out_w, F), dtype=dtype)
+    matmul_mixed(x_cols, w_mat, out=out)
+    out += b.astype(dtype, copy=False)
+    out = out.reshape(N, out_h, out_w, F)
+
+    cache = (x.shape, w, conv_param, [x_cols])
+    return out, cache
+
+
+def conv_backward_nhwc(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer
+    computed with conv_forward_nhwc.
+    """
+    x_shape, w, conv_param, x_cols_slot = cache
+    x_cols = _take_cached(x_cols_slot)
+    F = w.shape[0]
+    return _nhwc_gemm_backward(dout.reshape(-1, F), x_shape, w, conv_param,
+                               x_cols)
+
+
+def conv_relu_pool_forward_fused(x, w, b, conv_param, pool_param):
+    """
+    A fused implementation of the forward pass for a convolution followed by
+    a ReLU and a max pool.
+
+    The convolution is computed like conv_forward_strides; the bias and the
+    ReLU are then applied in place on the (F, N * out_h * out_w) GEMM result,
+    which is max pooled directly in that layout. No full-size activation is
+    kept: the cache holds the im2col matrix, the compact argmax offsets of
+    the pool and a boolean mask of the positive pooled outputs. Since a
+    pooled output is positive exactly when its argmax element survived the
+    ReLU, this mask is all the ReLU backward pass needs.
+
+    Like conv_forward_strides, the im2col matrix is taken from the workspace
+    pool and released by conv_relu_pool_backward_fused, so each cache can
+    only be used for a single backward pass; a second one raises a
+    ValueError.
+
+    Inputs:
+    - x: Input data of shape (N, C, H, W)
+    - w, b, conv_param: Weights and parameters for the convolutional layer
+    - pool_param: Parameters for the pooling layer
+
+    Returns a tuple of:
+    - out: Output from the pooling layer
+    - cache: Object to give to conv_relu_pool_backward_fused
+    """
+    if conv_param.get('layout', 'NCHW') == 'NHWC':
+        return _conv_relu_pool_forward_nhwc(x, w, b, conv_param, pool_param)
+
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    x_cols, out_h, out_w = _strided_im2col(x, HH, WW, stride, pad)
+
+    w_flat = w.reshape(F, -1)
+    dtype = np.result_type(w_flat, x_cols)
+    a = workspace.acquire((F, N * out_h * out_w), dtype)
+    matmul_mixed(w_flat, x_cols, out=a)
+    a += b.astype(dtype, copy=False).reshape(-1, 1)
+    np.maximum(a, 0, out=a)
+
+    # The pooling layers only look at the last two axes, so the GEMM result
+    # can be pooled as (F, N, out_h, out_w) without transposing it first.
+    pooled, pool_cache = max_pool_forward_strided(
+        a.reshape(F, N, out_h, out_w), pool_param)
+    workspace.release(a)
+    _, _, argmax, _ = pool_cache
+    out = np.ascontiguousarray(pooled.transpose(1, 0, 2, 3))
+    positive = pooled > 0
+
+    cache = (x.shape, w, conv_param, [x_cols], argmax, positive, pool_param)
+    return out, cache
 
 
-def conv_forward_im2col(x, w, b, conv_param):
+def conv_relu_pool_backward_fused(dout, cache):
     """
-    A fast implementation of the forward pass for a convolutional layer
-    based on im2col and col2im.
+    A fused implementation of the backward pass for a convolution followed
+    by a ReLU and a max pool, computed with conv_relu_pool_forward_fused.
+
+    The im2col matrix from the cache is released to the workspace pool.
     """
-    N, C, H, W = x.shape
-    num_filters, _, filter_height, filter_width = w.shape
+    x_shape, w, conv_param, x_cols_slot, argmax, positive, pool_param = cache
+    if conv_param.get('layout', 'NCHW') == 'NHWC':
+        return _conv_relu_pool_backward_nhwc(dout, cache)
+    x_cols = _take_cached(x_cols_slot)
+
     stride, pad = conv_param['stride'], conv_param['pad']
+    N, C, H, W = x_shape
+    F, _, HH, WW = w.shape
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
 
-    # Check dimensions
-    assert (W + 2 * pad - filter_width) % stride == 0, 'width does not work'
-    assert (H + 2 * pad - filter_height) % stride == 0, 'height does not work'
+    # ReLU backward on the pooled outputs, then route each derivative to its
+    # argmax, giving the derivative of the GEMM result in (F, N, ...) layout.
+    dpooled = dout.transpose(1, 0, 2, 3) * positive
+    pool_cache = ((F, N, out_h, out_w), dpooled.dtype, argmax, pool_param)
+    da = max_pool_backward_strided(dpooled, pool_cache)
+    da = da.reshape(F, N * out_h * out_w)
 
-    # Create output
-    out_height = (H + 2 * pad - filter_height) // stride + 1
-    out_width = (W + 2 * pad - filter_width) // stride + 1
-    out = np.zeros((N, num_filters, out_height, out_width), dtype=x.dtype)
+    db = np.sum(da, axis=1)
+    dw = matmul_mixed(da, x_cols.T).reshape(w.shape)
 
-    # x_cols = im2col_indices(x, w.shape[2], w.shape[3], pad, stride)
-    x_cols = im2col_cython(x, w.shape[2], w.shape[3], pad, stride)
-    res = w.reshape((w.shape[0], -1)).dot(x_cols) + b.reshape(-1, 1)
+    w_flat = w.reshape(F, -1)
+    dx_cols = workspace.acquire((C * HH * WW, N * out_h * out_w),
+                                np.result_type(w_flat, da))
+    matmul_mixed(w_flat.T, da, out=dx_cols)
+    dx = col2im_6d_cython(dx_cols.reshape(C, HH, WW, N, out_h, out_w),
+                          N, C, H, W, HH, WW, pad, stride)
 
-    out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
-    out = out.transpose(3, 0, 1, 2)
+    workspace.release(x_cols, dx_cols)
+    return dx, dw, db
 
-    cache = (x, w, b, conv_param, x_cols)
+
+def _conv_relu_pool_forward_nhwc(x, w, b, conv_param, pool_param):
+    """
+    Channels-last version of conv_relu_pool_forward_fused. The GEMM result
+    is already (N, H', W', F), so it is pooled and returned as is.
+    """
+    N, H, W, C = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    x_cols, out_h, out_w = _nhwc_im2col(x, HH, WW, stride, pad)
+
+    w_mat = w.transpose(2, 3, 1, 0).reshape(-1, F)
+    dtype = np.result_type(x_cols, w_mat)
+    a = workspace.acquire((N * out_h * out_w, F), dtype)
+    matmul_mixed(x_cols, w_mat, out=a)
+    a += b.astype(dtype, copy=False)
+    np.maximum(a, 0, out=a)
+
+    out, pool_cache = max_pool_forward_nhwc(a.reshape(N, out_h, out_w, F),
+                                            pool_param)
+    workspace.release(a)
+    _, _, argmax, _ = pool_cache
+    positive = out > 0
+
+    cache = (x.shape, w, conv_param, [x_cols], argmax, positive, pool_param)
     return out, cache
 
 
-def conv_forward_strides(x, w, b, conv_param):
-    N, C, H, W = x.shape
+def _conv_relu_pool_backward_nhwc(dout, cache):
+    """
+    Channels-last version of conv_relu_pool_backward_fused.
+    """
+    x_shape, w, conv_param, x_cols_slot, argmax, positive, pool_param = cache
+    x_cols = _take_cached(x_cols_slot)
+    N, H, W, C = x_shape
     F, _, HH, WW = w.shape
     stride, pad = conv_param['stride'], conv_param['pad']
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
 
-    # Check dimensions
-    #assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
-    #assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+    dpooled = dout * positive
+    pool_cache = ((N, out_h, out_w, F), dpooled.dtype, argmax, pool_param)
+    da = max_pool_backward_nhwc(dpooled, pool_cache)
+    return _nhwc_gemm_backward(da.reshape(-1, F), x_shape, w, conv_param,
+                               x_cols)
 
-    # Pad the input
-    p = pad
-    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
 
-    # Figure out output dimensions
-    H += 2 * pad
-    W += 2 * pad
-    out_h = (H - HH) // stride + 1
-    out_w = (W - WW) // stride + 1
+# Default memory budget in bytes for the im2col matrix of a single tile in
+# conv_forward_tiled; conv_forward_fast switches to the tiled method for
+# layers whose whole im2col matrix would be larger than this.
+CONV_MAX_WORKSPACE_BYTES = 256 * 1024 * 1024
 
-    # Perform an im2col operation by picking clever strides
-    shape = (C, HH, WW, N, out_h, out_w)
-    strides = (H * W, W, 1, C * H * W, stride * W, stride)
-    strides = x.itemsize * np.array(strides)
-    x_stride = np.lib.stride_tricks.as_strided(x_padded,
-                  shape=shape, strides=strides)
-    x_cols = np.ascontiguousarray(x_stride)
-    x_cols.shape = (C * HH * WW, N * out_h * out_w)
+# Default number of worker threads used by conv_forward_threaded;
+# conv_forward_fast uses the threaded method instead of the strides method
+# when this (or conv_param['num_threads']) is greater than one.
+CONV_NUM_THREADS = 1
 
-    # Now all our convolutions are a big matrix multiply
-    res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
+# Largest number of outputs per side in a tile of the FFT convolution.
+FFT_TILE_SIZE = 32
 
-    # Reshape the output
-    res.shape = (F, N, out_h, out_w)
-    out = res.transpose(1, 0, 2, 3)
+# Smallest number of input channels for which conv_forward_fast prefers the
+# Winograd method over the strides method.
+WINOGRAD_MIN_CHANNELS = 32
 
-    # Be nice and return a contiguous array
-    # The old version of conv_forward_fast doesn't do this, so for a fair
-    # comparison we won't either
-    out = np.ascontiguousarray(out)
+# Smallest filter size and number of input channels for which
+# conv_forward_fast prefers the FFT method over the strides method.
+FFT_MIN_FILTER_SIZE = 5
+FFT_MIN_CHANNELS = 16
 
-    cache = (x, w, b, conv_param, x_cols)
+
+def _conv_method_heuristic(x, w, conv_param):
+    """
+    Picks a convolution method from the shapes alone; see conv_forward_fast.
+    """
+    _, C, HH, WW = w.shape
+    if _conv_pointwise_supported(x.shape, w.shape, conv_param):
+        return 'pointwise'
+    if _conv_patchify_supported(x.shape, w.shape, conv_param):
+        return 'patchify'
+    stride_1 = conv_param['stride'] == 1
+    if stride_1 and HH == WW == 3 and C >= WINOGRAD_MIN_CHANNELS:
+        return 'winograd'
+    if (stride_1 and min(HH, WW) >= FFT_MIN_FILTER_SIZE
+            and C >= FFT_MIN_CHANNELS):
+        return 'fft'
+    if _conv_tile_size(x, w, conv_param) < x.shape[0]:
+        return 'tiled'
+    if conv_param.get('num_threads', CONV_NUM_THREADS) > 1:
+        return 'threaded'
+    return 'strides'
+
+
+def conv_forward_fast(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer.
+
+    If autotuning has been turned on with enable_autotuning, this uses the
+    method that the autotuner measured to be fastest for this layer.
+
+    Otherwise, 1x1 convolutions without padding are done as a plain matrix
+    multiply over channels, and convolutions whose filters are as large as
+    the stride (and have no padding) with a reshape, as for max pooling.
+    Other layers use the Winograd method for 3x3 filters with stride 1,
+    which are the most common convolutions in our networks, the FFT method for
+    stride 1 filters of size FFT_MIN_FILTER_SIZE and up, and fall back on the
+    strides method for everything else. With only a few input channels the
+    transforms cost more than the multiplies they save, so layers with fewer
+    than WINOGRAD_MIN_CHANNELS (resp. FFT_MIN_CHANNELS) input channels also
+    use the strides method. If the im2col matrix of the strides method would
+    not fit in the memory budget (see conv_forward_tiled), the tiled method is
+    used instead; otherwise, if more than one thread is configured, the
+    threaded method is used in place of the strides method.
+
+    If conv_param['layout'] is 'NHWC', x and the output are channels-last
+    and the layer always uses conv_forward_nhwc.
+    """
+    method = select_conv_method(x, w, b, conv_param)
+    forward, _, _ = CONV_METHODS[method]
+    out, real_cache = forward(x, w, b, conv_param)
+    cache = (method, real_cache)
     return out, cache
 
 
-def conv_backward_strides(dout, cache):
-    x, w, b, conv_param, x_cols = cache
-    stride, pad = conv_param['stride'], conv_param['pad']
+def select_conv_method(x, w, b, conv_param):
+    """
+    Returns the name of the method in CONV_METHODS that conv_forward_fast
+    uses for this layer.
+    """
+    if conv_param.get('layout', 'NCHW') == 'NHWC':
+        return 'nhwc'
+    if _autotuner is not None:
+        return _autotuner.conv_method(x, w, b, conv_param)
+    return _conv_method_heuristic(x, w, conv_param)
 
-    N, C, H, W = x.shape
-    F, _, HH, WW = w.shape
-    _, _, out_h, out_w = dout.shape
 
-    db = np.sum(dout, axis=(0, 2, 3))
+def conv_backward_fast(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer.
 
-    dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
-    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+    This switches between the methods in CONV_METHODS depending on which
+    method was used to generate the cache.
+    """
+    method, real_cache = cache
+    if method not in CONV_METHODS:
+        raise ValueError('Unrecognized method "%s"' % method)
+    _, backward, _ = CONV_METHODS[method]
+    return backward(dout, real_cache)
 
-    dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
-    dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-    dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
 
-    return dx, dw, db
+def max_pool_forward_fast(x, pool_param):
+    """
+    A fast implementation of the forward pass for a max pooling layer.
 
+    If autotuning has been turned on with enable_autotuning, this uses the
+    method that the autotuner measured to be fastest for this layer.
 
-def conv_backward_im2col(dout, cache):
+    Otherwise this uses the strided method, which handles both tiling and
+    overlapping pooling regions, computes exact gradients and keeps only
+    compact argmax offsets in its cache. This includes the common 2x2 pools
+    with stride 2, for which it is faster than the reshape method: it needs
+    four elementwise maxima instead of two reductions over a 6D view, and its
+    backward pass scatters through the argmax offsets instead of comparing
+    the whole input against the broadcast output.
+
+    If pool_param['layout'] is 'NHWC', x and the output are channels-last
+    and the layer always uses max_pool_forward_nhwc.
     """
-    A fast implementation of the backward pass for a convolutional layer
-    based on im2col and col2im.
+    if pool_param.get('layout', 'NCHW') == 'NHWC':
+        method = 'nhwc'
+    elif _autotuner is not None:
+        method = _autotuner.pool_method(x, pool_param)
+    else:
+        method = 'strided'
+    forward, _, _ = POOL_METHODS[method]
+    out, real_cache = forward(x, pool_param)
+    cache = (method, real_cache)
+    return out, cache
+
+
+def max_pool_backward_fast(dout, cache):
     """
-    x, w, b, conv_param, x_cols = cache
-    stride, pad = conv_param['stride'], conv_param['pad']
+    A fast implementation of the backward pass for a max pooling layer.
 
-    db = np.sum(dout, axis=(0, 2, 3))
+    This switches between the methods in POOL_METHODS depending on which
+    method was used to generate the cache.
+    """
+    method, real_cache = cache
+    if method not in POOL_METHODS:
+        raise ValueError('Unrecognized method "%s"' % method)
+    _, backward, _ = POOL_METHODS[method]
+    return backward(dout, real_cache)
 
-    num_filters, _, filter_height, filter_width = w.shape
-    dout_reshaped = dout.transpose(1, 2, 3, 0).reshape(num_filters, -1)
-    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
-    dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
-    # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
-    dx = col2im_cython(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
-                       filter_height, filter_width, pad, stride)
+def avg_pool_forward_fast(x, pool_param):
+    """
+    A fast implementation of the forward pass for an average pooling layer.
 
-    return dx, dw, db
+    This uses the reshape method when the pooling regions tile the input and
+    the strided method otherwise.
+    """
+    method = 'reshape' if _pool_reshape_supported(x.shape, pool_param) \
+        else 'strided'
+    forward, _, _ = AVG_POOL_METHODS[method]
+    out, real_cache = forward(x, pool_param)
+    cache = (method, real_cache)
+    return out, cache
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+def avg_pool_backward_fast(dout, cache):
+    """
+    A fast implementation of the backward pass for an average pooling layer.
+
+    This switches between the methods in AVG_POOL_METHODS depending on which
+    method was used to generate the cache.
+    """
+    method, real_cache = cache
+    if method not in AVG_POOL_METHODS:
+        raise ValueError('Unrecognized method "%s"' % method)
+    _, backward, _ = AVG_POOL_METHODS[method]
+    return backward(dout, real_cache)
 
 
-def max_pool_forward_fast(x, pool_param):
+def _pool_taps(pool_param, out_height, out_width):
     """
-    A fast implementation of the forward pass for a max pooling layer.
+    Yields (k, rows, cols) for each of the pool_height * pool_width offsets k
+    inside a pooling window, where x[:, :, rows, cols] selects the input
+    element at that offset in every window.
+    """
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+    for i in range(pool_height):
+        rows = slice(i, i + stride * (out_height - 1) + 1, stride)
+        for j in range(pool_width):
+            cols = slice(j, j + stride * (out_width - 1) + 1, stride)
+            yield i * pool_width + j, rows, cols
+
+
+def max_pool_forward_strided(x, pool_param):
+    """
+    A fast implementation of the forward pass for a max pooling layer that
+    works for any pooling parameters, including overlapping windows such as
+    3x3 pools with stride 2.
 
-    This chooses between the reshape method and the im2col method. If the pooling
-    regions are square and tile the input image, then we can use the reshape
-    method which is very fast. Otherwise we fall back on the im2col method, which
-    is not much faster than the naive method.
+    This loops over the pool_height * pool_width offsets inside a window,
+    comparing a strided slice of the input holding that offset for every
+    window against the running maximum. Besides the output, the only thing
+    kept for the backward pass is the offset of the (first) maximum in each
+    window, stored as a small unsigned integer (uint8 for windows of up to
+    256 elements), so the cache is a fraction of the size of the input.
     """
     N, C, H, W = x.shape
     pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
     stride = pool_param['stride']
+    out_height = (H - pool_height) // stride + 1
+    out_width = (W - pool_width) // stride + 1
 
-    same_size = pool_height == pool_width == stride
-    tiles = H % pool_height == 0 and W % pool_width == 0
-    if same_size and tiles:
-        out, reshape_cache = max_pool_forward_reshape(x, pool_param)
-        cache = ('reshape', reshape_cache)
-    else:
-        out, im2col_cache = max_pool_forward_im2col(x, pool_param)
-        cache = ('im2col', im2col_cache)
+    argmax = np.zeros((N, C, out_height, out_width),
+                      dtype=np.min_scalar_type(pool_height * pool_width - 1))
+    out = None
+    for k, rows, cols in _pool_taps(pool_param, out_height, out_width):
+        window = x[:, :, rows, cols]
+        if out is None:
+            out = window.copy()
+            continue
+        # Strict comparison keeps the first maximum in row-major window
+        # order, so ties get a single argmax.
+        better = window > out
+        argmax[better] = k
+        np.maximum(out, window, out=out)
+
+    cache = (x.shape, x.dtype, argmax, pool_param)
     return out, cache
 
 
-def max_pool_backward_fast(dout, cache):
+def max_pool_backward_strided(dout, cache):
     """
-    A fast implementation of the backward pass for a max pooling layer.
+    A fast implementation of the backward pass for a max pooling layer
+    computed with max_pool_forward_strided.
 
-    This switches between the reshape method an the im2col method depending on
-    which method was used to generate the cache.
+    Each upstream derivative is routed to exactly one input element, the
+    first maximum of its window, so the gradient is exact even with ties.
     """
-    method, real_cache = cache
-    if method == 'reshape':
-        return max_pool_backward_reshape(dout, real_cache)
-    elif method == 'im2col':
-        return max_pool_backward_im2col(dout, real_cache)
-    else:
-        raise ValueError('Unrecognized method "%s"' % method)
+    x_shape, x_dtype, argmax, pool_param = cache
+    _, _, out_height, out_width = dout.shape
+
+    dx = np.zeros(x_shape, dtype=np.result_type(dout, x_dtype))
+    for k, rows, cols in _pool_taps(pool_param, out_height, out_width):
+        dx[:, :, rows, cols] += np.where(argmax == k, dout, 0)
+
+    return dx
+
+
+def max_pool_forward_nhwc(x, pool_param):
+    """
+    The channels-last version of max_pool_forward_strided: x has shape
+    (N, H, W, C) and the output has shape (N, H', W', C).
+    """
+    N, H, W, C = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+    out_height = (H - pool_height) // stride + 1
+    out_width = (W - pool_width) // stride + 1
+
+    argmax = np.zeros((N, out_height, out_width, C),
+                      dtype=np.min_scalar_type(pool_height * pool_width - 1))
+    out = None
+    for k, rows, cols in _pool_taps(pool_param, out_height, out_width):
+        window = x[:, rows, cols, :]
+        if out is None:
+            out = window.copy()
+            continue
+        better = window > out
+        argmax[better] = k
+        np.maximum(out, window, out=out)
+
+    cache = (x.shape, x.dtype, argmax, pool_param)
+    return out, cache
+
+
+def max_pool_backward_nhwc(dout, cache):
+    """
+    The channels-last version of max_pool_backward_strided.
+    """
+    x_shape, x_dtype, argmax, pool_param = cache
+    _, out_height, out_width, _ = dout.shape
+
+    dx = np.zeros(x_shape, dtype=np.result_type(dout, x_dtype))
+    for k, rows, cols in _pool_taps(pool_param, out_height, out_width):
+        dx[:, rows, cols, :] += np.where(argmax == k, dout, 0)
+
+    return dx
 
 
 def max_pool_forward_reshape(x, pool_param):
@@ -240,7 +1598,7 @@ def max_pool_forward_im2col(x, pool_param):
     out_width = (W - pool_width) // stride + 1
 
     x_split = x.reshape(N * C, 1, H, W)
-    x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+    x_cols = im2col_cython(x_split, pool_height, pool_width, 0, stride)
     x_cols_argmax = np.argmax(x_cols, axis=0)
     x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
     out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
@@ -262,10 +1620,309 @@ def max_pool_backward_im2col(dout, cache):
     stride = pool_param['stride']
 
     dout_reshaped = dout.transpose(2, 3, 0, 1).flatten()
-    dx_cols = np.zeros_like(x_cols)
+    dx_cols = workspace.acquire_zeros(x_cols.shape, x_cols.dtype)
     dx_cols[x_cols_argmax, np.arange(dx_cols.shape[1])] = dout_reshaped
-    dx = col2im_indices(dx_cols, (N * C, 1, H, W), pool_height, pool_width,
-                padding=0, stride=stride)
+    dx = col2im_cython(dx_cols, N * C, 1, H, W, pool_height, pool_width, 0,
+                       stride)
     dx = dx.reshape(x.shape)
+    workspace.release(dx_cols)
+
+    return dx
+
+
+def avg_pool_forward_reshape(x, pool_param):
+    """
+    A fast implementation of the forward pass for the average pooling layer
+    that uses the same reshaping trick as max_pool_forward_reshape.
+
+    This can only be used for square pooling regions that tile the input.
+    """
+    N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+    assert pool_height == pool_width == stride, 'Invalid pool params'
+    assert H % pool_height == 0
+    assert W % pool_height == 0
+    x_reshaped = x.reshape(N, C, H // pool_height, pool_height,
+                           W // pool_width, pool_width)
+    out = x_reshaped.mean(axis=(3, 5))
+
+    # Averaging needs nothing from x in the backward pass.
+    cache = (x.shape, pool_param)
+    return out, cache
+
+
+def avg_pool_backward_reshape(dout, cache):
+    """
+    A fast implementation of the backward pass for the average pooling layer.
+
+    This can only be used if the forward pass was computed using
+    avg_pool_forward_reshape.
+    """
+    x_shape, pool_param = cache
+    N, C, H, W = x_shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+
+    dx_reshaped = np.empty((N, C, H // pool_height, pool_height,
+                            W // pool_width, pool_width), dtype=dout.dtype)
+    dx_reshaped[...] = (dout / (pool_height * pool_width))[
+        :, :, :, np.newaxis, :, np.newaxis]
+    dx = dx_reshaped.reshape(x_shape)
+
+    return dx
+
+
+def avg_pool_forward_strided(x, pool_param):
+    """
+    A fast implementation of the forward pass for an average pooling layer
+    that works for any pooling parameters, including overlapping windows.
+
+    Like max_pool_forward_strided, this loops over the offsets inside a
+    window and accumulates a strided slice of the input for each of them.
+    """
+    N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+    out_height = (H - pool_height) // stride + 1
+    out_width = (W - pool_width) // stride + 1
+
+    out = np.zeros((N, C, out_height, out_width), dtype=x.dtype)
+    for _, rows, cols in _pool_taps(pool_param, out_height, out_width):
+        out += x[:, :, rows, cols]
+    out /= pool_height * pool_width
+
+    cache = (x.shape, pool_param)
+    return out, cache
+
+
+def avg_pool_backward_strided(dout, cache):
+    """
+    A fast implementation of the backward pass for an average pooling layer
+    computed with avg_pool_forward_strided.
+    """
+    x_shape, pool_param = cache
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    _, _, out_height, out_width = dout.shape
+
+    dout_scaled = dout / (pool_height * pool_width)
+    dx = np.zeros(x_shape, dtype=dout_scaled.dtype)
+    for _, rows, cols in _pool_taps(pool_param, out_height, out_width):
+        dx[:, :, rows, cols] += dout_scaled
 
     return dx
+
+
+def _conv_im2col_supported(x_shape, w_shape, conv_param):
+    _, _, H, W = x_shape
+    _, _, HH, WW = w_shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    return ((H + 2 * pad - HH) % stride == 0 and
+            (W + 2 * pad - WW) % stride == 0)
+
+
+def _conv_winograd_supported(x_shape, w_shape, conv_param):
+    return w_shape[2] == w_shape[3] == 3 and conv_param['stride'] == 1
+
+
+def _conv_pointwise_supported(x_shape, w_shape, conv_param):
+    return w_shape[2] == w_shape[3] == 1 and conv_param['pad'] == 0
+
+
+def _conv_patchify_supported(x_shape, w_shape, conv_param):
+    return (w_shape[2] == w_shape[3] == conv_param['stride'] and
+            conv_param['pad'] == 0)
+
+
+def _conv_nhwc_supported(x_shape, w_shape, conv_param):
+    return conv_param.get('layout', 'NCHW') == 'NHWC'
+
+
+def _pool_reshape_supported(x_shape, pool_param):
+    _, _, H, W = x_shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    return (pool_height == pool_width == pool_param['stride'] and
+            H % pool_height == 0 and W % pool_width == 0)
+
+
+def _pool_im2col_supported(x_shape, pool_param):
+    _, _, H, W = x_shape
+    stride = pool_param['stride']
+    return ((H - pool_param['pool_height']) % stride == 0 and
+            (W - pool_param['pool_width']) % stride == 0)
+
+
+def _pool_nhwc_supported(x_shape, pool_param):
+    return pool_param.get('layout', 'NCHW') == 'NHWC'
+
+
+# The methods that conv_forward_fast, max_pool_forward_fast and
+# avg_pool_forward_fast can dispatch to. Each entry maps the name stored in
+# the cache to a tuple of (forward, backward, supported), where
+# supported(x_shape, w_shape, conv_param) (resp. supported(x_shape,
+# pool_param)) says whether the method can handle a layer.
+CONV_METHODS = {
+    'strides': (conv_forward_strides, conv_backward_strides,
+                lambda x_shape, w_shape, conv_param: True),
+    'im2col': (conv_forward_im2col, conv_backward_im2col,
+               _conv_im2col_supported),
+    'winograd': (conv_forward_winograd, conv_backward_winograd,
+                 _conv_winograd_supported),
+    'fft': (conv_forward_fft, conv_backward_fft,
+            lambda x_shape, w_shape, conv_param: True),
+    'tiled': (conv_forward_tiled, conv_backward_tiled,
+              lambda x_shape, w_shape, conv_param: True),
+    'threaded': (conv_forward_threaded, conv_backward_threaded,
+                 lambda x_shape, w_shape, conv_param: True),
+    'pointwise': (conv_forward_pointwise, conv_backward_pointwise,
+                  _conv_pointwise_supported),
+    'patchify': (conv_forward_patchify, conv_backward_patchify,
+                 _conv_patchify_supported),
+    'nhwc': (conv_forward_nhwc, conv_backward_nhwc, _conv_nhwc_supported),
+}
+
+# The convolution methods that build the im2col matrix of the whole
+# minibatch; the autotuner only times them when it fits in the memory budget.
+_CONV_FULL_IM2COL_METHODS = ('strides', 'im2col', 'threaded')
+
+POOL_METHODS = {
+    'strided': (max_pool_forward_strided, max_pool_backward_strided,
+                lambda x_shape, pool_param: True),
+    'reshape': (max_pool_forward_reshape, max_pool_backward_reshape,
+                _pool_reshape_supported),
+    'im2col': (max_pool_forward_im2col, max_pool_backward_im2col,
+               _pool_im2col_supported),
+    'nhwc': (max_pool_forward_nhwc, max_pool_backward_nhwc,
+             _pool_nhwc_supported),
+}
+
+
+AVG_POOL_METHODS = {
+    'strided': (avg_pool_forward_strided, avg_pool_backward_strided,
+                lambda x_shape, pool_param: True),
+    'reshape': (avg_pool_forward_reshape, avg_pool_backward_reshape,
+                _pool_reshape_supported),
+}
+
+
+class Autotuner(object):
+    """
+    An Autotuner picks the fastest convolution and max pooling method for each
+    layer it sees.
+
+    The first time conv_forward_fast or max_pool_forward_fast is called with a
+    new combination of input shape, dtype and layer parameters, the autotuner
+    times a forward and backward pass of every method in CONV_METHODS (resp.
+    POOL_METHODS) that supports the layer and remembers the winner; later
+    calls with the same key dispatch straight to it. If a cache file is given,
+    the winners are stored there as JSON so that they survive across runs.
+    Convolution methods that would build an im2col matrix larger than the
+    memory budget of conv_forward_tiled are not timed.
+
+    Don't use this class directly; call enable_autotuning instead.
+    """
+
+    def __init__(self, cache_file=None, num_repeats=3):
+        """
+        Inputs:
+        - cache_file: Path of a JSON file used to persist the timing results,
+          or None to keep them in memory only.
+        - num_repeats: Number of timed forward / backward passes per method;
+          the fastest of them is used, after one untimed warm-up pass.
+        """
+        self.cache_file = cache_file
+        self.num_repeats = num_repeats
+        self.best_methods = {}
+        if cache_file is not None and os.path.isfile(cache_file):
+            with open(cache_file, 'r') as f:
+                self.best_methods = json.load(f)
+
+    def conv_method(self, x, w, b, conv_param):
+        """
+        Returns the name of the fastest method in CONV_METHODS for this layer.
+        """
+        params = sorted((k, v) for k, v in conv_param.items()
+                        if isinstance(v, (int, float)))
+        key = 'conv %s %s %s %s' % (x.shape, w.shape, x.dtype, params)
+
+        def run(method):
+            forward, backward, _ = CONV_METHODS[method]
+            out, cache = forward(x, w, b, conv_param)
+            backward(out, cache)
+
+        fits = _conv_tile_size(x, w, conv_param) >= x.shape[0]
+        candidates = [name for name, (_, _, supported) in CONV_METHODS.items()
+                      if supported(x.shape, w.shape, conv_param) and
+                      (fits or name not in _CONV_FULL_IM2COL_METHODS)]
+        return self._best_method(key, candidates, run)
+
+    def pool_method(self, x, pool_param):
+        """
+        Returns the name of the fastest method in POOL_METHODS for this layer.
+        """
+        params = sorted(pool_param.items())
+        key = 'pool %s %s %s' % (x.shape, x.dtype, params)
+
+        def run(method):
+            forward, backward, _ = POOL_METHODS[method]
+            out, cache = forward(x, pool_param)
+            backward(out, cache)
+
+        candidates = [name for name, (_, _, supported) in POOL_METHODS.items()
+                      if supported(x.shape, pool_param)]
+        return self._best_method(key, candidates, run)
+
+    def _best_method(self, key, candidates, run):
+        method = self.best_methods.get(key)
+        if method in candidates:
+            return method
+
+        best_time = None
+        for name in sorted(candidates):
+            run(name)
+            elapsed = None
+            for _ in range(self.num_repeats):
+                start = timer()
+                run(name)
+                t = timer() - start
+                elapsed = t if elapsed is None else min(elapsed, t)
+            if best_time is None or elapsed < best_time:
+                method, best_time = name, elapsed
+
+        self.best_methods[key] = method
+        self._save()
+        return method
+
+    def _save(self):
+        if self.cache_file is None:
+            return
+        with open(self.cache_file, 'w') as f:
+            json.dump(self.best_methods, f, indent=2, sort_keys=True)
+
+
+_autotuner = None
+
+
+def enable_autotuning(cache_file=None, num_repeats=3):
+    """
+    Makes conv_forward_fast and max_pool_forward_fast (and so all of the
+    layer_utils sandwiches) pick the fastest method for each layer shape by
+    timing them; see Autotuner.
+
+    Inputs:
+    - cache_file: Optional path of a JSON file in which timing results are
+      stored, so that later runs do not need to time the same layers again.
+    - num_repeats: Number of timed passes per method.
+
+    Returns the Autotuner.
+    """
+    global _autotuner
+    _autotuner = Autotuner(cache_file, num_repeats)
+    return _autotuner
+
+
+def disable_autotuning():
+    """
+    Goes back to choosing convolution and pooling methods by fixed rules.
+    """
+    global _autotuner
+    _autotuner = None
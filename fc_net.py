@@ -23,7 +23,7 @@ class TwoLayerNet(object):
     """
 
     def __init__(self, input_dim=3*32*32, hidden_dim=100, num_classes=10,
-                 weight_scale=1e-3, reg=0.0):
+                 weight_scale=1e-3, reg=0.0, dtype=np.float64):
         """
         Initialize a new network.
 
@@ -34,9 +34,16 @@ class TwoLayerNet(object):
         - weight_scale: Scalar giving the standard deviation for random
           initialization of the weights.
         - reg: Scalar giving L2 regularization strength.
+        - dtype: A numpy datatype object; all computations will be performed
+          using this datatype. float16 stores weights and activations in half
+          precision for mixed-precision training with the Solver.
         """
         self.params = {}
         self.reg = reg
+        self.dtype = dtype
+        # Factor by which the gradients are scaled; set by the Solver for
+        # mixed-precision training so that they do not underflow in float16.
+        self.loss_scale = 1.0
 
         ############################################################################
         # TODO: Initialize the weights and biases of the two-layer net. Weights    #
@@ -60,6 +67,9 @@ class TwoLayerNet(object):
         #                             END OF YOUR CODE                             #
         ############################################################################
 
+        for k, v in self.params.items():
+            self.params[k] = v.astype(dtype)
+
 
     def loss(self, X, y=None):
         """
@@ -86,6 +96,8 @@ class TwoLayerNet(object):
         # class scores for X and storing them in the scores variable.              #
         ############################################################################
         
+        X = X.astype(self.dtype, copy=False)
+
         # Unpack variables from the params dictionary
         W1, b1 = self.params['W1'], self.params['b1']
         W2, b2 = self.params['W2'], self.params['b2']
@@ -121,14 +133,15 @@ class TwoLayerNet(object):
         reg_loss = 0.5 * self.reg * np.sum(W1**2)
         reg_loss += 0.5 * self.reg * np.sum(W2**2)
         loss = data_loss + reg_loss
+        dscores = (dscores * self.loss_scale).astype(self.dtype, copy=False)
 
         # Backprop into second layer
         dx1, dW2, db2 = affine_backward(dscores, cache_scores)
-        dW2 += self.reg * W2
+        dW2 += self.loss_scale * self.reg * W2
 
         # Backprop into first layer
         dx, dW1, db1 = affine_relu_backward(dx1, cache_hidden_layer)
-        dW1 += self.reg * W1
+        dW1 += self.loss_scale * self.reg * W1
     
         # assign gradient class
         grads['W2'] = dW2
@@ -161,7 +174,8 @@ class FullyConnectedNet(object):
 
     def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                  dropout=1, normalization=None, reg=0.0,
-                 weight_scale=1e-2, dtype=np.float32, seed=None):
+                 weight_scale=1e-2, dtype=np.float32, seed=None,
+                 inplace=False):
         """
         Initialize a new FullyConnectedNet.
 
@@ -178,12 +192,21 @@ class FullyConnectedNet(object):
           initialization of the weights.
         - dtype: A numpy datatype object; all computations will be performed using
           this datatype. float32 is faster but less accurate, so you should use
-          float64 for numeric gradient checking.
+          float64 for numeric gradient checking. float16 stores weights and
+          activations in half precision for mixed-precision training with the
+          Solver.
         - seed: If not None, then pass this random seed to the dropout layers. This
           will make the dropout layers deteriminstic so we can gradient check the
           model.
+        - inplace: If True, the ReLU and dropout layers overwrite their inputs
+          (and upstream gradients) and cache packed bit masks, so that the
+          activations of a deep network are not stored twice.
         """
         self.normalization = normalization
+        self.inplace = inplace
+        # Factor by which the gradients are scaled; set by the Solver for
+        # mixed-precision training so that they do not underflow in float16.
+        self.loss_scale = 1.0
         self.use_dropout = dropout != 1
         self.reg = reg
         self.num_layers = 1 + len(hidden_dims)
@@ -225,12 +248,16 @@ class FullyConnectedNet(object):
 
         # When using dropout we need to pass a dropout_param dictionary to each
         # dropout layer so that the layer knows the dropout probability and the mode
-        # (train / test). You can pass the same dropout_param to each dropout layer.
-        self.dropout_param = {}
+        # (train / test). Each layer gets its own dropout_param, and with it its
+        # own random stream, so that layers of the same size draw different masks.
+        self.dropout_params = []
         if self.use_dropout:
-            self.dropout_param = {'mode': 'train', 'p': dropout}
+            self.dropout_params = [{'mode': 'train', 'p': dropout,
+                                    'inplace': inplace, 'stream': i}
+                                   for i in range(self.num_layers - 1)]
             if seed is not None:
-                self.dropout_param['seed'] = seed
+                for dropout_param in self.dropout_params:
+                    dropout_param['seed'] = seed
 
         # With batch normalization we need to keep track of running means and
         # variances, so we need to pass a special bn_param object to each batch
@@ -261,7 +288,8 @@ class FullyConnectedNet(object):
         # Set train/test mode for batchnorm params and dropout param since they
         # behave differently during training and testing.
         if self.use_dropout:
-            self.dropout_param['mode'] = mode
+            for dropout_param in self.dropout_params:
+                dropout_param['mode'] = mode
         if self.normalization=='batchnorm':
             for bn_param in self.bn_params:
                 bn_param['mode'] = mode
@@ -270,8 +298,8 @@ class FullyConnectedNet(object):
         # TODO: Implement the forward pass for the fully-connected net, computing  #
         # the class scores for X and storing them in the scores variable.          #
         #                                                                          #
-        # When using dropout, you'll need to pass self.dropout_param to each       #
-        # dropout forward pass.                                                    #
+        # When using dropout, you'll need to pass self.dropout_params[0] to the    #
+        # first dropout forward pass, self.dropout_params[1] to the second, etc.   #
         #                                                                          #
         # When using batch normalization, you'll need to pass self.bn_params[0] to #
         # the forward pass for the first batch normalization layer, pass           #
@@ -290,37 +318,37 @@ class FullyConnectedNet(object):
         for i in range(1, self.num_layers):
             
             if self.normalization == None:
-                current_input, affine_relu_cache[i] = affine_relu_forward(current_input, 
-                                                                          self.params['W'+str(i)], 
-                                                                          self.params['b'+str(i)])
+                fc_out, fc_cache = affine_layer_forward(current_input, self.params, i)
+                current_input, relu_cache = relu_forward(fc_out, self.inplace)
+                affine_relu_cache[i] = (fc_cache, relu_cache)
             elif self.normalization == 'batchnorm':  
                 # affine -> batch norm -> relu
-                fc_out, fc_cache = affine_forward(current_input, self.params['W'+str(i)], self.params['b'+str(i)])
-                bn_out, bn_cache = batchnorm_forward(fc_out, \
-                                                     self.params['gamma'+str(i)], \
-                                                     self.params['beta'+str(i)], \
-                                                     self.bn_params[i-1])
-                current_input, relu_cache = relu_forward(bn_out)
+                fc_out, fc_cache = affine_layer_forward(current_input, self.params, i)
+                bn_out, bn_cache = batchnorm_forward_fused(fc_out, \
+                                                           self.params['gamma'+str(i)], \
+                                                           self.params['beta'+str(i)], \
+                                                           self.bn_params[i-1])
+                current_input, relu_cache = relu_forward(bn_out, self.inplace)
                 caches[i] = (fc_cache, bn_cache, relu_cache)
                 
             elif self.normalization == 'layernorm':
                 # affine -> layer norm -> relu
-                fc_out, fc_cache = affine_forward(current_input, self.params['W'+str(i)], self.params['b'+str(i)])
+                fc_out, fc_cache = affine_layer_forward(current_input, self.params, i)
                 ln_out, ln_cache = layernorm_forward(fc_out, \
                                                      self.params['gamma'+str(i)], \
                                                      self.params['beta'+str(i)], \
                                                      self.ln_params[i-1])
-                current_input, relu_cache = relu_forward(ln_out)
+                current_input, relu_cache = relu_forward(ln_out, self.inplace)
                 caches[i] = (fc_cache, ln_cache, relu_cache)
                 
             if self.use_dropout:
-                current_input, dropout_cache[i] = dropout_forward(current_input, self.dropout_param)  
+                current_input, dropout_cache[i] = dropout_forward(current_input, self.dropout_params[i-1])
     
     
-        # Last affine layer
-        affine_out, affine_cache = affine_forward(current_input, 
-                                                  self.params['W'+str(self.num_layers)], 
-                                                  self.params['b'+str(self.num_layers)])
+        # Last affine layer; the affine layers may have been factorized by
+        # low-rank compression, so their weights are looked up by layer.
+        affine_out, affine_cache = affine_layer_forward(current_input, self.params,
+                                                        self.num_layers)
         scores = affine_out        
         
         ############################################################################
@@ -349,13 +377,11 @@ class FullyConnectedNet(object):
         # caluculate loss
         loss, dscores = softmax_loss(scores, y)
         
-        # add reg for loss
-        loss += 0.5 * self.reg*(np.sum(self.params['W'+str(self.num_layers)]**2))
+        dscores = (dscores * self.loss_scale).astype(self.dtype, copy=False)
 
         # calculate gradient of last layer
-        affine_dx, affine_dw, affine_db = affine_backward(dscores, affine_cache)
-        grads['W'+str(self.num_layers)] = affine_dw + self.reg * self.params['W'+str(self.num_layers)]
-        grads['b'+str(self.num_layers)] = affine_db
+        affine_dx, layer_grads = affine_layer_backward(dscores, affine_cache)
+        grads.update(layer_grads)
 
         # calculate gradient of each layer (except last layer)
         for i in range(self.num_layers-1,0,-1):
@@ -363,7 +389,9 @@ class FullyConnectedNet(object):
                 affine_dx = dropout_backward(affine_dx, dropout_cache[i])
     
             if self.normalization == None:       
-                affine_dx, affine_dw, affine_db = affine_relu_backward(affine_dx, affine_relu_cache[i])
+                fc_cache, relu_cache = affine_relu_cache[i]
+                da = relu_backward(affine_dx, relu_cache)
+                affine_dx, layer_grads = affine_layer_backward(da, fc_cache)
     
             else:
                 # Dropout backward except the last layer (before relu backward)
@@ -371,21 +399,23 @@ class FullyConnectedNet(object):
                     # drelu -> dbatchnorm -> daffine
                     fc_cache, bn_cache, relu_cache = caches[i]
                     dbn_out = relu_backward(affine_dx, relu_cache)
-                    dfc_out, grads['gamma'+str(i)], grads['beta'+str(i)] = batchnorm_backward(dbn_out, bn_cache)
-                    affine_dx, affine_dw, affine_db = affine_backward(dfc_out, fc_cache)
+                    dfc_out, grads['gamma'+str(i)], grads['beta'+str(i)] = batchnorm_backward_fused(dbn_out, bn_cache)
+                    affine_dx, layer_grads = affine_layer_backward(dfc_out, fc_cache)
                     
                 if self.normalization == 'layernorm':
                     # drelu -> dlayernorm -> daffine
                     fc_cache, ln_cache, relu_cache = caches[i]
                     dln_out = relu_backward(affine_dx, relu_cache)
                     dfc_out, grads['gamma'+str(i)], grads['beta'+str(i)] = layernorm_backward(dln_out, ln_cache)
-                    affine_dx, affine_dw, affine_db = affine_backward(dfc_out, fc_cache)
+                    affine_dx, layer_grads = affine_layer_backward(dfc_out, fc_cache)
             
-            grads['W'+str(i)] = affine_dw + self.reg * self.params['W'+str(i)]
-            grads['b'+str(i)] = affine_db
-            
-            # add reg for loss
-            loss += 0.5 * self.reg*(np.sum(self.params['W'+str(i)]**2)) 
+            grads.update(layer_grads)
+
+        # add reg for loss and gradients of the (possibly factorized) weights
+        for i in range(1, self.num_layers + 1):
+            for k in weight_names(self.params, i):
+                loss += 0.5 * self.reg * np.sum(self.params[k]**2)
+                grads[k] += self.loss_scale * self.reg * self.params[k]
         
         ############################################################################
         #                             END OF YOUR CODE                             #
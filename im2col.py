@@ -1,14 +1,37 @@
 from builtins import range
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2 has no lru_cache; index tables are then rebuilt on every call.
+    def lru_cache(maxsize=None):
+        return lambda f: f
 import numpy as np
 
 
 def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
+    """
+    Returns the (k, i, j) index arrays such that x_padded[:, k, i, j] gathers
+    the im2col matrix of an input of shape x_shape.
+
+    The index arrays do not depend on the batch size, so they are computed
+    once per (C, H, W, field size, padding, stride) and cached; they are
+    read-only.
+    """
+    _, C, H, W = x_shape
+    return _im2col_index_table(C, H, W, field_height, field_width, padding,
+                               stride)
+
+
+@lru_cache(maxsize=16)
+def _im2col_index_table(C, H, W, field_height, field_width, padding, stride):
+    """
+    Builds the per-image index arrays for get_im2col_indices.
+    """
     # First figure out what the size of the output should be
-    N, C, H, W = x_shape
     assert (H + 2 * padding - field_height) % stride == 0
-    assert (W + 2 * padding - field_height) % stride == 0
-    out_height = (H + 2 * padding - field_height) / stride + 1
-    out_width = (W + 2 * padding - field_width) / stride + 1
+    assert (W + 2 * padding - field_width) % stride == 0
+    out_height = (H + 2 * padding - field_height) // stride + 1
+    out_width = (W + 2 * padding - field_width) // stride + 1
 
     i0 = np.repeat(np.arange(field_height), field_width)
     i0 = np.tile(i0, C)
@@ -20,6 +43,8 @@ def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
 
     k = np.repeat(np.arange(C), field_height * field_width).reshape(-1, 1)
 
+    for a in (k, i, j):
+        a.flags.writeable = False
     return (k, i, j)
 
 
@@ -40,17 +65,96 @@ def im2col_indices(x, field_height, field_width, padding=1, stride=1):
 
 def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
                    stride=1):
-    """ An implementation of col2im based on fancy indexing and np.add.at """
+    """
+    An implementation of col2im for the matrices built by im2col_indices.
+
+    Their columns are ordered (out position, image) like those of
+    im2col_strided, so the contributions are summed the same way, one kernel
+    offset at a time, in the dtype of cols (np.add.at does the same
+    element by element but is many times slower).
+    """
     N, C, H, W = x_shape
+    return col2im_strided(cols, N, C, H, W, field_height, field_width,
+                          padding, stride)
+
+
+def _strided_windows(x_padded, field_height, field_width, stride, out_height,
+                     out_width):
+    """
+    Returns a read-only 6D view of shape (C, field_height, field_width,
+    out_height, out_width, N) over a padded (N, C, H, W) input, built with
+    stride tricks so that no data is copied.
+    """
+    N, C, H, W = x_padded.shape
+    sN, sC, sH, sW = x_padded.strides
+    shape = (C, field_height, field_width, out_height, out_width, N)
+    strides = (sC, sH, sW, stride * sH, stride * sW, sN)
+    return np.lib.stride_tricks.as_strided(x_padded, shape=shape,
+                                           strides=strides, writeable=False)
+
+
+def im2col_strided(x, field_height, field_width, padding=1, stride=1):
+    """
+    A pure-numpy drop-in replacement for im2col_cython.
+
+    Returns an array of shape (C * field_height * field_width,
+    out_height * out_width * N), laid out exactly like im2col_cython.
+    """
+    N, C, H, W = x.shape
+    out_height = (H + 2 * padding - field_height) // stride + 1
+    out_width = (W + 2 * padding - field_width) // stride + 1
+
+    p = padding
+    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+    windows = _strided_windows(x_padded, field_height, field_width, stride,
+                               out_height, out_width)
+    cols = np.ascontiguousarray(windows)
+    cols.shape = (C * field_height * field_width, -1)
+    return cols
+
+
+def col2im_strided(cols, N, C, H, W, field_height, field_width, padding,
+                   stride):
+    """
+    A pure-numpy drop-in replacement for col2im_cython.
+
+    Rather than scattering every element with np.add.at, this loops over the
+    field_height * field_width kernel offsets and accumulates a whole strided
+    slice of the padded image at once, so the Python overhead is independent
+    of the input size.
+    """
+    out_height = (H + 2 * padding - field_height) // stride + 1
+    out_width = (W + 2 * padding - field_width) // stride + 1
     H_padded, W_padded = H + 2 * padding, W + 2 * padding
-    x_padded = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
-    k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
-                                 stride)
-    cols_reshaped = cols.reshape(C * field_height * field_width, -1, N)
-    cols_reshaped = cols_reshaped.transpose(2, 0, 1)
-    np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
-    if padding == 0:
-        return x_padded
-    return x_padded[:, :, padding:-padding, padding:-padding]
-
-pass
+
+    cols = cols.reshape(C, field_height, field_width, out_height, out_width, N)
+    x_padded = np.zeros((C, H_padded, W_padded, N), dtype=cols.dtype)
+    for ii in range(field_height):
+        i_end = ii + stride * out_height
+        for jj in range(field_width):
+            j_end = jj + stride * out_width
+            x_padded[:, ii:i_end:stride, jj:j_end:stride, :] += cols[:, ii, jj]
+
+    x = x_padded[:, padding:padding + H, padding:padding + W, :]
+    return np.ascontiguousarray(x.transpose(3, 0, 1, 2))
+
+
+def col2im_6d_strided(cols, N, C, H, W, HH, WW, pad, stride):
+    """
+    A pure-numpy drop-in replacement for col2im_6d_cython.
+
+    cols has shape (C, HH, WW, N, out_h, out_w), as produced by the backward
+    pass of conv_forward_strides; the result has shape (N, C, H, W).
+    """
+    _, _, _, _, out_h, out_w = cols.shape
+    H_padded, W_padded = H + 2 * pad, W + 2 * pad
+
+    x_padded = np.zeros((C, N, H_padded, W_padded), dtype=cols.dtype)
+    for ii in range(HH):
+        i_end = ii + stride * out_h
+        for jj in range(WW):
+            j_end = jj + stride * out_w
+            x_padded[:, :, ii:i_end:stride, jj:j_end:stride] += cols[:, ii, jj]
+
+    x = x_padded[:, :, pad:pad + H, pad:pad + W]
+    return np.ascontiguousarray(x.transpose(1, 0, 2, 3))
@@ -3,20 +3,22 @@ from cs231n.layers import *
 from cs231n.fast_layers import *
 
 
-def affine_relu_forward(x, w, b):
+def affine_relu_forward(x, w, b, inplace=False):
     """
     Convenience layer that perorms an affine transform followed by a ReLU
 
     Inputs:
     - x: Input to the affine layer
     - w, b: Weights for the affine layer
+    - inplace: If True, apply the ReLU in place on the affine output and
+      cache a packed mask; the backward pass then overwrites dout.
 
     Returns a tuple of:
     - out: Output from the ReLU
     - cache: Object to give to the backward pass
     """
     a, fc_cache = affine_forward(x, w, b)
-    out, relu_cache = relu_forward(a)
+    out, relu_cache = relu_forward(a, inplace)
     cache = (fc_cache, relu_cache)
     return out, cache
 
@@ -31,6 +33,52 @@ def affine_relu_backward(dout, cache):
     return dx, dw, db
 
 
+def affine_layer_forward(x, params, i):
+    """
+    Forward pass for the i-th affine layer of a model. Its weight is either
+    params['W%d' % i], or, once the model has been compressed with
+    compression.compress_model, the factors params['U%d' % i] and
+    params['V%d' % i]; its bias is params['b%d' % i].
+
+    Returns a tuple of:
+    - out: Output from the affine layer
+    - cache: Object to give to the backward pass
+    """
+    names = weight_names(params, i) + ('b%d' % i,)
+    if len(names) == 2:
+        out, cache = affine_forward(x, params[names[0]], params[names[1]])
+    else:
+        out, cache = factorized_affine_forward(x, *[params[k] for k in names])
+    return out, (names, cache)
+
+
+def affine_layer_backward(dout, cache):
+    """
+    Backward pass for affine_layer_forward.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x
+    - grads: Dictionary mapping the names of the parameters of the layer to
+      their gradients
+    """
+    names, cache = cache
+    if len(names) == 2:
+        dx, dw, db = affine_backward(dout, cache)
+        return dx, {names[0]: dw, names[1]: db}
+    dx, du, dv, db = factorized_affine_backward(dout, cache)
+    return dx, dict(zip(names, (du, dv, db)))
+
+
+def weight_names(params, i):
+    """
+    Names of the weights of the i-th affine layer of a model: ('W%d',) or,
+    for a factorized layer, ('U%d', 'V%d').
+    """
+    if 'W%d' % i in params:
+        return ('W%d' % i,)
+    return ('U%d' % i, 'V%d' % i)
+
+
 def conv_relu_forward(x, w, b, conv_param):
     """
     A convenience layer that performs a convolution followed by a ReLU.
@@ -61,7 +109,10 @@ def conv_relu_backward(dout, cache):
 
 def conv_bn_relu_forward(x, w, b, gamma, beta, conv_param, bn_param):
     a, conv_cache = conv_forward_fast(x, w, b, conv_param)
-    an, bn_cache = spatial_batchnorm_forward(a, gamma, beta, bn_param)
+    # The batch norm works in whatever layout the convolution produces, over
+    # every axis but the channels (as spatial_batchnorm_forward does)
+    axis = 3 if conv_param.get('layout', 'NCHW') == 'NHWC' else 1
+    an, bn_cache = batchnorm_forward_fused(a, gamma, beta, bn_param, axis)
     out, relu_cache = relu_forward(an)
     cache = (conv_cache, bn_cache, relu_cache)
     return out, cache
@@ -79,6 +130,14 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
     """
     Convenience layer that performs a convolution, a ReLU, and a pool.
 
+    When conv_forward_fast would use the strides method (or the NHWC method
+    for channels-last inputs), this runs the fused kernel
+    conv_relu_pool_forward_fused instead, which never stores the full-size
+    convolution or ReLU outputs. Otherwise, when the autotuner or the shapes
+    pick another method, or the im2col matrix would not fit in the memory
+    budget, it chains conv_relu_forward and max_pool_forward_fast. The layout
+    of x and out is given by conv_param['layout'].
+
     Inputs:
     - x: Input to the convolutional layer
     - w, b, conv_param: Weights and parameters for the convolutional layer
@@ -88,10 +147,13 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
     - out: Output from the pooling layer
     - cache: Object to give to the backward pass
     """
-    a, conv_cache = conv_forward_fast(x, w, b, conv_param)
-    s, relu_cache = relu_forward(a)
+    if select_conv_method(x, w, b, conv_param) in ('strides', 'nhwc'):
+        out, fused_cache = conv_relu_pool_forward_fused(x, w, b, conv_param,
+                                                        pool_param)
+        return out, (True, fused_cache)
+    s, conv_cache = conv_relu_forward(x, w, b, conv_param)
     out, pool_cache = max_pool_forward_fast(s, pool_param)
-    cache = (conv_cache, relu_cache, pool_cache)
+    cache = (False, (conv_cache, pool_cache))
     return out, cache
 
 
@@ -99,8 +161,89 @@ def conv_relu_pool_backward(dout, cache):
     """
     Backward pass for the conv-relu-pool convenience layer
     """
-    conv_cache, relu_cache, pool_cache = cache
+    fused, real_cache = cache
+    if fused:
+        return conv_relu_pool_backward_fused(dout, real_cache)
+    conv_cache, pool_cache = real_cache
     ds = max_pool_backward_fast(dout, pool_cache)
-    da = relu_backward(ds, relu_cache)
-    dx, dw, db = conv_backward_fast(da, conv_cache)
-    return dx, dw, db
+    return conv_relu_backward(ds, conv_cache)
+
+
+def depthwise_separable_forward(x, w_dw, b_dw, w_pw, b_pw, conv_param):
+    """
+    Convenience layer for a MobileNet-style depthwise separable convolution:
+    a depthwise convolution, a ReLU, a 1x1 pointwise convolution and a ReLU.
+
+    Inputs:
+    - x: Input to the depthwise convolutional layer, of shape (N, C, H, W)
+    - w_dw, b_dw: Weights of shape (C * M, 1, HH, WW) and biases of shape
+      (C * M,) for the depthwise layer
+    - w_pw, b_pw: Weights of shape (F, C * M, 1, 1) and biases of shape (F,)
+      for the pointwise layer
+    - conv_param: Stride and padding of the depthwise layer; the pointwise
+      layer always uses stride 1 and no padding.
+
+    Returns a tuple of:
+    - out: Output from the second ReLU
+    - cache: Object to give to the backward pass
+    """
+    a, dw_cache = conv_forward_depthwise(x, w_dw, b_dw, conv_param)
+    s, dw_relu_cache = relu_forward(a)
+    pw_conv_param = {'stride': 1, 'pad': 0}
+    out, pw_cache = conv_relu_forward(s, w_pw, b_pw, pw_conv_param)
+    cache = (dw_cache, dw_relu_cache, pw_cache)
+    return out, cache
+
+
+def depthwise_separable_backward(dout, cache):
+    """
+    Backward pass for the depthwise separable convenience layer.
+
+    Returns a tuple of (dx, dw_dw, db_dw, dw_pw, db_pw).
+    """
+    dw_cache, dw_relu_cache, pw_cache = cache
+    ds, dw_pw, db_pw = conv_relu_backward(dout, pw_cache)
+    da = relu_backward(ds, dw_relu_cache)
+    dx, dw_dw, db_dw = conv_backward_depthwise(da, dw_cache)
+    return dx, dw_dw, db_dw, dw_pw, db_pw
+
+
+def depthwise_separable_bn_forward(x, w_dw, b_dw, gamma_dw, beta_dw,
+                                   w_pw, b_pw, gamma_pw, beta_pw,
+                                   conv_param, bn_param_dw, bn_param_pw):
+    """
+    Convenience layer for a depthwise separable convolution with spatial
+    batch normalization after each convolution, as in MobileNet:
+    depthwise conv - bn - relu - 1x1 conv - bn - relu.
+
+    Inputs are as for depthwise_separable_forward, plus the scale and shift
+    parameters and bn_param dictionaries of the two batch normalization
+    layers.
+    """
+    a, dw_cache = conv_forward_depthwise(x, w_dw, b_dw, conv_param)
+    an, dw_bn_cache = spatial_batchnorm_forward(a, gamma_dw, beta_dw,
+                                                bn_param_dw)
+    s, dw_relu_cache = relu_forward(an)
+    pw_conv_param = {'stride': 1, 'pad': 0}
+    out, pw_cache = conv_bn_relu_forward(s, w_pw, b_pw, gamma_pw, beta_pw,
+                                         pw_conv_param, bn_param_pw)
+    cache = (dw_cache, dw_bn_cache, dw_relu_cache, pw_cache)
+    return out, cache
+
+
+def depthwise_separable_bn_backward(dout, cache):
+    """
+    Backward pass for the depthwise separable convenience layer with batch
+    normalization.
+
+    Returns a tuple of (dx, dw_dw, db_dw, dgamma_dw, dbeta_dw, dw_pw, db_pw,
+    dgamma_pw, dbeta_pw).
+    """
+    dw_cache, dw_bn_cache, dw_relu_cache, pw_cache = cache
+    ds, dw_pw, db_pw, dgamma_pw, dbeta_pw = conv_bn_relu_backward(dout,
+                                                                  pw_cache)
+    dan = relu_backward(ds, dw_relu_cache)
+    da, dgamma_dw, dbeta_dw = spatial_batchnorm_backward(dan, dw_bn_cache)
+    dx, dw_dw, db_dw = conv_backward_depthwise(da, dw_cache)
+    return dx, dw_dw, db_dw, dgamma_dw, dbeta_dw, dw_pw, db_pw, dgamma_pw, \
+        dbeta_pw
@@ -1,5 +1,55 @@
 from builtins import range
 import numpy as np
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    # scipy is only needed for sparse (pruned) affine weights.
+    sparse = None
+
+
+def matmul_mixed(a, b, out=None):
+    """
+    Matrix product for mixed-precision training.
+
+    numpy has no float16 BLAS, and its float16 matrix product is both very
+    slow and accumulated in float16. If either operand is float16, this
+    instead multiplies float32 copies of the operands and rounds the result
+    to np.result_type(a, b) (or to the dtype of out); otherwise it is np.dot.
+
+    Inputs:
+    - a, b: Arrays to multiply, as for np.dot
+    - out: Optional C-contiguous array in which to store the result
+
+    Returns the product.
+    """
+    if a.dtype != np.float16 and b.dtype != np.float16:
+        return np.dot(a, b, out=out)
+    product = np.dot(a.astype(np.float32), b.astype(np.float32))
+    if out is None:
+        return product.astype(np.result_type(a, b), copy=False)
+    out[...] = product
+    return out
+
+
+def _accumulation_dtype(dtype):
+    """
+    The dtype in which to accumulate sums of arrays of the given dtype, which
+    is at least float32.
+    """
+    return np.result_type(dtype, np.float32)
+
+
+# Largest fraction of nonzero weights for which sparse_affine_backward
+# computes the weight gradient only on the sparsity pattern. Above it, a dense
+# BLAS product sampled on the pattern is faster than gathering the inputs for
+# every nonzero: on CIFAR-sized affine layers the two break even at about
+# 1.5% density, and at the 80-95% sparsities of gradual pruning the gathers
+# are 3-20x slower than the dense product.
+SPARSE_GRAD_MAX_DENSITY = 0.01
+
+
+def _is_sparse(w):
+    return sparse is not None and sparse.issparse(w)
 
 
 def affine_forward(x, w, b):
@@ -13,13 +63,16 @@ def affine_forward(x, w, b):
 
     Inputs:
     - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
-    - w: A numpy array of weights, of shape (D, M)
+    - w: A numpy array of weights, of shape (D, M), or a scipy.sparse CSR
+      matrix, in which case sparse_affine_forward is used
     - b: A numpy array of biases, of shape (M,)
 
     Returns a tuple of:
     - out: output, of shape (N, M)
     - cache: (x, w, b)
     """
+    if _is_sparse(w):
+        return sparse_affine_forward(x, w, b)
     out = None
     ###########################################################################
     # TODO: Implement the affine forward pass. Store the result in out. You   #
@@ -29,8 +82,13 @@ def affine_forward(x, w, b):
     # reshape input x to N*D
     x_reshape = x.reshape(x.shape[0], -1)
     
-    # output = x_reshape*w + b
-    out = np.dot(x_reshape, w) + b
+    # output = x_reshape*w + b, adding the bias in place when that does not
+    # change the result type
+    out = matmul_mixed(x_reshape, w)
+    if np.can_cast(b.dtype, out.dtype):
+        out += b
+    else:
+        out = out + b
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -56,6 +114,8 @@ def affine_backward(dout, cache):
     - db: Gradient with respect to b, of shape (M,)
     """
     x, w, b = cache
+    if _is_sparse(w):
+        return sparse_affine_backward(dout, cache)
     dx, dw, db = None, None, None
     ###########################################################################
     # TODO: Implement the affine backward pass.                               #
@@ -73,14 +133,15 @@ def affine_backward(dout, cache):
     # db    
 
     # dx = dout*w_t, remember to modify the shape
-    dx = dout.dot(w.T).reshape(x.shape)
+    dx = matmul_mixed(dout, w.T).reshape(x.shape)
     
     # dw = x_t*dout
     x_temp = x.reshape(x.shape[0],-1)
-    dw = x_temp.T.dot(dout)
+    dw = matmul_mixed(x_temp.T, dout)
     
     # db = sum along the row of dout
-    db = np.sum(dout, axis = 0)
+    db = np.sum(dout, axis = 0, dtype=_accumulation_dtype(dout.dtype))
+    db = db.astype(dout.dtype, copy=False)
     
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -88,22 +149,146 @@ def affine_backward(dout, cache):
     return dx, dw, db
 
 
-def relu_forward(x):
+def sparse_affine_forward(x, w, b):
+    """
+    Computes the forward pass for an affine layer whose weights are a sparse
+    matrix, such as a magnitude-pruned weight (see pruning.py). The cost of
+    the matrix product is proportional to the number of nonzero weights.
+
+    Inputs:
+    - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
+    - w: A scipy.sparse CSR matrix of weights, of shape (D, M)
+    - b: A numpy array of biases, of shape (M,)
+
+    Returns a tuple of:
+    - out: output, of shape (N, M)
+    - cache: (x, w, b)
+    """
+    x_reshape = x.reshape(x.shape[0], -1)
+    # x * w = (w^T * x^T)^T, where w^T is a CSC view of w
+    out = np.asarray(w.T.dot(x_reshape.T)).T + b
+    cache = (x, w, b)
+    return out, cache
+
+
+def sparse_affine_backward(dout, cache):
+    """
+    Computes the backward pass for an affine layer with sparse weights.
+
+    The gradient with respect to w is only returned for the stored entries
+    of w, so that the sparsity pattern is fixed during training: the
+    gradient of entry (i, j) is x[:, i] . dout[:, j]. If at most a fraction
+    SPARSE_GRAD_MAX_DENSITY of w is stored, only these dot products are
+    computed; otherwise they are read off the dense gradient, which is
+    faster at moderate sparsity. Either way the pruned entries get no
+    gradient.
+
+    Inputs:
+    - dout: Upstream derivative, of shape (N, M)
+    - cache: Tuple of (x, w, b) as for affine_backward, with w a CSR matrix
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
+    - dw: Gradient with respect to w, a CSR matrix with the same sparsity
+      pattern as w
+    - db: Gradient with respect to b, of shape (M,)
+    """
+    x, w, b = cache
+    x_reshape = x.reshape(x.shape[0], -1)
+    dx = np.asarray(w.dot(dout.T)).T.reshape(x.shape)
+
+    rows = np.repeat(np.arange(w.shape[0]), np.diff(w.indptr))
+    if w.nnz > SPARSE_GRAD_MAX_DENSITY * w.shape[0] * w.shape[1]:
+        dw_data = matmul_mixed(x_reshape.T, dout)[rows, w.indices]
+    else:
+        # Dot products of the rows of x^T and dout^T selected by the pattern,
+        # in blocks of nonzeros to bound the size of the gathered rows.
+        x_t = np.ascontiguousarray(x_reshape.T)
+        dout_t = np.ascontiguousarray(dout.T)
+        dw_data = np.empty(w.nnz, dtype=np.result_type(x, dout))
+        block = max(1, 2 ** 20 // max(x.shape[0], 1))
+        for start in range(0, w.nnz, block):
+            end = start + block
+            np.einsum('kn,kn->k', x_t[rows[start:end]],
+                      dout_t[w.indices[start:end]], out=dw_data[start:end])
+    dw = w.__class__((dw_data, w.indices, w.indptr), shape=w.shape)
+
+    db = np.sum(dout, axis=0)
+    return dx, dw, db
+
+
+def factorized_affine_forward(x, u, v, b):
+    """
+    Computes the forward pass for an affine layer whose (D, M) weight matrix
+    is factorized as the product u * v of rank R, such as a weight compressed
+    with a truncated SVD (see compression.py). The layer is computed as two
+    thin matrix products, which costs N * R * (D + M) instead of N * D * M.
+
+    Inputs:
+    - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
+    - u: A numpy array of shape (D, R)
+    - v: A numpy array of shape (R, M)
+    - b: A numpy array of biases, of shape (M,)
+
+    Returns a tuple of:
+    - out: output, of shape (N, M)
+    - cache: (x, u, v, h), where h = x * u is the rank R projection of x
+    """
+    h = matmul_mixed(x.reshape(x.shape[0], -1), u)
+    out = matmul_mixed(h, v)
+    out += b
+    cache = (x, u, v, h)
+    return out, cache
+
+
+def factorized_affine_backward(dout, cache):
+    """
+    Computes the backward pass for a factorized affine layer.
+
+    Inputs:
+    - dout: Upstream derivative, of shape (N, M)
+    - cache: Tuple of (x, u, v, h) from factorized_affine_forward
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
+    - du: Gradient with respect to u, of shape (D, R)
+    - dv: Gradient with respect to v, of shape (R, M)
+    - db: Gradient with respect to b, of shape (M,)
+    """
+    x, u, v, h = cache
+    dv = matmul_mixed(h.T, dout)
+    dh = matmul_mixed(dout, v.T)
+    du = matmul_mixed(x.reshape(x.shape[0], -1).T, dh)
+    dx = matmul_mixed(dh, u.T).reshape(x.shape)
+    db = np.sum(dout, axis=0, dtype=_accumulation_dtype(dout.dtype))
+    db = db.astype(dout.dtype, copy=False)
+    return dx, du, dv, db
+
+
+def relu_forward(x, inplace=False):
     """
     Computes the forward pass for a layer of rectified linear units (ReLUs).
 
     Input:
     - x: Inputs, of any shape
+    - inplace: If True, overwrite x with the output and cache a packed bit
+      mask of the positive inputs instead of x itself, so that the layer
+      allocates no full-size float arrays. The caller must own x.
 
     Returns a tuple of:
     - out: Output, of the same shape as x
-    - cache: x
+    - cache: x, or a packed mask if inplace is True
     """
     out = None
     ###########################################################################
     # TODO: Implement the ReLU forward pass.                                  #
     ###########################################################################
     
+    if inplace:
+        out = np.maximum(x, 0, out=x)
+        cache = _pack_mask(out > 0)
+        return out, cache
+
     out = np.copy(x)
     out[out<0] = 0
     
@@ -120,7 +305,8 @@ def relu_backward(dout, cache):
 
     Input:
     - dout: Upstream derivatives, of any shape
-    - cache: Input x, of same shape as dout
+    - cache: Input x, of same shape as dout, or the packed mask cached by an
+      in-place forward pass; in that case dout is overwritten with dx.
 
     Returns:
     - dx: Gradient with respect to x
@@ -130,6 +316,10 @@ def relu_backward(dout, cache):
     # TODO: Implement the ReLU backward pass.                                 #
     ###########################################################################
     
+    if isinstance(cache, tuple):
+        dx = np.multiply(dout, _unpack_mask(cache), out=dout)
+        return dx
+
     dx = np.copy(dout)
     dx[x<0] = 0
     
@@ -139,6 +329,23 @@ def relu_backward(dout, cache):
     return dx
 
 
+def _pack_mask(mask):
+    """
+    Packs a boolean array into bits, for caches that would otherwise hold a
+    full-size array just to remember where it was nonzero.
+    """
+    return (np.packbits(mask, axis=None), mask.shape)
+
+
+def _unpack_mask(packed):
+    """
+    Inverse of _pack_mask; returns a boolean array.
+    """
+    bits, shape = packed
+    count = int(np.prod(shape))
+    return np.unpackbits(bits, count=count).view(np.bool_).reshape(shape)
+
+
 def batchnorm_forward(x, gamma, beta, bn_param):
     """
     Forward pass for batch normalization.
@@ -352,6 +559,113 @@ def batchnorm_backward_alt(dout, cache):
     return dx, dgamma, dbeta
 
 
+def batchnorm_forward_fused(x, gamma, beta, bn_param, axis=1):
+    """
+    Forward pass for batch normalization with a lean cache.
+
+    This computes the same function as batchnorm_forward and takes the same
+    inputs, but allocates only x_hat and the output: the statistics are
+    reduced with einsum rather than through squared temporaries, and x_hat is
+    normalized in place. The cache holds just x_hat, gamma and the inverse
+    standard deviation, and must be given to batchnorm_backward_fused.
+
+    x may have any number of dimensions; axis gives the feature axis, and
+    the statistics are taken over all of the others. For example, spatial
+    batch normalization of (N, C, H, W) data is axis=1, with no transposes.
+
+    Inputs / outputs: Same as batchnorm_forward, with gamma, beta and the
+    running averages of shape (D,) where D = x.shape[axis].
+    """
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+
+    D = x.shape[axis]
+    M = x.size // D
+    running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.dtype))
+    running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
+
+    # Shape that broadcasts a (D,) vector along the feature axis
+    shape = [1] * x.ndim
+    shape[axis] = D
+    reduce_axes = tuple(i for i in range(x.ndim) if i != axis)
+    gamma_b, beta_b = gamma.reshape(shape), beta.reshape(shape)
+
+    out, cache = None, None
+    if mode == 'train':
+        # The variance is taken around the mean rather than as E[x^2] - E[x]^2,
+        # which loses all precision in float32 when the mean is large.
+        acc = _accumulation_dtype(x.dtype)
+        sample_mean = x.mean(axis=reduce_axes, dtype=acc)
+        x_hat = (x - sample_mean.reshape(shape)).astype(x.dtype, copy=False)
+        sample_var = np.einsum(_einsum_reduce(x.ndim, axis), x_hat, x_hat,
+                               dtype=acc) / M
+        inv_std = 1 / np.sqrt(sample_var + eps)
+        x_hat *= inv_std.reshape(shape)
+
+        out = x_hat * gamma_b
+        out += beta_b
+
+        running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+        running_var = momentum * running_var + (1 - momentum) * sample_var
+
+        cache = (x_hat, gamma, inv_std, axis)
+    elif mode == 'test':
+        out = x - running_mean.reshape(shape)
+        out *= gamma_b / np.sqrt(running_var.reshape(shape) + eps)
+        out += beta_b
+    else:
+        raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+    bn_param['running_mean'] = running_mean
+    bn_param['running_var'] = running_var
+
+    return out, cache
+
+
+def batchnorm_backward_fused(dout, cache):
+    """
+    Backward pass for batch normalization computed with
+    batchnorm_forward_fused.
+
+    This evaluates the simplified gradient of batchnorm_backward_alt,
+
+    dx = gamma * inv_std * (dout - mean(dout) - x_hat * mean(dout * x_hat))
+
+    writing every step into dx so that no other full-size array is allocated.
+
+    Inputs / outputs: Same as batchnorm_backward
+    """
+    x_hat, gamma, inv_std, axis = cache
+    D = x_hat.shape[axis]
+    M = x_hat.size // D
+    shape = [1] * x_hat.ndim
+    shape[axis] = D
+    reduce_axes = tuple(i for i in range(x_hat.ndim) if i != axis)
+
+    acc = _accumulation_dtype(dout.dtype)
+    dbeta = dout.sum(axis=reduce_axes, dtype=acc)
+    dgamma = np.einsum(_einsum_reduce(x_hat.ndim, axis), dout, x_hat, dtype=acc)
+
+    dx = np.multiply(x_hat, (dgamma / M).reshape(shape).astype(x_hat.dtype))
+    np.subtract(dout, dx, out=dx)
+    dx -= (dbeta / M).reshape(shape).astype(dx.dtype)
+    dx *= (gamma.reshape(-1) * inv_std).reshape(shape).astype(dx.dtype)
+
+    dgamma = dgamma.astype(gamma.dtype, copy=False).reshape(gamma.shape)
+    dbeta = dbeta.astype(gamma.dtype, copy=False).reshape(gamma.shape)
+    return dx, dgamma, dbeta
+
+
+def _einsum_reduce(ndim, axis):
+    """
+    Returns the einsum subscripts for the sum over all axes but axis of the
+    elementwise product of two ndim-dimensional arrays.
+    """
+    letters = 'abcdefgh'[:ndim]
+    return '%s,%s->%s' % (letters, letters, letters[axis])
+
+
 def layernorm_forward(x, gamma, beta, ln_param):
     """
     Forward pass for layer normalization.
@@ -445,6 +759,25 @@ def layernorm_backward(dout, cache):
     return dx, dgamma, dbeta
 
 
+def _dropout_rng(dropout_param):
+    """
+    Returns the np.random.Generator that dropout_forward should draw its mask
+    from; see dropout_forward.
+    """
+    if 'seed' in dropout_param:
+        counter = [0, 0, 0, dropout_param.get('stream', 0)]
+        return np.random.Generator(
+            np.random.Philox(key=dropout_param['seed'], counter=counter))
+    rng = dropout_param.get('rng')
+    if rng is None:
+        # Seeded from the global RNG, so that np.random.seed still makes
+        # training runs reproducible.
+        seed = np.random.randint(2**63, dtype=np.int64)
+        rng = dropout_param.setdefault('rng', np.random.Generator(
+            np.random.PCG64(seed)))
+    return rng
+
+
 def dropout_forward(x, dropout_param):
     """
     Performs the forward pass for (inverted) dropout.
@@ -458,11 +791,23 @@ def dropout_forward(x, dropout_param):
       - seed: Seed for the random number generator. Passing seed makes this
         function deterministic, which is needed for gradient checking but not
         in real networks.
+      - stream: Optional integer identifying the layer; layers with the same
+        seed but different streams draw independent masks.
+      - inplace: If True, overwrite x with the output and cache the mask as
+        packed bits rather than as a boolean array. The caller must own x.
+
+    Masks are not drawn from the global numpy RNG. With a seed, every call
+    builds a counter-based Philox generator keyed by the seed and positioned
+    at the stream, so the same seed always gives the same mask. Without one,
+    dropout_param['rng'] holds a Generator that is created on first use,
+    seeded from the global RNG; Generators serialize concurrent calls with a
+    lock, so a dropout_param can be shared between threads.
 
     Outputs:
     - out: Array of the same shape as x.
-    - cache: tuple (dropout_param, mask). In training mode, mask is the dropout
-      mask that was used to multiply the input; in test mode, mask is None.
+    - cache: tuple (dropout_param, mask). In training mode, mask is the boolean
+      mask of the kept inputs (packed if inplace is set); in test mode, mask is
+      None.
 
     NOTE: Please implement **inverted** dropout, not the vanilla version of dropout.
     See http://cs231n.github.io/neural-networks-2/#reg for more details.
@@ -472,8 +817,6 @@ def dropout_forward(x, dropout_param):
     as the probability of dropping a neuron output.
     """
     p, mode = dropout_param['p'], dropout_param['mode']
-    if 'seed' in dropout_param:
-        np.random.seed(dropout_param['seed'])
 
     mask = None
     out = None
@@ -483,8 +826,15 @@ def dropout_forward(x, dropout_param):
         # TODO: Implement training phase forward pass for inverted dropout.   #
         # Store the dropout mask in the mask variable.                        #
         #######################################################################
-        mask = (np.random.rand(*x.shape) < p) / p
-        out = x * mask
+        rng = _dropout_rng(dropout_param)
+        keep = rng.random(x.shape, dtype=np.float32) < p
+        if dropout_param.get('inplace', False):
+            out = np.multiply(x, keep, out=x)
+            mask = _pack_mask(keep)
+        else:
+            out = x * keep
+            mask = keep
+        out *= 1 / p
         #######################################################################
         #                           END OF YOUR CODE                          #
         #######################################################################
@@ -509,7 +859,8 @@ def dropout_backward(dout, cache):
 
     Inputs:
     - dout: Upstream derivatives, of any shape
-    - cache: (dropout_param, mask) from dropout_forward.
+    - cache: (dropout_param, mask) from dropout_forward. If the forward pass
+      was in place, dout is overwritten with dx.
     """
     dropout_param, mask = cache
     mode = dropout_param['mode']
@@ -519,7 +870,11 @@ def dropout_backward(dout, cache):
         #######################################################################
         # TODO: Implement training phase backward pass for inverted dropout   #
         #######################################################################
-        dx = dout * mask
+        if dropout_param.get('inplace', False):
+            dx = np.multiply(dout, _unpack_mask(mask), out=dout)
+        else:
+            dx = dout * mask
+        dx *= 1 / dropout_param['p']
         #######################################################################
         #                          END OF YOUR CODE                           #
         #######################################################################
@@ -574,7 +929,7 @@ def conv_forward_naive(x, w, b, conv_param):
     Hh = int(1 + (H + 2 * P - HH) / S)
     Hw = int(1 + (W + 2 * P - WW) / S)
     
-    out = np.zeros((N, F, Hh, Hw))
+    out = np.zeros((N, F, Hh, Hw), dtype=np.result_type(x, w, b))
 
     for n in range(N):  # First, iterate over all the images
         for f in range(F):  # Second, iterate over all the kernels
@@ -731,6 +1086,102 @@ def max_pool_backward_naive(dout, cache):
     return dx
 
 
+def avg_pool_forward_naive(x, pool_param):
+    """
+    A naive implementation of the forward pass for an average-pooling layer.
+
+    Inputs:
+    - x: Input data, of shape (N, C, H, W)
+    - pool_param: dictionary with the following keys:
+      - 'pool_height': The height of each pooling region
+      - 'pool_width': The width of each pooling region
+      - 'stride': The distance between adjacent pooling regions
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, C, H', W') where H' and W' are given by
+      H' = 1 + (H - pool_height) / stride
+      W' = 1 + (W - pool_width) / stride
+    - cache: (x, pool_param)
+    """
+    N, C, H, W = x.shape
+    HH = pool_param['pool_height']
+    WW = pool_param['pool_width']
+    S = pool_param['stride']
+    H_prime = (H - HH) // S + 1
+    W_prime = (W - WW) // S + 1
+    out = np.zeros((N, C, H_prime, W_prime), dtype=x.dtype)
+
+    for i in range(H_prime):
+        for j in range(W_prime):
+            selected_x = x[:, :, i*S : i*S+HH, j*S : j*S+WW]
+            out[:, :, i, j] = np.mean(selected_x, axis=(2, 3))
+
+    cache = (x, pool_param)
+    return out, cache
+
+
+def avg_pool_backward_naive(dout, cache):
+    """
+    A naive implementation of the backward pass for an average-pooling layer.
+
+    Inputs:
+    - dout: Upstream derivatives
+    - cache: A tuple of (x, pool_param) as in the forward pass.
+
+    Returns:
+    - dx: Gradient with respect to x
+    """
+    x, pool_param = cache
+    N, C, H, W = x.shape
+    HH = pool_param['pool_height']
+    WW = pool_param['pool_width']
+    S = pool_param['stride']
+    H_prime = (H - HH) // S + 1
+    W_prime = (W - WW) // S + 1
+
+    # Every element of a window contributes 1 / (HH * WW) of its average.
+    dx = np.zeros_like(x, dtype=np.result_type(dout, x))
+    for i in range(H_prime):
+        for j in range(W_prime):
+            dx[:, :, i*S : i*S+HH, j*S : j*S+WW] += \
+                dout[:, :, i, j][:, :, None, None] / (HH * WW)
+    return dx
+
+
+def global_avg_pool_forward(x):
+    """
+    Computes the forward pass for a global average-pooling layer, which
+    averages each channel over all spatial positions.
+
+    Inputs:
+    - x: Input data, of shape (N, C, H, W)
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, C)
+    - cache: The shape of x
+    """
+    out = x.mean(axis=(2, 3))
+    cache = x.shape
+    return out, cache
+
+
+def global_avg_pool_backward(dout, cache):
+    """
+    Computes the backward pass for a global average-pooling layer.
+
+    Inputs:
+    - dout: Upstream derivatives, of shape (N, C)
+    - cache: The shape of x, as returned by global_avg_pool_forward
+
+    Returns:
+    - dx: Gradient with respect to x, of shape (N, C, H, W)
+    """
+    N, C, H, W = cache
+    dx = np.empty(cache, dtype=dout.dtype)
+    dx[...] = (dout / (H * W))[:, :, None, None]
+    return dx
+
+
 def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     """
     Computes the forward pass for spatial batch normalization.
@@ -748,6 +1199,8 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
         default of momentum=0.9 should work well in most situations.
       - running_mean: Array of shape (D,) giving running mean of features
       - running_var Array of shape (D,) giving running variance of features
+      - layout: 'NCHW' (the default) or 'NHWC'; in the latter case x and out
+        have shape (N, H, W, C).
 
     Returns a tuple of:
     - out: Output data, of shape (N, C, H, W)
@@ -763,12 +1216,10 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     # Your implementation should be very short; ours is less than five lines. #
     ###########################################################################
     
-    N, C, H, W = x.shape
-    x_reshaped = x.transpose(0,2,3,1).reshape(N*H*W, C)
-    
-    out_tmp, cache = batchnorm_forward(x_reshaped, gamma, beta, bn_param)
-    
-    out = out_tmp.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+    # Batch normalization over every axis but the channels, directly on the
+    # (N, C, H, W) or (N, H, W, C) layout
+    axis = 3 if bn_param.get('layout', 'NCHW') == 'NHWC' else 1
+    out, cache = batchnorm_forward_fused(x, gamma, beta, bn_param, axis)
     
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -800,12 +1251,7 @@ def spatial_batchnorm_backward(dout, cache):
     # Your implementation should be very short; ours is less than five lines. #
     ###########################################################################
     
-    N, C, H, W = dout.shape
-    dout_reshaped = dout.transpose(0,2,3,1).reshape(N*H*W, C)
-    
-    dx_tmp, dgamma, dbeta = batchnorm_backward(dout_reshaped, cache)
-    
-    dx = dx_tmp.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+    dx, dgamma, dbeta = batchnorm_backward_fused(dout, cache)
     
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -843,28 +1289,23 @@ def spatial_groupnorm_forward(x, gamma, beta, G, gn_param):
     # and layer normalization!                                                # 
     ###########################################################################
     
+    # Normalize over a (N, G, C//G * H * W) view of x, so that each group is
+    # a contiguous row and no transposes are needed
     N, C, H, W = x.shape
-    x = np.reshape(x, (N*G, C//G*H*W))
-    
-    # Transpose x to use batchnorm code
-    x = x.T
+    x_groups = x.reshape(N, G, -1)
+    K = x_groups.shape[2]
 
-    # Just copy from batch normalization cdoe
-    mu = np.mean(x, axis=0)
-    
-    xmu = x - mu
-    sq = xmu ** 2
-    var = np.var(x, axis=0)
+    mean = x_groups.mean(axis=2, keepdims=True)
+    xhat = x_groups - mean
+    var = np.einsum('ngk,ngk->ng', xhat, xhat) / K
+    ivar = 1. / np.sqrt(var + eps)
+    xhat *= ivar[:, :, np.newaxis]
+    xhat = xhat.reshape(N, C, H, W)
 
-    sqrtvar = np.sqrt(var + eps)
-    ivar = 1./sqrtvar
-    xhat = xmu * ivar
-    
-    # Transform xhat and reshape
-    xhat = np.reshape(xhat.T, (N, C, H, W))
-    out = gamma * xhat + beta
+    out = xhat * gamma.reshape(1, C, 1, 1)
+    out += beta.reshape(1, C, 1, 1)
 
-    cache = (xhat, gamma, xmu, ivar, sqrtvar, var, eps, G)
+    cache = (xhat, gamma, ivar, G)
     
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -894,23 +1335,23 @@ def spatial_groupnorm_backward(dout, cache):
     
     N, C, H, W = dout.shape
 
-    xhat, gamma, xmu, ivar, sqrtvar, var, eps, G = cache
+    xhat, gamma, ivar, G = cache
 
-    dxhat = dout * gamma[np.newaxis, :, np.newaxis, np.newaxis]
+    dbeta = np.sum(dout, axis=(0, 2, 3)).reshape(gamma.shape)
+    dgamma = np.einsum('nchw,nchw->c', dout, xhat).reshape(gamma.shape)
 
-    # Set keepdims=True to make dbeta and dgamma's shape be (1, C, 1, 1)
-    dbeta = np.sum(dout, axis=(0, 2, 3), keepdims=True)
-    dgamma = np.sum(dout*xhat, axis=(0, 2, 3), keepdims=True)
-
-    # Reshape and transpose back
-    dxhat = np.reshape(dxhat, (N*G, C//G*H*W)).T
-    xhat = np.reshape(xhat, (N*G, C//G*H*W)).T
-
-    Nprime, Dprime = dxhat.shape
-    
-    dx = 1.0/Nprime * ivar * (Nprime*dxhat - np.sum(dxhat, axis=0) - xhat*np.sum(dxhat*xhat, axis=0))
+    # Same expression as for layer norm, on the (N, G, C//G * H * W) views:
+    # dx = ivar * (dxhat - mean(dxhat) - xhat * mean(dxhat * xhat))
+    dx = np.multiply(dout, gamma.reshape(1, C, 1, 1), order='C')
+    dx_groups = dx.reshape(N, G, -1)
+    xhat_groups = xhat.reshape(N, G, -1)
+    K = dx_groups.shape[2]
 
-    dx = np.reshape(dx.T, (N, C, H, W))
+    mean_dxhat = dx_groups.mean(axis=2, keepdims=True)
+    mean_dxhat_xhat = np.einsum('ngk,ngk->ng', dx_groups, xhat_groups) / K
+    dx_groups -= mean_dxhat
+    dx_groups -= xhat_groups * mean_dxhat_xhat[:, :, np.newaxis]
+    dx_groups *= ivar[:, :, np.newaxis]
     
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -959,6 +1400,9 @@ def softmax_loss(x, y):
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
     """
+    # Low precision scores are handled in float32; dx is then float32 too, so
+    # that small gradients do not underflow before any loss scaling.
+    x = x.astype(_accumulation_dtype(x.dtype), copy=False)
     shifted_logits = x - np.max(x, axis=1, keepdims=True)
     Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
     log_probs = shifted_logits - np.log(Z)
@@ -0,0 +1,352 @@
+from __future__ import print_function, division
+from builtins import range
+import copy
+from timeit import default_timer as timer
+
+import numpy as np
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    # Pruning works without scipy, but pruned weights cannot be stored as
+    # sparse matrices.
+    sparse = None
+
+from cs231n.layer_utils import conv_relu_pool_forward
+from cs231n.compression import affine_flops
+
+"""
+This file implements magnitude pruning of affine weights, and structured
+pruning of convolutional filters.
+
+Pruning zeroes the weights of smallest magnitude and keeps them at zero for
+the rest of training. The Solver prunes iteratively when given a
+prune_config: the sparsity is raised gradually over several epochs, with
+training in between to recover the accuracy. The Solver then converts the
+pruned weights to scipy.sparse CSR matrices, so that the rest of training,
+and inference, only touch the surviving weights (see sparse_affine_forward
+in layers.py).
+
+Pruning individual weights does not make convolutions any cheaper, since
+they are computed as dense GEMMs; removing whole filters does. Channel
+pruning (prune_channels) ranks the filters of a convolutional layer, and
+removes the weakest ones along with the weights that consume their output
+channels in the next layer. The result is a smaller dense model.
+"""
+
+
+def magnitude_prune(w, sparsity):
+    """
+    Computes the mask that prunes the given fraction of the entries of w with
+    the smallest magnitude. Entries of w that are already zero are pruned
+    first, so masks only shrink as the sparsity is raised.
+
+    Inputs:
+    - w: Numpy array of weights
+    - sparsity: Fraction of the entries of w to prune, between 0 and 1
+
+    Returns:
+    - mask: Boolean array of the same shape as w that is False for the pruned
+      entries
+    """
+    num_pruned = int(round(sparsity * w.size))
+    mask = np.ones(w.size, dtype=bool)
+    if num_pruned > 0:
+        pruned = np.argpartition(np.abs(w).ravel(), num_pruned - 1)
+        mask[pruned[:num_pruned]] = False
+    return mask.reshape(w.shape)
+
+
+def prune_schedule(epoch, sparsity, start_epoch, end_epoch):
+    """
+    Target sparsity after the given epoch for gradual pruning: none until
+    start_epoch, then rising along a cubic to the final sparsity at
+    end_epoch. Most weights are pruned early, while the network still has
+    plenty of capacity to recover.
+    """
+    if epoch <= start_epoch:
+        return 0.0
+    if epoch >= end_epoch:
+        return sparsity
+    progress = (epoch - start_epoch) / (end_epoch - start_epoch)
+    return sparsity * (1 - (1 - progress) ** 3)
+
+
+def to_csr(w, mask):
+    """
+    Converts a pruned weight to a scipy.sparse CSR matrix that stores exactly
+    the entries selected by mask, including any that happen to be zero.
+    Its data array lists the kept entries in the same order as w[mask].
+    """
+    if sparse is None:
+        raise ImportError('Sparse weights require scipy')
+    rows, cols = np.nonzero(mask)
+    indptr = np.concatenate([[0], np.cumsum(np.sum(mask, axis=1))])
+    return sparse.csr_array((w[rows, cols], cols, indptr), shape=w.shape)
+
+
+def prune_model(model, sparsity, keys=None, to_sparse=True):
+    """
+    One-shot magnitude pruning of the weights of a model.
+
+    Inputs:
+    - model: A model whose params dictionary holds affine weights
+    - sparsity: Fraction of the entries of each weight to prune
+    - keys: Names of the parameters to prune; by default all 2D parameters
+      (the affine weights) whose name starts with 'W'.
+    - to_sparse: If True, replace the pruned weights with CSR matrices;
+      otherwise zero the pruned entries of the dense weights.
+
+    Returns a dictionary mapping the names of the pruned parameters to their
+    masks.
+    """
+    if keys is None:
+        keys = prunable_params(model.params)
+    masks = {}
+    for k in keys:
+        w = model.params[k]
+        masks[k] = magnitude_prune(w, sparsity)
+        if to_sparse:
+            model.params[k] = to_csr(w, masks[k])
+        else:
+            model.params[k] = w * masks[k]
+    return masks
+
+
+def prunable_params(params):
+    """
+    Names of the parameters that are pruned by default: the 2D weights.
+    """
+    return sorted(k for k, v in params.items()
+                  if k.startswith('W') and v.ndim == 2)
+
+
+def is_sparse(w):
+    return sparse is not None and sparse.issparse(w)
+
+
+def pattern_data(dw, w):
+    """
+    Returns the entries of the gradient dw at the stored entries of the CSR
+    weight w, in the order of w.data.
+
+    sparse_affine_backward returns gradients with the pattern of w, but
+    sparse arithmetic in the models (such as adding the regularization
+    gradient) drops entries that are exactly zero, so the pattern of dw
+    is checked and realigned if necessary.
+    """
+    if (is_sparse(dw) and dw.format == 'csr' and dw.nnz == w.nnz
+            and np.array_equal(dw.indptr, w.indptr)
+            and np.array_equal(dw.indices, w.indices)):
+        return dw.data
+    rows = np.repeat(np.arange(w.shape[0]), np.diff(w.indptr))
+    if is_sparse(dw):
+        return np.asarray(dw.tocsr()[rows, w.indices]).ravel()
+    return dw[rows, w.indices]
+
+
+def sparsity_report(params):
+    """
+    Returns a dictionary mapping the name of each parameter to the fraction
+    of its entries that are zero or not stored.
+    """
+    report = {}
+    for k, v in params.items():
+        if is_sparse(v):
+            nonzero = np.count_nonzero(v.data)
+        else:
+            nonzero = np.count_nonzero(v)
+        report[k] = 1 - nonzero / np.prod(v.shape)
+    return report
+
+
+def select_input_channels(w_next, keep, num_channels, layout='NCHW'):
+    """
+    Removes the weights of a layer that consume the input channels not in
+    keep, once the filters producing them have been pruned. Per-channel
+    arrays, such as the biases of the pruned filters or batch normalization
+    parameters, can simply be indexed with keep.
+
+    Inputs:
+    - w_next: Weights of the next layer. Either conv filters of shape
+      (F', C, HH, WW), or affine weights (dense, sparse, or the U factor of a
+      factorized layer) whose rows are the flattened (C, H, W) feature maps,
+      the (H, W, C) feature maps for layout 'NHWC', or the C channels of a
+      global average pool.
+    - keep: Sorted array of the indices of the channels to keep
+    - num_channels: Number of channels C before pruning
+    - layout: Layout of the feature maps flattened into affine weights
+
+    Returns the pruned weights.
+    """
+    if w_next.ndim == 4:
+        return w_next[:, keep]
+    rows = np.arange(w_next.shape[0])
+    if layout == 'NHWC':
+        rows = rows.reshape(-1, num_channels)[:, keep]
+    else:
+        rows = rows.reshape(num_channels, -1)[keep]
+    return w_next[rows.ravel()]
+
+
+def _conv_net_layer_params(model):
+    """
+    The conv_param and pool_param of the first layer of a ThreeLayerConvNet,
+    as built by its loss method.
+    """
+    filter_size = model.params['W1'].shape[2]
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2,
+                  'layout': model.layout}
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2,
+                  'layout': model.layout}
+    return conv_param, pool_param
+
+
+def _hidden_weight_key(params):
+    # W2, or its U factor if the layer has been factorized
+    return 'W2' if 'W2' in params else 'U2'
+
+
+def filter_importance(model, criterion='l1', X=None, batch_size=100):
+    """
+    Scores the filters of the convolutional layer of a ThreeLayerConvNet.
+
+    Inputs:
+    - model: A ThreeLayerConvNet
+    - criterion: 'l1' scores each filter by the L1 norm of its weights.
+      'activation' scores it by its contribution to the hidden layer: the
+      mean pooled activation of its output channel on X at each position,
+      times the L1 norm of the weights of the hidden layer reading it.
+    - X: Input data for the 'activation' criterion
+    - batch_size: Size of the minibatches in which X is processed
+
+    Returns an array of shape (F,) of filter scores; higher is more
+    important.
+    """
+    W1, b1 = model.params['W1'], model.params['b1']
+    F = W1.shape[0]
+    if criterion == 'l1':
+        return np.sum(np.abs(W1), axis=(1, 2, 3))
+    if criterion != 'activation':
+        raise ValueError('Invalid criterion "%s"' % criterion)
+    if X is None:
+        raise ValueError('The activation criterion needs input data X')
+
+    conv_param, pool_param = _conv_net_layer_params(model)
+    activation = 0
+    for i in range(0, X.shape[0], batch_size):
+        out, _ = conv_relu_pool_forward(X[i:i + batch_size].astype(W1.dtype),
+                                        W1, b1, conv_param, pool_param)
+        activation += np.sum(out, axis=0)
+    activation /= X.shape[0]
+    if model.layout == 'NHWC':
+        activation = activation.transpose(2, 0, 1)
+    if model.global_pool:
+        activation = np.mean(activation, axis=(1, 2))
+
+    w2 = model.params[_hidden_weight_key(model.params)]
+    if is_sparse(w2):
+        w2 = w2.toarray()
+    # The L1 norm of each row of W2, arranged like the activations
+    row_norms = np.sum(np.abs(w2), axis=1)
+    if model.layout == 'NHWC' and not model.global_pool:
+        row_norms = row_norms.reshape(activation.shape[1:] + (F,))
+        row_norms = row_norms.transpose(2, 0, 1)
+    else:
+        row_norms = row_norms.reshape(activation.shape)
+    contribution = activation * row_norms
+    return np.sum(contribution.reshape(F, -1), axis=1)
+
+
+def prune_channels(model, num_filters=None, fraction=None, criterion='l1',
+                   X=None):
+    """
+    Structured pruning of the convolutional layer of a ThreeLayerConvNet:
+    removes its least important filters, and the rows of the hidden layer
+    weights (W2, or U2 once factorized) that read their output channels.
+
+    Inputs:
+    - model: A trained ThreeLayerConvNet; it is not modified.
+    - num_filters: Number of filters to keep
+    - fraction: If num_filters is None, the fraction of the filters to remove
+    - criterion, X: How to rank the filters; see filter_importance.
+
+    Returns a pruned copy of the model, with the same API. Its attribute
+    kept_filters gives the indices of the surviving filters in the original
+    model. Fine-tune it with a Solver to recover accuracy.
+    """
+    scores = filter_importance(model, criterion, X)
+    F = len(scores)
+    if num_filters is None:
+        if fraction is None:
+            raise ValueError('Either num_filters or fraction must be given')
+        num_filters = F - int(round(fraction * F))
+    num_filters = max(1, min(num_filters, F))
+    keep = np.sort(np.argsort(-scores, kind='stable')[:num_filters])
+
+    pruned = copy.deepcopy(model)
+    params = pruned.params
+    params['W1'] = params['W1'][keep]
+    params['b1'] = params['b1'][keep]
+    k = _hidden_weight_key(params)
+    params[k] = select_input_channels(params[k], keep, F, model.layout)
+    pruned.kept_filters = keep
+    return pruned
+
+
+def conv_net_flops(model, input_shape):
+    """
+    Number of multiply-adds per example of a ThreeLayerConvNet on images of
+    the given shape, in the layout of the model.
+    """
+    if model.layout == 'NHWC':
+        H, W = input_shape[0], input_shape[1]
+    else:
+        H, W = input_shape[1], input_shape[2]
+    conv_flops = np.prod(model.params['W1'].shape) * H * W
+    return int(conv_flops) + affine_flops(model.params)
+
+
+def channel_pruning_report(model, pruned, X, y, batch_size=100, num_runs=3,
+                           verbose=True):
+    """
+    Compares a ThreeLayerConvNet with its channel-pruned version on a
+    labelled dataset.
+
+    Inputs:
+    - model: The original model
+    - pruned: The model returned by prune_channels(model, ...), possibly
+      fine-tuned
+    - X, y: Input data and labels
+    - batch_size: Size of the minibatches passed to loss
+    - num_runs: Number of timed passes over X; the fastest one is reported.
+    - verbose: Whether to print the report
+
+    Returns a dictionary with the following keys, each mapping to a tuple of
+    the values for the original and the pruned model:
+    - acc: Accuracy on (X, y)
+    - time: Seconds per pass over X
+    - filters: Number of filters of the convolutional layer
+    - flops: Multiply-adds per example
+    """
+    report = {'acc': (), 'time': (), 'filters': (), 'flops': ()}
+    for m in (model, pruned):
+        best = None
+        for _ in range(num_runs):
+            start = timer()
+            y_pred = np.hstack([np.argmax(m.loss(X[i:i + batch_size]), axis=1)
+                                for i in range(0, X.shape[0], batch_size)])
+            elapsed = timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+        report['acc'] += (np.mean(y_pred == y),)
+        report['time'] += (best,)
+        report['filters'] += (m.params['W1'].shape[0],)
+        report['flops'] += (conv_net_flops(m, X.shape[1:]),)
+
+    if verbose:
+        print('%-9s %10s %12s %9s %14s' % ('', 'accuracy', 'time (ms)',
+                                           'filters', 'flops'))
+        for j, name in enumerate(('original', 'pruned')):
+            print('%-9s %10.4f %12.2f %9d %14d' % (
+                   name, report['acc'][j], 1e3 * report['time'][j],
+                   report['filters'][j], report['flops'][j]))
+    return report
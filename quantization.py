@@ -0,0 +1,497 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+from timeit import default_timer as timer
+
+import numpy as np
+
+from cs231n.layers import layernorm_forward
+from cs231n.fast_layers import max_pool_forward_fast
+from cs231n.im2col import im2col_strided
+from cs231n.fc_net import TwoLayerNet, FullyConnectedNet
+from cs231n.cnn import ThreeLayerConvNet
+from cs231n.pruning import is_sparse
+
+"""
+This file implements post-training int8 quantization for inference.
+
+quantize_model converts a trained model into a QuantizedModel with the same
+test-time API (scores = qmodel.loss(X)). Weights are quantized symmetrically
+to int8 with one scale per output channel. Layer inputs are quantized to int8
+with one scale per layer, calibrated on a sample of data. Affine layers and
+convolutions multiply int8 operands with int32 accumulation. The
+accumulators are then rescaled to float32 before the bias, normalization and
+ReLU are applied.
+
+Batch normalization is folded into the preceding affine layer. Layer
+normalization is applied in float32 to the dequantized affine output.
+quantization_report compares the accuracy, latency and model size of a float
+model and its quantized version.
+"""
+
+# Largest magnitude of a quantized value; the range is symmetric.
+INT8_MAX = 127
+
+# Largest reduction length K for which a sum of K products of int8 values
+# is exact in float32 (K * 127 ** 2 < 2 ** 24).
+FLOAT32_EXACT_K = (2 ** 24) // INT8_MAX ** 2
+
+
+def quantize_weights(w, axis=0):
+    """
+    Symmetric per-channel int8 quantization of a weight array.
+
+    Inputs:
+    - w: Array of weights
+    - axis: Axis of w indexing the output channels; every channel gets its own
+      scale.
+
+    Returns a tuple of:
+    - w_q: int8 array of the same shape as w, such that w ~ w_q * scale along
+      axis
+    - scale: float32 array of shape (w.shape[axis],)
+    """
+    reduce_axes = tuple(a for a in range(w.ndim) if a != axis % w.ndim)
+    scale = np.max(np.abs(w), axis=reduce_axes, keepdims=True) / INT8_MAX
+    scale = scale.astype(np.float32)
+    scale[scale == 0] = 1
+    w_q = np.clip(np.rint(w / scale), -INT8_MAX, INT8_MAX).astype(np.int8)
+    return w_q, scale.ravel()
+
+
+def quantize_activations(x, scale):
+    """
+    Quantizes an array to int8 with a single scale, saturating values outside
+    of [-127 * scale, 127 * scale].
+    """
+    x_q = np.multiply(x, np.float32(1.0 / scale), dtype=np.float32)
+    np.rint(x_q, out=x_q)
+    np.clip(x_q, -INT8_MAX, INT8_MAX, out=x_q)
+    return x_q.astype(np.int8)
+
+
+def calibrate_scale(x, percentile=100.0):
+    """
+    Chooses the quantization scale of an activation from a calibration sample
+    x, so that the given percentile of |x| maps to 127. Percentiles below 100
+    clip outliers in exchange for a finer resolution of the bulk of the
+    values.
+    """
+    a = np.abs(x).ravel()
+    if percentile >= 100:
+        bound = np.max(a)
+    else:
+        bound = np.percentile(a, percentile)
+    return float(bound) / INT8_MAX if bound > 0 else 1.0
+
+
+def matmul_int8(a, b, blas=True):
+    """
+    Matrix product of two int8 arrays with int32 accumulation.
+
+    numpy's integer matrix product does not use BLAS and is more than an
+    order of magnitude slower than a float32 GEMM. Products of int8 values are
+    integers below 127 ** 2 in magnitude, so as long as their sums are below
+    2 ** 24 (2 ** 53) every partial sum is exact in float32 (float64), and a
+    floating point GEMM gives exactly the int32 result. With blas=True (the
+    default) the product is computed that way; with blas=False it uses
+    numpy's integer matrix product. Both return the same int32 array.
+
+    Inputs:
+    - a: int8 array of shape (M, K)
+    - b: int8 array of shape (K, N)
+    - blas: Whether to compute the exact product with a floating point GEMM
+
+    Returns an int32 array of shape (M, N).
+    """
+    if not blas:
+        return np.matmul(a, b, dtype=np.int32)
+    dtype = np.float32 if a.shape[1] <= FLOAT32_EXACT_K else np.float64
+    return np.dot(a.astype(dtype), b.astype(dtype)).astype(np.int32)
+
+
+def affine_forward_int8(x_q, x_scale, w_q, w_scale, b, blas=True):
+    """
+    Computes the forward pass for an affine layer with int8 inputs and
+    weights.
+
+    Inputs:
+    - x_q: int8 array of shape (N, d_1, ..., d_k), the quantized input
+    - x_scale: Scale of x_q
+    - w_q: int8 array of shape (D, M), the weights quantized per output
+    - w_scale: Array of shape (M,) giving the scales of the columns of w_q
+    - b: Array of biases, of shape (M,)
+    - blas: Passed to matmul_int8
+
+    Returns:
+    - out: float32 array of shape (N, M)
+    """
+    acc = matmul_int8(x_q.reshape(x_q.shape[0], -1), w_q, blas)
+    out = acc.astype(np.float32)
+    out *= x_scale * w_scale
+    out += b
+    return out
+
+
+def _conv_int8_accumulate(x_q, w_q, conv_param, blas=True):
+    """
+    int32 accumulators of the convolution of int8 x_q (N, C, H, W) with int8
+    w_q (F, C, HH, WW), computed as an im2col GEMM. Returns an array of shape
+    (N, F, H', W').
+    """
+    N, C, H, W = x_q.shape
+    F, _, HH, WW = w_q.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    out_height = (H + 2 * pad - HH) // stride + 1
+    out_width = (W + 2 * pad - WW) // stride + 1
+
+    x_cols = im2col_strided(x_q, HH, WW, pad, stride)
+    acc = matmul_int8(w_q.reshape(F, -1), x_cols, blas)
+    acc = acc.reshape(F, out_height, out_width, N)
+    return acc.transpose(3, 0, 1, 2)
+
+
+def conv_forward_int8(x_q, x_scale, w_q, w_scale, b, conv_param, blas=True):
+    """
+    Computes the forward pass for a convolutional layer with int8 inputs and
+    weights.
+
+    Inputs:
+    - x_q: int8 array of shape (N, C, H, W), the quantized input
+    - x_scale: Scale of x_q
+    - w_q: int8 array of shape (F, C, HH, WW), the filters quantized per
+      filter
+    - w_scale: Array of shape (F,) giving the scales of the filters
+    - b: Array of biases, of shape (F,)
+    - conv_param: Dictionary with the keys 'stride' and 'pad'
+    - blas: Passed to matmul_int8
+
+    Returns:
+    - out: float32 array of shape (N, F, H', W')
+    """
+    acc = _conv_int8_accumulate(x_q, w_q, conv_param, blas)
+    out = acc.astype(np.float32)
+    out *= (x_scale * w_scale).reshape(1, -1, 1, 1)
+    out += b.reshape(1, -1, 1, 1)
+    return out
+
+
+def conv_relu_pool_forward_int8(x_q, x_scale, w_q, w_scale, b, conv_param,
+                                pool_param, blas=True):
+    """
+    conv - relu - max pool with int8 inputs and weights.
+
+    Rescaling by a positive per-filter scale, adding a per-filter bias and the
+    ReLU are all monotonic within a channel, so they commute with max pooling.
+    The int32 accumulators are therefore pooled first and only the pooled
+    outputs are dequantized.
+
+    Inputs are as for conv_forward_int8, plus pool_param as for
+    max_pool_forward_fast. Returns the float32 output of the pooling layer.
+    """
+    acc = _conv_int8_accumulate(x_q, w_q, conv_param, blas)
+    acc, _ = max_pool_forward_fast(acc, pool_param)
+    out = acc.astype(np.float32)
+    out *= (x_scale * w_scale).reshape(1, -1, 1, 1)
+    out += b.reshape(1, -1, 1, 1)
+    np.maximum(out, 0, out=out)
+    return out
+
+
+class QuantizedModel(object):
+    """
+    An int8 inference model built from a trained float model by
+    quantize_model.
+
+    The model is a list of layers, each a dictionary with a 'type' key:
+
+    - 'affine': affine layer, optionally followed by layer normalization
+      ('ln' holds (gamma, beta, ln_param) or None) and a ReLU ('relu').
+    - 'conv_relu_pool': conv - relu - max pool, with 'conv_param' and
+      'pool_param'.
+    - 'global_avg_pool': global average pooling over the spatial axes.
+    - 'to_nchw': transposes channels-last input to channels-first.
+
+    Affine and conv layers hold their quantized weights 'w_q', the per-output
+    scales 'w_scale', the float32 biases 'b' and the scale 'x_scale' with
+    which their inputs are quantized.
+
+    Like the float models, loss(X) returns the class scores for X. Training
+    is not supported.
+    """
+
+    def __init__(self, layers, blas=True):
+        """
+        Inputs:
+        - layers: List of layer dictionaries as described above
+        - blas: If True, compute the exact int8 products with floating point
+          BLAS (see matmul_int8); otherwise use numpy's integer matmul.
+        """
+        self.layers = layers
+        self.blas = blas
+
+
+    @property
+    def nbytes(self):
+        """
+        Size in bytes of the parameters of the model.
+        """
+        total = 0
+        for layer in self.layers:
+            for k in ('w_q', 'w_scale', 'b'):
+                if k in layer:
+                    total += layer[k].nbytes
+            if layer.get('ln') is not None:
+                total += layer['ln'][0].nbytes + layer['ln'][1].nbytes
+        return total
+
+
+    def loss(self, X, y=None):
+        """
+        Compute the class scores for a minibatch of data.
+
+        Inputs:
+        - X: Array of input data, as for the float model
+        - y: Must be None; quantized models only run the test-time forward
+          pass.
+
+        Returns:
+        - scores: float32 array of shape (N, C) giving class scores
+        """
+        if y is not None:
+            raise ValueError('Quantized models only support inference')
+        return self._forward(X)
+
+
+    def _forward(self, X, calibrate=False, percentile=100.0):
+        """
+        Runs the layers on X. With calibrate=True, each layer instead runs in
+        float32 with its float weights 'w', and records the quantization
+        scale of its input in 'x_scale'.
+        """
+        out = X.astype(np.float32, copy=False)
+        for layer in self.layers:
+            kind = layer['type']
+            if kind == 'to_nchw':
+                out = out.transpose(0, 3, 1, 2)
+                continue
+            if kind == 'global_avg_pool':
+                out = out.mean(axis=(2, 3))
+                continue
+
+            if calibrate:
+                layer['x_scale'] = calibrate_scale(out, percentile)
+                out = self._float_layer(out, layer)
+                continue
+
+            x_q = quantize_activations(out, layer['x_scale'])
+            if kind == 'conv_relu_pool':
+                out = conv_relu_pool_forward_int8(
+                    x_q, layer['x_scale'], layer['w_q'], layer['w_scale'],
+                    layer['b'], layer['conv_param'], layer['pool_param'],
+                    self.blas)
+                continue
+            out = affine_forward_int8(x_q, layer['x_scale'], layer['w_q'],
+                                      layer['w_scale'], layer['b'], self.blas)
+            if layer['ln'] is not None:
+                gamma, beta, ln_param = layer['ln']
+                out, _ = layernorm_forward(out, gamma, beta, ln_param)
+            if layer['relu']:
+                np.maximum(out, 0, out=out)
+        return out
+
+
+    def _float_layer(self, x, layer):
+        """
+        The float32 forward pass of an affine or conv layer, for calibration.
+        """
+        w, b = layer['w'], layer['b']
+        if layer['type'] == 'conv_relu_pool':
+            N, C, H, W = x.shape
+            F, _, HH, WW = w.shape
+            conv_param = layer['conv_param']
+            stride, pad = conv_param['stride'], conv_param['pad']
+            out_height = (H + 2 * pad - HH) // stride + 1
+            out_width = (W + 2 * pad - WW) // stride + 1
+            x_cols = im2col_strided(x, HH, WW, pad, stride)
+            out = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
+            out = out.reshape(F, out_height, out_width, N).transpose(3, 0, 1, 2)
+            out, _ = max_pool_forward_fast(out, layer['pool_param'])
+            return np.maximum(out, 0)
+        out = x.reshape(x.shape[0], -1).dot(w) + b
+        if layer['ln'] is not None:
+            gamma, beta, ln_param = layer['ln']
+            out, _ = layernorm_forward(out, gamma, beta, ln_param)
+        if layer['relu']:
+            out = np.maximum(out, 0)
+        return out
+
+
+def _affine_layer(w, b, relu, ln=None):
+    return {'type': 'affine', 'w': w.astype(np.float32),
+            'b': b.astype(np.float32), 'relu': relu, 'ln': ln}
+
+
+def _fc_layers(model):
+    """
+    Converts the parameters of a FullyConnectedNet into QuantizedModel layers,
+    folding batch normalization into the affine layers.
+    """
+    params = model.params
+    layers = []
+    for i in range(1, model.num_layers + 1):
+        w, b = params['W%d' % i], params['b%d' % i]
+        if i == model.num_layers:
+            layers.append(_affine_layer(w, b, relu=False))
+        elif model.normalization == 'batchnorm':
+            # At test time batch normalization is an affine map per feature
+            bn_param = model.bn_params[i - 1]
+            eps = bn_param.get('eps', 1e-5)
+            mean = bn_param.get('running_mean', np.zeros_like(b))
+            var = bn_param.get('running_var', np.ones_like(b))
+            scale = params['gamma%d' % i] / np.sqrt(var + eps)
+            b = (b - mean) * scale + params['beta%d' % i]
+            layers.append(_affine_layer(w * scale, b, relu=True))
+        elif model.normalization == 'layernorm':
+            ln = (params['gamma%d' % i].astype(np.float32),
+                  params['beta%d' % i].astype(np.float32),
+                  model.ln_params[i - 1])
+            layers.append(_affine_layer(w, b, relu=True, ln=ln))
+        else:
+            layers.append(_affine_layer(w, b, relu=True))
+    return layers
+
+
+def _conv_net_layers(model, input_shape):
+    """
+    Converts the parameters of a ThreeLayerConvNet into QuantizedModel
+    layers. input_shape is the shape of one input image, in the layout of the
+    model.
+    """
+    params = model.params
+    W1, W2 = params['W1'], params['W2']
+    F = W1.shape[0]
+    layers = []
+    if model.layout == 'NHWC':
+        layers.append({'type': 'to_nchw'})
+        H, W = input_shape[0], input_shape[1]
+        if not model.global_pool:
+            # The rows of W2 are in (H', W', F) order for channels-last
+            # feature maps; permute them to the (F, H', W') order of the
+            # channels-first int8 convolution.
+            hidden_dim = W2.shape[1]
+            W2 = W2.reshape(H // 2, W // 2, F, hidden_dim)
+            W2 = W2.transpose(2, 0, 1, 3).reshape(-1, hidden_dim)
+
+    filter_size = W1.shape[2]
+    layers.append({
+        'type': 'conv_relu_pool', 'w': W1.astype(np.float32),
+        'b': params['b1'].astype(np.float32),
+        'conv_param': {'stride': 1, 'pad': (filter_size - 1) // 2},
+        'pool_param': {'pool_height': 2, 'pool_width': 2, 'stride': 2},
+    })
+    if model.global_pool:
+        layers.append({'type': 'global_avg_pool'})
+    layers.append(_affine_layer(W2, params['b2'], relu=True))
+    layers.append(_affine_layer(params['W3'], params['b3'], relu=False))
+    return layers
+
+
+def quantize_model(model, X_calib, percentile=100.0, blas=True):
+    """
+    Post-training int8 quantization of a trained model.
+
+    Inputs:
+    - model: A trained TwoLayerNet, FullyConnectedNet or ThreeLayerConvNet
+    - X_calib: A sample of input data, such as a few hundred training images,
+      used to calibrate the quantization scales of the layer inputs
+    - percentile: Percentile of the absolute value of each layer input that
+      is mapped to the largest int8 value; see calibrate_scale.
+    - blas: Passed to QuantizedModel
+
+    Models with low-rank factorized weights (see compression.py) or sparse
+    weights (see pruning.py) are not supported; quantize a model with dense
+    weights instead, such as a pruned model from prune_model with
+    to_sparse=False.
+
+    Returns a QuantizedModel.
+    """
+    for k, v in model.params.items():
+        if k[:1] in ('U', 'V') and k[1:].isdigit():
+            raise ValueError('Cannot quantize a model with factorized weight '
+                             '%s; quantize the uncompressed model instead' % k)
+        if is_sparse(v):
+            raise ValueError('Cannot quantize a model with sparse weight %s; '
+                             'use dense weights instead' % k)
+    if isinstance(model, ThreeLayerConvNet):
+        layers = _conv_net_layers(model, X_calib.shape[1:])
+    elif isinstance(model, FullyConnectedNet):
+        layers = _fc_layers(model)
+    elif isinstance(model, TwoLayerNet):
+        layers = [_affine_layer(model.params['W1'], model.params['b1'], True),
+                  _affine_layer(model.params['W2'], model.params['b2'], False)]
+    else:
+        raise ValueError('Cannot quantize model of type %s'
+                         % type(model).__name__)
+
+    qmodel = QuantizedModel(layers, blas)
+    qmodel._forward(X_calib, calibrate=True, percentile=percentile)
+    for layer in layers:
+        if 'w' in layer:
+            # Affine weights have their outputs along axis 1, filters along 0
+            axis = 0 if layer['type'] == 'conv_relu_pool' else 1
+            layer['w_q'], layer['w_scale'] = quantize_weights(layer.pop('w'),
+                                                              axis)
+    return qmodel
+
+
+def quantization_report(model, qmodel, X, y, batch_size=100, num_runs=3,
+                        verbose=True):
+    """
+    Compares a float model with its quantized version on a labelled dataset.
+
+    Inputs:
+    - model: The float model
+    - qmodel: The QuantizedModel returned by quantize_model(model, ...)
+    - X, y: Input data and labels
+    - batch_size: Size of the minibatches passed to loss
+    - num_runs: Number of timed passes over X; the fastest one is reported.
+    - verbose: Whether to print the report
+
+    Returns a dictionary with the following keys:
+    - float_acc, int8_acc: Accuracy of each model on (X, y)
+    - agreement: Fraction of inputs on which the models predict the same class
+    - float_time, int8_time: Seconds per pass over X
+    - float_bytes, int8_bytes: Size of the parameters of each model
+    """
+    def predict(m):
+        best, y_pred = None, None
+        for _ in range(num_runs):
+            start = timer()
+            y_pred = np.hstack([np.argmax(m.loss(X[i:i + batch_size]), axis=1)
+                                for i in range(0, X.shape[0], batch_size)])
+            elapsed = timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return y_pred, best
+
+    float_pred, float_time = predict(model)
+    int8_pred, int8_time = predict(qmodel)
+    report = {
+        'float_acc': np.mean(float_pred == y),
+        'int8_acc': np.mean(int8_pred == y),
+        'agreement': np.mean(float_pred == int8_pred),
+        'float_time': float_time,
+        'int8_time': int8_time,
+        'float_bytes': sum(v.nbytes for v in model.params.values()),
+        'int8_bytes': qmodel.nbytes,
+    }
+
+    if verbose:
+        print('%-6s %10s %12s %12s' % ('', 'accuracy', 'time (ms)', 'size (KB)'))
+        for name in ('float', 'int8'):
+            print('%-6s %10.4f %12.2f %12.1f' % (
+                   name, report[name + '_acc'], 1e3 * report[name + '_time'],
+                   report[name + '_bytes'] / 1024.0))
+        print('Predictions agree on %.2f%% of the inputs'
+              % (100 * report['agreement']))
+    return report
@@ -0,0 +1,328 @@
+from builtins import object
+from functools import partial
+
+import numpy as np
+
+from cs231n.layers import *
+from cs231n.fast_layers import *
+from cs231n.layer_utils import *
+
+
+class Sequential(object):
+    """
+    A model made of a sequence of layers from layers.py, fast_layers.py and
+    layer_utils.py, described by a list of layer specs, followed by a softmax
+    or SVM loss.
+
+    Each layer spec is a dictionary with a 'type' key and its options:
+
+    - {'type': 'affine', 'dim': M}
+    - {'type': 'conv', 'num_filters': F, 'filter_size': HH, 'stride': 1,
+       'pad': (HH - 1) // 2}
+    - {'type': 'relu'}
+    - {'type': 'max_pool', 'pool_size': 2, 'stride': pool_size}
+    - {'type': 'avg_pool', 'pool_size': 2, 'stride': pool_size}
+    - {'type': 'global_avg_pool'}
+    - {'type': 'batchnorm'}, {'type': 'layernorm'}: for affine outputs
+    - {'type': 'spatial_batchnorm'}, {'type': 'groupnorm', 'G': G}: for conv
+      outputs
+    - {'type': 'dropout', 'p': p}, where p is the probability of keeping a
+      unit
+
+    The weights and biases of the i-th affine or conv layer are stored in
+    params as 'Wi' and 'bi', and the scale and shift of a normalization layer
+    following it as 'gammai' and 'betai', as in FullyConnectedNet.
+
+    The model is compiled once, when it is built: consecutive layers that
+    have a fused implementation (conv - relu - 2x2 max pool, conv - spatial
+    batchnorm - relu, conv - relu and affine - relu) are merged, and every
+    layer becomes a forward and a backward function with its options bound
+    and the names of its parameters resolved. A call to loss then just runs
+    through this flat plan, with no per-layer dispatch.
+    """
+
+    def __init__(self, layers, input_dim=3*32*32, weight_scale=1e-3,
+                 reg=0.0, loss='softmax', dtype=np.float32, seed=None):
+        """
+        Initialize a new network.
+
+        Inputs:
+        - layers: List of layer specs, as described above
+        - input_dim: Integer giving the size of the input, or tuple (C, H, W)
+          giving the shape of input images
+        - weight_scale: Scalar giving the standard deviation for random
+          initialization of the weights, or 'kaiming' to use sqrt(2 / fan_in)
+          for each layer, which keeps the scale of the activations constant
+          through deep stacks of ReLU layers.
+        - reg: Scalar giving L2 regularization strength.
+        - loss: 'softmax' or 'svm'
+        - dtype: A numpy datatype object; all computations will be performed
+          using this datatype.
+        - seed: If not None, then pass this random seed to the dropout
+          layers. This will make the dropout layers deterministic so we can
+          gradient check the model.
+        """
+        if loss not in ('softmax', 'svm'):
+            raise ValueError('Invalid loss "%s"' % loss)
+        self.reg = reg
+        self.dtype = dtype
+        self.weight_scale = weight_scale
+        self.seed = seed
+        # Factor by which the gradients are scaled; set by the Solver for
+        # mixed-precision training so that they do not underflow in float16.
+        self.loss_scale = 1.0
+        self._loss_function = softmax_loss if loss == 'softmax' else svm_loss
+
+        self.params = {}
+        # The compiled plan: a list of (forward, backward, keys) tuples.
+        # forward(x, *params) returns (out, cache); for layers with
+        # parameters backward(dout, cache) returns (dx, dparam1, ...) in the
+        # order of keys, and otherwise just dx.
+        self._plan = []
+        # The bn_param and dropout_param dictionaries whose mode is set on
+        # every call to loss, and the names of the regularized weights.
+        self._mode_params = []
+        self._weight_keys = []
+        self._num_weight_layers = 0
+        self._num_dropout_layers = 0
+
+        shape = (input_dim,) if np.isscalar(input_dim) else tuple(input_dim)
+        i = 0
+        while i < len(layers):
+            consumed, shape = self._compile(layers[i:], shape)
+            i += consumed
+
+        for k, v in self.params.items():
+            self.params[k] = v.astype(dtype)
+
+
+    def loss(self, X, y=None):
+        """
+        Compute loss and gradient for the network.
+
+        Input / output: Same as TwoLayerNet in fc_net.py.
+        """
+        X = X.astype(self.dtype, copy=False)
+        mode = 'test' if y is None else 'train'
+        for param in self._mode_params:
+            param['mode'] = mode
+
+        params = self.params
+        out = X
+        caches = []
+        for forward, _, keys in self._plan:
+            out, cache = forward(out, *[params[k] for k in keys])
+            caches.append(cache)
+
+        if y is None:
+            return out
+
+        loss, dout = self._loss_function(out, y)
+        dout = (dout * self.loss_scale).astype(self.dtype, copy=False)
+        grads = {}
+        for (_, backward, keys), cache in zip(reversed(self._plan),
+                                              reversed(caches)):
+            if keys:
+                result = backward(dout, cache)
+                dout = result[0]
+                grads.update(zip(keys, result[1:]))
+            else:
+                dout = backward(dout, cache)
+
+        for k in self._weight_keys:
+            w = params[k]
+            loss += 0.5 * self.reg * np.sum(w * w)
+            grads[k] += self.loss_scale * self.reg * w
+
+        return loss, grads
+
+
+    def _compile(self, layers, shape):
+        """
+        Compiles the layer layers[0], merged with the layers following it if
+        they can be fused, given the shape of its input (without the batch
+        axis). Appends to the plan and returns the number of layer specs
+        consumed and the shape of the output.
+        """
+        spec = layers[0]
+        kind = spec['type']
+        following = tuple(l['type'] for l in layers[1:3])
+
+        if kind == 'affine':
+            index = self._add_weights((int(np.prod(shape)), spec['dim']))
+            keys = ('W%d' % index, 'b%d' % index)
+            if following[:1] == ('relu',):
+                self._plan.append((affine_relu_forward, affine_relu_backward,
+                                   keys))
+                return 2, (spec['dim'],)
+            self._plan.append((affine_forward, affine_backward, keys))
+            return 1, (spec['dim'],)
+
+        if kind == 'conv':
+            C, H, W = shape
+            F, HH = spec['num_filters'], spec['filter_size']
+            stride = spec.get('stride', 1)
+            pad = spec.get('pad', (HH - 1) // 2)
+            conv_param = {'stride': stride, 'pad': pad}
+            index = self._add_weights((F, C, HH, HH))
+            keys = ('W%d' % index, 'b%d' % index)
+            H = 1 + (H + 2 * pad - HH) // stride
+            W = 1 + (W + 2 * pad - HH) // stride
+
+            pool = layers[2] if len(layers) > 2 else {}
+            if (following == ('relu', 'max_pool')
+                    and pool.get('pool_size', 2) == 2
+                    and pool.get('stride', 2) == 2):
+                pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+                self._plan.append((
+                    partial(conv_relu_pool_forward, conv_param=conv_param,
+                            pool_param=pool_param),
+                    conv_relu_pool_backward, keys))
+                return 3, (F, H // 2, W // 2)
+            if following == ('spatial_batchnorm', 'relu'):
+                bn_param = self._add_norm(index, F, {'mode': 'train'})
+                self._plan.append((
+                    partial(conv_bn_relu_forward, conv_param=conv_param,
+                            bn_param=bn_param),
+                    conv_bn_relu_backward,
+                    keys + ('gamma%d' % index, 'beta%d' % index)))
+                return 3, (F, H, W)
+            if following[:1] == ('relu',):
+                self._plan.append((partial(conv_relu_forward,
+                                           conv_param=conv_param),
+                                   conv_relu_backward, keys))
+                return 2, (F, H, W)
+            self._plan.append((partial(conv_forward_fast, conv_param=conv_param),
+                               conv_backward_fast, keys))
+            return 1, (F, H, W)
+
+        if kind == 'relu':
+            self._plan.append((relu_forward, relu_backward, ()))
+            return 1, shape
+
+        if kind in ('max_pool', 'avg_pool'):
+            C, H, W = shape
+            size = spec.get('pool_size', 2)
+            stride = spec.get('stride', size)
+            pool_param = {'pool_height': size, 'pool_width': size,
+                          'stride': stride}
+            if kind == 'max_pool':
+                forward, backward = max_pool_forward_fast, max_pool_backward_fast
+            else:
+                forward, backward = avg_pool_forward_fast, avg_pool_backward_fast
+            self._plan.append((partial(forward, pool_param=pool_param),
+                               backward, ()))
+            return 1, (C, 1 + (H - size) // stride, 1 + (W - size) // stride)
+
+        if kind == 'global_avg_pool':
+            self._plan.append((global_avg_pool_forward,
+                               global_avg_pool_backward, ()))
+            return 1, shape[:1]
+
+        if kind in ('batchnorm', 'layernorm', 'spatial_batchnorm',
+                    'groupnorm'):
+            index = self._num_weight_layers
+            keys = ('gamma%d' % index, 'beta%d' % index)
+            C = shape[0]
+            if kind == 'batchnorm':
+                bn_param = self._add_norm(index, C, {'mode': 'train'})
+                forward = partial(batchnorm_forward_fused, bn_param=bn_param)
+                backward = batchnorm_backward_fused
+            elif kind == 'spatial_batchnorm':
+                bn_param = self._add_norm(index, C, {'mode': 'train'})
+                forward = partial(spatial_batchnorm_forward, bn_param=bn_param)
+                backward = spatial_batchnorm_backward
+            elif kind == 'layernorm':
+                ln_param = self._add_norm(index, C, {})
+                forward = partial(layernorm_forward, ln_param=ln_param)
+                backward = layernorm_backward
+            else:
+                gn_param = self._add_norm(index, C, {})
+                forward = partial(spatial_groupnorm_forward, G=spec['G'],
+                                  gn_param=gn_param)
+                backward = spatial_groupnorm_backward
+            self._plan.append((forward, backward, keys))
+            return 1, shape
+
+        if kind == 'dropout':
+            dropout_param = {'mode': 'train', 'p': spec['p'],
+                             'stream': self._num_dropout_layers}
+            if self.seed is not None:
+                dropout_param['seed'] = self.seed
+            self._num_dropout_layers += 1
+            self._mode_params.append(dropout_param)
+            self._plan.append((partial(dropout_forward,
+                                       dropout_param=dropout_param),
+                               dropout_backward, ()))
+            return 1, shape
+
+        raise ValueError('Invalid layer type "%s"' % kind)
+
+
+    def _add_weights(self, shape):
+        """
+        Initializes the weights of the given shape and the biases of the next
+        affine or conv layer, and returns its index.
+        """
+        self._num_weight_layers += 1
+        index = self._num_weight_layers
+        scale = self.weight_scale
+        if scale == 'kaiming':
+            # Affine weights are (fan_in, M), conv filters (F, C, HH, WW)
+            fan_in = shape[0] if len(shape) == 2 else np.prod(shape[1:])
+            scale = np.sqrt(2.0 / fan_in)
+        self.params['W%d' % index] = np.random.normal(0, scale, shape)
+        self.params['b%d' % index] = np.zeros(shape[-1] if len(shape) == 2
+                                              else shape[0])
+        self._weight_keys.append('W%d' % index)
+        return index
+
+
+    def _add_norm(self, index, num_features, norm_param):
+        """
+        Initializes the scale and shift of a normalization layer with
+        num_features features following the weight layer with the given index.
+        Returns norm_param, which is registered for mode switching if it has a
+        mode.
+        """
+        self.params['gamma%d' % index] = np.ones(num_features)
+        self.params['beta%d' % index] = np.zeros(num_features)
+        if 'mode' in norm_param:
+            self._mode_params.append(norm_param)
+        return norm_param
+
+
+def fc_net_layers(hidden_dims, num_classes=10, normalization=None,
+                  dropout=1):
+    """
+    Layer specs for a Sequential model with the architecture of a
+    FullyConnectedNet with the same arguments.
+    """
+    layers = []
+    for dim in hidden_dims:
+        layers.append({'type': 'affine', 'dim': dim})
+        if normalization is not None:
+            layers.append({'type': normalization})
+        layers.append({'type': 'relu'})
+        if dropout != 1:
+            layers.append({'type': 'dropout', 'p': dropout})
+    layers.append({'type': 'affine', 'dim': num_classes})
+    return layers
+
+
+def three_layer_convnet_layers(num_filters=32, filter_size=7, hidden_dim=100,
+                               num_classes=10, global_pool=False):
+    """
+    Layer specs for a Sequential model with the architecture of a
+    ThreeLayerConvNet with the same arguments.
+    """
+    layers = [{'type': 'conv', 'num_filters': num_filters,
+               'filter_size': filter_size},
+              {'type': 'relu'},
+              {'type': 'max_pool', 'pool_size': 2, 'stride': 2}]
+    if global_pool:
+        layers.append({'type': 'global_avg_pool'})
+    layers += [{'type': 'affine', 'dim': hidden_dim},
+               {'type': 'relu'},
+               {'type': 'affine', 'dim': num_classes}]
+    return layers
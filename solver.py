@@ -5,10 +5,13 @@ from builtins import range
 from builtins import object
 import os
 import pickle as pickle
+import tracemalloc
 
 import numpy as np
 
 from cs231n import optim
+from cs231n import pruning
+from cs231n.workspace import workspace
 
 
 class Solver(object):
@@ -77,6 +80,10 @@ class Solver(object):
       - loss: Scalar giving the loss
       - grads: Dictionary with the same keys as self.params mapping parameter
         names to gradients of the loss with respect to those parameters.
+
+    For mixed-precision training the model must also have a loss_scale
+    attribute, by which it multiplies the gradients it returns (the loss
+    itself is not scaled); see the mixed_precision option below.
     """
 
     def __init__(self, model, data, **kwargs):
@@ -113,6 +120,32 @@ class Solver(object):
           accuracy; default is None, which uses the entire validation set.
         - checkpoint_name: If not None, then save model checkpoints here every
           epoch.
+        - mixed_precision: Boolean; if set to true then the model parameters,
+          minibatches, activations and caches are stored in float16, while
+          the update rule works on float32 master copies of the parameters
+          (so that optimizer state such as Adam moments is float32 too).
+          Gradients are computed with dynamic loss scaling: steps whose
+          gradients overflow are skipped and halve the scale, and the scale
+          doubles after loss_scale_window steps without overflow.
+        - loss_scale: Initial loss scale for mixed-precision training.
+        - loss_scale_window: Number of steps without overflow after which the
+          loss scale is doubled.
+        - min_loss_scale: Smallest loss scale; if the gradients still
+          overflow at this scale (for instance because the loss itself is
+          NaN), training stops with a FloatingPointError.
+        - prune_config: If not None, a dictionary enabling iterative magnitude
+          pruning of the weights (see pruning.py), with the keys:
+          - sparsity: Final fraction of each pruned weight that is zero;
+            default 0.9.
+          - params: Names of the weights to prune; default all 2D weights.
+          - start_epoch, end_epoch: The sparsity rises from zero after
+            start_epoch (default 0) to its final value at end_epoch (default
+            num_epochs - 1, leaving an epoch of fine-tuning), with a pruning
+            step at the end of every epoch in between.
+          - to_sparse: If True (the default), at end_epoch the pruned weights
+            are replaced by scipy.sparse CSR matrices, which are then trained
+            on their sparsity pattern.
+          The best parameters are only tracked once pruning is done.
         """
         self.model = model
         self.X_train = data['X_train']
@@ -133,6 +166,12 @@ class Solver(object):
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
 
+        self.mixed_precision = kwargs.pop('mixed_precision', False)
+        self.loss_scale = kwargs.pop('loss_scale', 2.0 ** 15)
+        self.loss_scale_window = kwargs.pop('loss_scale_window', 200)
+        self.min_loss_scale = kwargs.pop('min_loss_scale', 1.0)
+        self.prune_config = kwargs.pop('prune_config', None)
+
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
             extra = ', '.join('"%s"' % k for k in list(kwargs.keys()))
@@ -144,6 +183,17 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        if self.prune_config is not None:
+            if self.mixed_precision:
+                raise ValueError('Pruning does not support mixed precision')
+            self.prune_config = dict(self.prune_config)
+            self.prune_config.setdefault('sparsity', 0.9)
+            self.prune_config.setdefault(
+                'params', pruning.prunable_params(self.model.params))
+            self.prune_config.setdefault('start_epoch', 0)
+            self.prune_config.setdefault('end_epoch', max(self.num_epochs - 1, 1))
+            self.prune_config.setdefault('to_sparse', True)
+
         self._reset()
 
 
@@ -166,6 +216,23 @@ class Solver(object):
             d = {k: v for k, v in self.optim_config.items()}
             self.optim_configs[p] = d
 
+        # For mixed precision, keep float32 master copies of the parameters
+        # and give the model float16 ones
+        self.master_params = {}
+        self.num_skipped_steps = 0
+        self._num_good_steps = 0
+        if self.mixed_precision:
+            for p, w in self.model.params.items():
+                self.master_params[p] = w.astype(np.float32)
+                self.model.params[p] = w.astype(np.float16)
+            if hasattr(self.model, 'dtype'):
+                self.model.dtype = np.float16
+            self.model.loss_scale = self.loss_scale
+
+        # Masks of the weights being pruned; pruned entries are zeroed after
+        # every update.
+        self.prune_masks = {}
+
 
     def _step(self):
         """
@@ -178,6 +245,16 @@ class Solver(object):
         X_batch = self.X_train[batch_mask]
         y_batch = self.y_train[batch_mask]
 
+        if self.mixed_precision:
+            # Overflows in the scaled backward pass are expected and handled
+            # by _mixed_precision_update.
+            with np.errstate(over='ignore', invalid='ignore'):
+                loss, grads = self.model.loss(X_batch.astype(np.float16),
+                                              y_batch)
+            self.loss_history.append(loss)
+            self._mixed_precision_update(grads)
+            return
+
         # Compute loss and gradient
         loss, grads = self.model.loss(X_batch, y_batch)
         self.loss_history.append(loss)
@@ -186,11 +263,175 @@ class Solver(object):
         for p, w in self.model.params.items():
             dw = grads[p]
             config = self.optim_configs[p]
+            if pruning.is_sparse(w):
+                # Only the stored entries of sparse weights are trained
+                dw = pruning.pattern_data(dw, w)
+                w.data, next_config = self.update_rule(w.data, dw, config)
+                self.optim_configs[p] = next_config
+                continue
             next_w, next_config = self.update_rule(w, dw, config)
+            if p in self.prune_masks:
+                next_w *= self.prune_masks[p]
             self.model.params[p] = next_w
             self.optim_configs[p] = next_config
 
 
+    def _prune(self):
+        """
+        Pruning step at the end of an epoch: raises the sparsity of the pruned
+        weights according to the schedule, and at end_epoch converts them to
+        sparse matrices. Called by train().
+        """
+        config = self.prune_config
+        start_epoch, end_epoch = config['start_epoch'], config['end_epoch']
+        if not start_epoch < self.epoch <= end_epoch:
+            return
+        sparsity = pruning.prune_schedule(self.epoch, config['sparsity'],
+                                          start_epoch, end_epoch)
+        for p in config['params']:
+            w = self.model.params[p]
+            mask = pruning.magnitude_prune(w, sparsity)
+            self.model.params[p] = w * mask
+            self.prune_masks[p] = mask
+            if self.epoch == end_epoch and config['to_sparse']:
+                self.model.params[p] = pruning.to_csr(w, mask)
+                del self.prune_masks[p]
+                # Keep the optimizer state of the surviving weights, which
+                # to_csr stores in the order of w[mask]
+                optim_config = self.optim_configs[p]
+                for k, v in optim_config.items():
+                    if isinstance(v, np.ndarray) and v.shape == w.shape:
+                        optim_config[k] = v[mask]
+
+
+    def _mixed_precision_update(self, grads):
+        """
+        Parameter update for mixed-precision training: unscales the gradients
+        in float32, updates the master parameters unless some gradient
+        overflowed, and adjusts the loss scale. Called by _step.
+        """
+        scale = self.model.loss_scale
+        grads32 = {}
+        for p, dw in grads.items():
+            grads32[p] = dw.astype(np.float32)
+            if not np.all(np.isfinite(grads32[p])):
+                # The gradients overflowed in float16; skip this step and
+                # try again with a smaller scale.
+                if scale <= self.min_loss_scale:
+                    raise FloatingPointError(
+                        'Non-finite gradient for %s at the minimum loss '
+                        'scale %g' % (p, scale))
+                self.loss_scale = max(scale / 2, self.min_loss_scale)
+                self.model.loss_scale = self.loss_scale
+                self.num_skipped_steps += 1
+                self._num_good_steps = 0
+                return
+
+        for p, w in self.master_params.items():
+            dw = grads32[p]
+            dw /= scale
+            config = self.optim_configs[p]
+            next_w, next_config = self.update_rule(w, dw, config)
+            self.master_params[p] = next_w
+            self.model.params[p] = next_w.astype(np.float16)
+            self.optim_configs[p] = next_config
+
+        self._num_good_steps += 1
+        if self._num_good_steps == self.loss_scale_window:
+            self.loss_scale = scale * 2
+            self.model.loss_scale = self.loss_scale
+            self._num_good_steps = 0
+
+
+    def memory_report(self, batch_size=None):
+        """
+        Measures the memory used for training with the current precision
+        settings against float32 training of the same model.
+
+        This runs one training-time forward and backward pass on a minibatch
+        of the training data with float16 storage and one with float32 storage,
+        recording the peak memory allocated during each with tracemalloc. Note
+        that like any training step these update the running averages of batch
+        normalization layers. Sparse (pruned) weights are kept in float32 for
+        both passes, since scipy.sparse does not support float16.
+
+        Inputs:
+        - batch_size: Size of the minibatch; defaults to self.batch_size.
+
+        Returns a dictionary with the following keys, all in bytes:
+        - params: Size of model.params; for a sparse weight, the size of its
+          data, indices and indptr arrays
+        - master_params: Size of the float32 master copies of the parameters
+          (zero without mixed precision)
+        - optimizer_state: Size of the arrays held in the optimizer configs
+        - peak_float16: Peak memory of a training step in float16
+        - peak_float32: Peak memory of a training step in float32
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        X_batch = self.X_train[:batch_size]
+        y_batch = self.y_train[:batch_size]
+
+        def nbytes(arrays):
+            total = 0
+            for a in arrays:
+                if pruning.is_sparse(a):
+                    total += a.data.nbytes + a.indices.nbytes + a.indptr.nbytes
+                elif isinstance(a, np.ndarray):
+                    total += a.nbytes
+            return total
+
+        def cast(v, peak_dtype):
+            # scipy.sparse has no float16, so sparse weights stay float32
+            if pruning.is_sparse(v):
+                return v.astype(np.float32)
+            return v.astype(peak_dtype)
+
+        report = {
+            'params': nbytes(self.model.params.values()),
+            'master_params': nbytes(self.master_params.values()),
+            'optimizer_state': sum(nbytes(config.values())
+                                   for config in self.optim_configs.values()),
+        }
+
+        params = self.model.params
+        dtype = getattr(self.model, 'dtype', None)
+        loss_scale = getattr(self.model, 'loss_scale', None)
+        try:
+            for name, peak_dtype in [('peak_float16', np.float16),
+                                     ('peak_float32', np.float32)]:
+                self.model.params = {k: cast(v, peak_dtype)
+                                     for k, v in params.items()}
+                if dtype is not None:
+                    self.model.dtype = peak_dtype
+                if loss_scale is not None:
+                    self.model.loss_scale = 1.0
+                X = X_batch.astype(peak_dtype)
+                workspace.clear()
+                tracemalloc.start()
+                try:
+                    self.model.loss(X, y_batch)
+                    _, report[name] = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+        finally:
+            # Restore the model even if a measurement failed
+            self.model.params = params
+            if dtype is not None:
+                self.model.dtype = dtype
+            if loss_scale is not None:
+                self.model.loss_scale = loss_scale
+            workspace.clear()
+
+        if self.verbose:
+            print('Peak training step memory: %.1f MB in float16, %.1f MB in '
+                  'float32 (%.0f%% saved)' % (
+                   report['peak_float16'] / 2.0 ** 20,
+                   report['peak_float32'] / 2.0 ** 20,
+                   100 * (1 - report['peak_float16'] / report['peak_float32'])))
+        return report
+
+
     def _save_checkpoint(self):
         if self.checkpoint_name is None: return
         checkpoint = {
@@ -277,6 +518,8 @@ class Solver(object):
                 self.epoch += 1
                 for k in self.optim_configs:
                     self.optim_configs[k]['learning_rate'] *= self.lr_decay
+                if self.prune_config is not None:
+                    self._prune()
 
             # Check train and val accuracy on the first iteration, the last
             # iteration, and at the end of each epoch.
@@ -295,8 +538,11 @@ class Solver(object):
                     print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
                            self.epoch, self.num_epochs, train_acc, val_acc))
 
-                # Keep track of the best model
-                if val_acc > self.best_val_acc:
+                # Keep track of the best model; when pruning, only once the
+                # final sparsity has been reached.
+                pruned = (self.prune_config is None or last_it or
+                          self.epoch >= self.prune_config['end_epoch'])
+                if pruned and val_acc > self.best_val_acc:
                     self.best_val_acc = val_acc
                     self.best_params = {}
                     for k, v in self.model.params.items():
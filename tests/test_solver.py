@@ -0,0 +1,37 @@
+import numpy as np
+
+from cs231n.fc_net import FullyConnectedNet
+from cs231n.pruning import is_sparse
+from cs231n.solver import Solver
+
+
+def _small_data(num_train=40, input_dim=20, num_classes=5):
+    np.random.seed(0)
+    X = np.random.randn(num_train, input_dim)
+    y = np.random.randint(num_classes, size=num_train)
+    return {'X_train': X, 'y_train': y, 'X_val': X, 'y_val': y}
+
+
+def test_memory_report_after_pruning():
+    data = _small_data()
+    model = FullyConnectedNet([30], input_dim=20, num_classes=5,
+                              dtype=np.float32)
+    solver = Solver(model, data, num_epochs=1, batch_size=10,
+                    prune_config={'sparsity': 0.5}, verbose=False)
+    solver.train()
+    assert is_sparse(model.params['W1'])
+
+    report = solver.memory_report()
+
+    expected = 0
+    for v in model.params.values():
+        if is_sparse(v):
+            expected += v.data.nbytes + v.indices.nbytes + v.indptr.nbytes
+        else:
+            expected += v.nbytes
+    assert report['params'] == expected
+    assert report['peak_float16'] > 0
+    assert report['peak_float32'] > 0
+    # The model is left as it was
+    assert model.params['W1'].dtype == np.float32
+    assert model.dtype == np.float32
@@ -0,0 +1,122 @@
+from builtins import object
+import threading
+
+import numpy as np
+
+"""
+This file implements a pool of reusable scratch buffers ("workspaces") for the
+fast layers. Convolution and pooling layers need several large temporary
+arrays per call (padded inputs, im2col matrices, GEMM results); allocating
+them afresh every iteration means hundreds of MB of allocations per training
+step. Instead, layers acquire buffers from the pool and release them once they
+are done, so that in steady state the same memory is handed out again.
+
+Buffers are keyed by shape and dtype. A buffer that has been acquired belongs
+to the caller until it is released; the pool never hands out a buffer twice
+and keeps no reference to buffers that are in use, so forgetting to release a
+buffer only means it will be garbage collected instead of reused. Releasing
+a buffer that is already free is an error, since the pool would then hand the
+same memory to two callers.
+"""
+
+
+class WorkspacePool(object):
+    """
+    A thread-safe pool of numpy arrays keyed by (shape, dtype).
+
+    Example usage:
+
+    buf = workspace.acquire((C * HH * WW, N * H * W), x.dtype)
+    ... fill and use buf ...
+    workspace.release(buf)
+    """
+
+    def __init__(self):
+        self._free = {}
+        # ids of the free buffers; they are unique since the pool holds a
+        # reference to every free buffer.
+        self._free_ids = set()
+        self._lock = threading.Lock()
+        self.num_allocations = 0
+
+    def acquire(self, shape, dtype):
+        """
+        Returns a C-contiguous array of the given shape and dtype. The contents
+        of the array are undefined.
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            buffers = self._free.get(key)
+            if buffers:
+                buf = buffers.pop()
+                self._free_ids.discard(id(buf))
+                return buf
+            self.num_allocations += 1
+        return np.empty(shape, dtype=dtype)
+
+    def acquire_zeros(self, shape, dtype):
+        """
+        Like acquire, but the returned array is filled with zeros.
+        """
+        buf = self.acquire(shape, dtype)
+        buf.fill(0)
+        return buf
+
+    def release(self, *buffers):
+        """
+        Gives buffers obtained from acquire back to the pool. The caller must
+        not use them afterwards.
+
+        Raises a ValueError if a buffer is already free, for instance because
+        a cache holding it was given to a backward pass twice.
+        """
+        with self._lock:
+            for buf in buffers:
+                if id(buf) in self._free_ids:
+                    raise ValueError('Buffer of shape %s was released twice'
+                                     % (buf.shape,))
+                key = (buf.shape, buf.dtype.str)
+                self._free.setdefault(key, []).append(buf)
+                self._free_ids.add(id(buf))
+
+    def clear(self):
+        """
+        Drops all free buffers, returning their memory to the system.
+        """
+        with self._lock:
+            self._free = {}
+            self._free_ids = set()
+
+    @property
+    def nbytes(self):
+        """
+        Total size in bytes of the free buffers held by the pool.
+        """
+        with self._lock:
+            return sum(buf.nbytes for buffers in self._free.values()
+                       for buf in buffers)
+
+
+def pad_into(x, pad, pool):
+    """
+    Zero-pads the last two axes of x by pad on each side, writing into a
+    buffer acquired from pool rather than allocating a new array like np.pad.
+    Only the border is zeroed, since the interior is overwritten with x.
+
+    The caller is responsible for releasing the returned buffer.
+    """
+    shape = x.shape[:-2] + (x.shape[-2] + 2 * pad, x.shape[-1] + 2 * pad)
+    x_padded = pool.acquire(shape, x.dtype)
+    if pad > 0:
+        x_padded[..., :pad, :] = 0
+        x_padded[..., -pad:, :] = 0
+        x_padded[..., pad:-pad, :pad] = 0
+        x_padded[..., pad:-pad, -pad:] = 0
+        x_padded[..., pad:-pad, pad:-pad] = x
+    else:
+        x_padded[...] = x
+    return x_padded
+
+
+# The pool shared by all of the fast layers.
+workspace = WorkspacePool()